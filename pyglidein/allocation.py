@@ -0,0 +1,173 @@
+"""
+Allocation of the demand between clients.
+
+Every client reading the full state tries to satisfy all of it, so with
+several clients serving the same jobs far more glideins are submitted
+than there are jobs. In allocation mode the server splits each row of the
+state between the clients that can run it, and every client only gets
+its own share.
+
+A client takes part by sending its uuid with its state requests. It holds
+a lease on its share for `lease_time` seconds after it last asked for the
+state or reported monitoring, after which its share goes to the others.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import zlib
+import logging
+from collections import Counter, OrderedDict
+
+from pyglidein.util import json_encode
+
+from pyglidein.net_demand import subtract_pending
+
+logger = logging.getLogger('server')
+
+
+class DemandAllocator(object):
+    """
+    Leases of the demand, by client uuid.
+
+    Shares are a pure function of the state, the clients holding a lease
+    and their filters, so every server process hands out the same shares.
+    The glideins a client launched or has running are deliberately not
+    weighed in: monitoring only reaches the worker processes every few
+    seconds, so workers would disagree on the split. A client only gets
+    its own idle glideins taken out of its share, see `allocate`.
+    """
+
+    def __init__(self, lease_time=900):
+        """
+        Args:
+            lease_time: seconds a client keeps its share after it was last seen
+        """
+        self.lease_time = lease_time
+        # uuid -> (last request, filters), least recently seen first
+        self.clients = OrderedDict()
+        # uuid -> latest lease handed out
+        self.leases = {}
+
+    def touch(self, uuid, filters=None, seen=None):
+        """
+        Record a state request from a client.
+
+        Args:
+            uuid: client uuid
+            filters: state filters of the client (see server.StateIndex.filter)
+            seen: when the client asked (default: now)
+
+        Returns:
+            bool: True if the client is new or changed its filters
+        """
+        if seen is None:
+            seen = time.time()
+        filters = filters or {}
+        old = self.clients.pop(uuid, None)
+        if old is not None and old[0] > seen:
+            seen = old[0]
+        self.clients[uuid] = (seen, filters)
+        return old is None or old[1] != filters
+
+    def last_seen(self, uuid, monitoring=None):
+        """When a client last asked for the state or reported monitoring"""
+        seen = self.clients[uuid][0] if uuid in self.clients else 0
+        if monitoring is not None:
+            seen = max(seen, monitoring.last_seen(uuid) or 0)
+        return seen
+
+    def expire(self, monitoring=None):
+        """Drop the clients whose lease ran out"""
+        cutoff = time.time() - self.lease_time
+        for uuid in list(self.clients):
+            if self.last_seen(uuid, monitoring) < cutoff:
+                logger.info('allocation lease of %r expired', uuid)
+                del self.clients[uuid]
+                self.leases.pop(uuid, None)
+
+    def active(self, monitoring=None):
+        """Get the clients holding a lease, sorted by uuid"""
+        self.expire(monitoring)
+        return sorted(self.clients)
+
+    @staticmethod
+    def split(key, count, clients):
+        """
+        Split the jobs of a row evenly between clients.
+
+        The rounding remainder goes to clients picked by a checksum of the
+        row, so it is spread over the clients instead of always going to
+        the first ones.
+
+        Args:
+            key: row key
+            count: number of jobs
+            clients: uuids of the clients that can run the row, sorted
+
+        Returns:
+            dict: uuid -> number of jobs
+        """
+        n = len(clients)
+        base, extra = divmod(count, n)
+        offset = zlib.crc32(json_encode(key).encode('utf-8')) % n
+        return dict((uuid, base + (1 if (i - offset) % n < extra else 0))
+                    for i, uuid in enumerate(clients))
+
+    def allocate(self, uuid, index, monitoring=None, pending_jobs=0):
+        """
+        Get the share of the state of a client.
+
+        The client must have been recorded with `touch` first. Rows are
+        split evenly between the clients that can run them, whatever they
+        launched or have running.
+
+        Args:
+            uuid: client uuid
+            index: server.StateIndex of the current state
+            monitoring: MonitoringStore, for when clients last reported
+            pending_jobs: jobs the client's idle glideins will run, taken
+                          out of its share
+
+        Returns:
+            list: the rows of the client, with `count` set to its share
+                  and `total_count` to the count of the whole row
+        """
+        clients = self.active(monitoring)
+        client_rows = dict((c, index.filter(self.clients[c][1])) for c in clients)
+        mine = client_rows[uuid]
+        share = Counter()
+        for key, row in mine.items():
+            eligible = [c for c in clients if key in client_rows[c]]
+            share[key] = self.split(key, row['count'], eligible)[uuid]
+        if pending_jobs:
+            share = subtract_pending(share, pending_jobs)
+        ret = []
+        for key, row in mine.items():
+            if share[key] > 0:
+                row = dict(row)
+                row['total_count'] = row['count']
+                row['count'] = share[key]
+                ret.append(row)
+        self.leases[uuid] = {
+            'expires': self.last_seen(uuid, monitoring) + self.lease_time,
+            'clients': len(clients),
+            'jobs': sum(share.values()),
+            'total_jobs': sum(row['count'] for row in mine.values()),
+        }
+        return ret
+
+    def get_leases(self, monitoring=None):
+        """Get the lease of every active client"""
+        clients = self.active(monitoring)
+        return dict((uuid, self.leases[uuid]) for uuid in clients if uuid in self.leases)
+
+    def dump(self):
+        """Get the clients as a json-serializable list"""
+        return [[uuid, seen, filters] for uuid, (seen, filters) in self.clients.items()]
+
+    def restore(self, dump):
+        """Merge in `dump` output from another process"""
+        for uuid, seen, filters in dump:
+            if uuid not in self.clients or self.clients[uuid][0] <= seen:
+                self.touch(uuid, filters, seen)
@@ -8,18 +8,25 @@ import subprocess
 import logging
 import socket
 import getpass
+import threading
+from functools import partial
 from optparse import OptionParser
 import stat
 
 from pyglidein.util import json_decode
-from pyglidein.client_util import get_state, monitoring
+from pyglidein.client_util import StateSync, wait_for_state
 import pyglidein.submit as submit
 import pyglidein.client_metrics as client_metrics
+from pyglidein.scheduler_snapshot import get_snapshot
 
 from pyglidein.config import Config
 
 logger = logging.getLogger('client')
 
+# monitoring is only held back for the next state request if that comes
+# within this many seconds
+monitoring_batch_window = 10
+
 
 
 def get_ssh_state():
@@ -77,6 +84,191 @@ def sort_states(state, columns, reverse=True):
     return sorted(state, key=compare, reverse=reverse)
 
 
+def get_state_filter(config_dict, partitions, sched_type):
+    """
+    Build server-side state filters that keep every row any partition can run.
+
+    The filters are the loosest limits over all partitions, so rows are
+    still checked per partition before submitting.
+
+    Args:
+        config_dict: the client config
+        partitions: list of partition names
+        sched_type: scheduler name
+
+    Returns:
+        dict: filters for the get_state and get_state_delta methods
+    """
+    clusters = [config_dict[p] for p in partitions]
+    filters = {}
+    if all(c.get('gpu_only', False) for c in clusters):
+        filters['gpu_only'] = True
+    if all(c.get('cpu_only', False) for c in clusters):
+        filters['cpu_only'] = True
+    for resource in ('cpus','gpus','memory','disk'):
+        max_values = []
+        min_values = []
+        for c in clusters:
+            if c.get('whole_node', False):
+                max_values.append(c.get('whole_node_%s'%resource))
+            else:
+                max_values.append(c.get('max_%s_per_job'%resource))
+            min_values.append(c.get('min_%s_per_job'%resource))
+        if None not in max_values:
+            filters['max_'+resource] = max(max_values)
+        if None not in min_values:
+            filters['min_'+resource] = min(min_values)
+    if sched_type == "pbs" and 'min_memory' in filters:
+        # the memory of pbs rows is scaled up before comparing
+        filters['min_memory'] = filters['min_memory']*1000/1024
+    return filters
+
+class Throttle(object):
+    """
+    Bounds on the concurrent calls to the local scheduler.
+
+    Queries (running, idle and idle time commands) of different partitions
+    run concurrently, up to `queries` at a time. Submits write the same
+    submit files, so only one runs at a time.
+    """
+    def __init__(self, queries=4):
+        self.query = threading.BoundedSemaphore(queries)
+        self.submit = threading.Lock()
+
+def run_concurrently(tasks):
+    """
+    Run functions in threads, and wait for all of them.
+
+    Args:
+        tasks: list of functions without arguments
+
+    Returns:
+        list: the return value of each function
+
+    Raises:
+        the first exception raised by a function, once all are done
+    """
+    results = [None]*len(tasks)
+    errors = []
+    def run(i):
+        try:
+            results[i] = tasks[i]()
+        except Exception as e:
+            logger.error('error in client task', exc_info=True)
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(tasks))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+def run_partition(partition, state, config_dict, scheduler, sched_type, info,
+                  metrics_bundle, throttle, snapshot=None):
+    """
+    Submit glideins for the state to one partition.
+
+    Runs concurrently with the other partitions, so the rows are copied
+    before they are modified.
+
+    Args:
+        partition: partition name
+        state: list of state rows
+        config_dict: the client config
+        scheduler: Submit object
+        sched_type: scheduler name
+        info: monitoring info, filled in for the partition
+        metrics_bundle: ClientMetricsBundle, filled in for the partition
+        throttle: Throttle of the scheduler
+        snapshot: SchedulerSnapshot to get the running and idle counts
+                  from, instead of running_cmd and idle_cmd
+    """
+    config_cluster = config_dict[partition]
+    if snapshot is None and "running_cmd" not in config_cluster:
+        raise Exception('Section [%s] has no running_cmd' % partition)
+    idle = 0
+    try:
+        with throttle.query:
+            if snapshot is not None:
+                info['glideins_running'][partition] = snapshot.running(partition)
+            else:
+                info['glideins_running'][partition] = get_running(config_cluster["running_cmd"])
+            metrics_bundle.update_metric('glideins_running', partition,
+                                         info['glideins_running'][partition])
+            if snapshot is not None or "idle_cmd" in config_cluster:
+                if snapshot is not None:
+                    idle = snapshot.idle(partition)
+                else:
+                    idle = get_running(config_cluster["idle_cmd"])
+                info['glideins_idle'][partition] = idle
+                metrics_bundle.update_metric('glideins_idle', partition,
+                                             info['glideins_idle'][partition])
+    except Exception:
+        logger.warn('error getting running job count', exc_info=True)
+        return
+    info['glideins_launched'][partition] = 0
+    limit = min(config_cluster["limit_per_submit"],
+                config_cluster["max_total_jobs"] - info['glideins_running'][partition],
+                max(config_cluster.get("max_idle_jobs", 1000) - idle, 0))
+    # Prioitize job submission. By default, prioritize submission of gpu and high memory jobs.
+    state = sort_states([dict(s) for s in state], config_cluster["prioritize_jobs"])
+    for s in state:
+        if sched_type == "pbs":
+            s["memory"] = s["memory"]*1024/1000
+        if limit <= 0:
+            logger.info('reached limit')
+            break
+        # Skipping CPU jobs for gpu only clusters
+        if ('gpu_only' in config_cluster and config_cluster['gpu_only']
+            and s["gpus"] == 0):
+            continue
+        # skipping GPU jobs for cpu only clusters
+        if ('cpu_only' in config_cluster and config_cluster['cpu_only']
+            and s["gpus"] != 0):
+            continue
+        # skipping jobs over cluster resource limits
+        if config_cluster['whole_node']:
+            prefix = 'whole_node_%s'
+        else:
+            prefix = 'max_%s_per_job'
+        for resource in ('cpus','gpus','memory','disk'):
+            cfg_name = prefix%resource
+            if (cfg_name in config_cluster
+                and s[resource] > config_cluster[cfg_name]):
+                break
+            cfg_name = 'min_%s_per_job'%resource
+            if (cfg_name in config_cluster
+                and s[resource] < config_cluster[cfg_name]):
+                break
+        else:
+            if "count" in s and s["count"] > limit:
+                s["count"] = limit
+            with throttle.submit:
+                job_ids = scheduler.submit(s, partition)
+            num = 1 if "count" not in s else s["count"]
+            if job_ids:
+                logger.info('submitted %d glideins on %s as jobs %s', num, partition,
+                            ','.join(str(job_id) for job_id in job_ids))
+            limit -= num
+            info['glideins_launched'][partition] += num
+    metrics_bundle.update_metric('glideins_launched', partition,
+                                 info['glideins_launched'][partition])
+    logger.info('launched %d glideins on %s', info['glideins_launched'][partition], partition)
+
+def next_cycle(start, delay, now=None):
+    """
+    Get the start of the next cycle, on a fixed cadence.
+
+    Cycles start every `delay` seconds after `start`. Cycles that would
+    have started while the previous one was still running are skipped.
+    """
+    if now is None:
+        now = time.time()
+    return start + delay*(int((now - start) // delay) + 1)
+
 def main():
     parser = OptionParser()
     parser.add_option('--config', type='string', default='cluster.config',
@@ -161,94 +353,102 @@ def main():
                 logger.error('Missing %s secret value in StartdLogging Section' % secret_val)
                 sys.exit(1)
 
+    state_filter = get_state_filter(config_dict,
+                                    config_dict['Cluster'].get('partitions', ['Cluster']),
+                                    sched_type)
+    if 'uuid' in config_glidein:
+        options.uuid = config_glidein['uuid']
+    state_sync = StateSync(config_glidein['address'], state_filter, uuid=options.uuid)
+    throttle = Throttle(config_glidein.get('max_concurrent_queries', 4))
+    snapshot = get_snapshot(config_dict, sched_type)
+    # monitoring bundle to send together with the next state request
+    pending_metrics = None
+    cadence_start = time.time()
     while True:
+        cycle_start = time.time()
+        if snapshot is not None:
+            # counts from the last cycle miss its submits and completions
+            snapshot.invalidate()
         if 'ssh_state' in config_glidein and config_glidein['ssh_state']:
             state = get_ssh_state()
         else:
-            state = get_state(config_glidein['address'])
-        if 'uuid' in config_glidein:
-            options.uuid = config_glidein['uuid']
+            state = state_sync.get_state(pending_metrics)
+            pending_metrics = None
+            if (state and state_sync.age is not None and 'max_state_age' in config_glidein
+                and state_sync.age > config_glidein['max_state_age']):
+                logger.info('state is %d seconds old, ignoring it', state_sync.age)
+                state = []
         info = {'uuid': options.uuid,
                 'glideins_idle': dict(),
                 'glideins_running': dict(),
                 'glideins_launched': dict(),
                }
         metrics_bundle = client_metrics.ClientMetricsBundle(options.uuid)
+        tasks = []
         if state:
             for partition in config_dict['Cluster'].get('partitions', ['Cluster']):
-                config_cluster = config_dict[partition]
-                if "running_cmd" not in config_cluster:
-                    raise Exception('Section [%s] has no running_cmd' % partition)
-                idle = 0
-                try:
-                    info['glideins_running'][partition] = get_running(config_cluster["running_cmd"])
-                    metrics_bundle.update_metric('glideins_running', partition,
-                                                 info['glideins_running'][partition])
-                    if "idle_cmd" in config_cluster:
-                        idle = get_running(config_cluster["idle_cmd"])
-                        info['glideins_idle'][partition] = idle
-                        metrics_bundle.update_metric('glideins_idle', partition,
-                                                     info['glideins_idle'][partition])
-                except Exception:
-                    logger.warn('error getting running job count', exc_info=True)
-                    continue
-                info['glideins_launched'][partition] = 0
-                limit = min(config_cluster["limit_per_submit"],
-                            config_cluster["max_total_jobs"] - info['glideins_running'][partition],
-                            max(config_cluster.get("max_idle_jobs", 1000) - idle, 0))
-                # Prioitize job submission. By default, prioritize submission of gpu and high memory jobs.
-                state = sort_states(state, config_cluster["prioritize_jobs"])
-                for s in state:
-                    if sched_type == "pbs":
-                        s["memory"] = s["memory"]*1024/1000
-                    if limit <= 0:
-                        logger.info('reached limit')
-                        break
-                    # Skipping CPU jobs for gpu only clusters
-                    if ('gpu_only' in config_cluster and config_cluster['gpu_only']
-                        and s["gpus"] == 0):
-                        continue
-                    # skipping GPU jobs for cpu only clusters
-                    if ('cpu_only' in config_cluster and config_cluster['cpu_only']
-                        and s["gpus"] != 0):
-                        continue
-                    # skipping jobs over cluster resource limits
-                    if config_cluster['whole_node']:
-                        prefix = 'whole_node_%s'
-                    else:
-                        prefix = 'max_%s_per_job'
-                    for resource in ('cpus','gpus','memory','disk'):
-                        cfg_name = prefix%resource
-                        if (cfg_name in config_cluster
-                            and s[resource] > config_cluster[cfg_name]):
-                            break
-                        cfg_name = 'min_%s_per_job'%resource
-                        if (cfg_name in config_cluster
-                            and s[resource] < config_cluster[cfg_name]):
-                            break
-                    else:
-                        if "count" in s and s["count"] > limit:
-                            s["count"] = limit
-                        scheduler.submit(s, partition)
-                        num = 1 if "count" not in s else s["count"]
-                        limit -= num
-                        info['glideins_launched'][partition] += num
-                metrics_bundle.update_metric('glideins_launched', partition,
-                                             info['glideins_launched'][partition])
-                logger.info('launched %d glideins on %s', info['glideins_launched'][partition], partition)
+                tasks.append(partial(run_partition, partition, state, config_dict,
+                                     scheduler, sched_type, info, metrics_bundle, throttle,
+                                     snapshot))
         else:
             logger.info('no state, nothing to do')
 
-        metrics_bundle.update_metrics(metrics.get_mma_idle_time())
-        metrics.send(metrics_bundle)
+        def idle_time():
+            with throttle.query:
+                if snapshot is not None:
+                    return snapshot.get_mma_idle_time()
+                return metrics.get_mma_idle_time()
+        tasks.append(idle_time)
+        metrics_bundle.update_metrics(run_concurrently(tasks)[-1])
 
         if 'delay' not in config_glidein or int(config_glidein['delay']) < 1:
+            metrics.send(metrics_bundle)
             break
-        time.sleep(config_glidein['delay'])
+        if time.time() - cycle_start > config_glidein['delay']:
+            logger.warn('cycle took %d seconds, longer than the delay',
+                        time.time() - cycle_start)
+        if 'ssh_state' in config_glidein and config_glidein['ssh_state']:
+            metrics.send(metrics_bundle)
+            time.sleep(max(next_cycle(cadence_start, config_glidein['delay']) - time.time(), 0))
+            continue
+        if config_glidein.get('event_driven', False):
+            end = next_cycle(cycle_start, config_glidein['delay'])
+        else:
+            end = next_cycle(cadence_start, config_glidein['delay'])
+        if end - time.time() > monitoring_batch_window:
+            # the server uses the idle glideins for the demand, so it
+            # should not wait a whole cycle for them
+            metrics.send(metrics_bundle)
+        else:
+            # save a round trip by batching it with the next state request
+            pending_metrics = metrics_bundle.get_bundle()
+        if config_glidein.get('event_driven', False):
+            # start the next cycle as soon as the demand changes,
+            # but no sooner than min_delay and no later than delay
+            # after this one started
+            min_delay = min(config_glidein.get('min_delay', 30), config_glidein['delay'])
+            time.sleep(max(cycle_start + min_delay - time.time(), 0))
+            try:
+                if state_sync.generation is None:
+                    raise Exception('server does not support state generations')
+                wait_for_state(config_glidein['address'], state_sync.generation,
+                               state_sync.epoch, max(end - time.time(), 0))
+            except Exception:
+                logger.info('error waiting for state change', exc_info=True)
+                time.sleep(max(end - time.time(), 0))
+        else:
+            time.sleep(max(end - time.time(), 0))
+    job_ids = None
+    if snapshot is not None:
+        if sum(info['glideins_launched'].values()):
+            # the snapshot is from before the submits
+            snapshot.invalidate()
+        job_ids = snapshot.job_ids()
     for partition in config_dict['Cluster'].get('partitions', ['Cluster']):
         config_cluster = config_dict[partition]
         if "cleanup" in config_cluster and config_cluster["cleanup"]:
-            scheduler.cleanup(config_cluster["running_cmd"], config_cluster["dir_cleanup"])
+            scheduler.cleanup(config_cluster.get("running_cmd"), config_cluster["dir_cleanup"],
+                              job_ids=job_ids)
 
 
 if __name__ == '__main__':
@@ -5,10 +5,17 @@ import logging
 import threading
 try:
     from urllib.request import Request,urlopen
+    from urllib.error import HTTPError
+    from urllib.parse import urljoin, urlencode
 except ImportError:
-    from urllib2 import Request,urlopen
+    from urllib2 import Request,urlopen,HTTPError
+    from urlparse import urljoin
+    from urllib import urlencode
 import ast
+import uuid
 import datetime
+import gzip
+from io import BytesIO
 
 from pyglidein.util import json_encode, json_decode
 
@@ -45,8 +52,47 @@ class Client(object):
             raise Exception('Cannot use RPC for private methods')
 
         # translate request to json
-        body = json_encode({'jsonrpc': '2.0', 'method': methodname,
-                            'params': kwargs, 'id': Client.newid()})
+        data = self.send({'jsonrpc': '2.0', 'method': methodname,
+                          'params': kwargs, 'id': Client.newid()})
+        return self.result(data)
+
+    def batch(self, calls):
+        """
+        Send several requests to the RPC Server in one round trip.
+
+        Args:
+            calls: list of (methodname, kwargs)
+
+        Returns:
+            list: the result of each call, in order. A call that failed
+                  gets an Exception instead of its result.
+        """
+        requests = []
+        for methodname, kwargs in calls:
+            if methodname[0] == '_':
+                logger.warning('cannot use RPC for private methods')
+                raise Exception('Cannot use RPC for private methods')
+            requests.append({'jsonrpc': '2.0', 'method': methodname,
+                             'params': kwargs, 'id': Client.newid()})
+        data = self.send(requests)
+        if not isinstance(data, list):
+            # the whole batch was rejected
+            self.result(data)
+            raise Exception('Error: batch response is not a list')
+        responses = dict((d.get('id'), d) for d in data)
+        ret = []
+        for r in requests:
+            try:
+                if r['id'] not in responses:
+                    raise Exception('Error: no response for %r'%r['method'])
+                ret.append(self.result(responses[r['id']]))
+            except Exception as e:
+                ret.append(e)
+        return ret
+
+    def send(self, request):
+        """Send a jsonrpc request object (or batch) and return the decoded response"""
+        body = json_encode(request)
 
         body = body.encode()
 
@@ -63,7 +109,7 @@ class Client(object):
         # translate response from json
         try:
             cb_data = response.read()
-            data = json_decode(cb_data)
+            return json_decode(cb_data)
         except Exception:
             try:
                 logger.info('json data: %r', cb_data)
@@ -71,6 +117,9 @@ class Client(object):
                 pass
             raise
 
+    @staticmethod
+    def result(data):
+        """Get the result out of a jsonrpc response, raising on errors"""
         if 'error' in data:
             try:
                 raise Exception('Error %r: %r    %r'%data['error'])
@@ -81,14 +130,170 @@ class Client(object):
         else:
             return None
 
-def get_state(address):
-    """Getting the server state directly from remote queue"""
+# address -> last state response, for conditional requests
+state_cache = {}
+
+def get_state_cached(address, timeout=60.0):
+    """
+    Get the pre-serialized state from the server's /state url.
+
+    Sends the ETag of the previous response, so an unchanged state
+    is not transferred again.
+
+    Args:
+        address: jsonrpc address of the server
+        timeout: request timeout
+
+    Returns:
+        dict: with the state `body` (json), `etag` and `generation`,
+              or None if the server does not support it
+    """
+    url = urljoin(address, 'state')
+    cached = state_cache.get(address)
+    headers = {'Accept-Encoding': 'gzip'}
+    if cached:
+        headers['If-None-Match'] = cached['etag']
+    try:
+        response = urlopen(Request(url, headers=headers), timeout=timeout)
+    except HTTPError as e:
+        if e.code == 304 and cached:
+            return cached
+        raise
+    if response.info().get('X-State-Generation') is None:
+        # older server without a /state url
+        return None
+    body = response.read()
+    if response.info().get('Content-Encoding') == 'gzip':
+        body = gzip.GzipFile(fileobj=BytesIO(body)).read()
+    cached = {'body': body.decode('utf-8'),
+              'etag': response.info().get('ETag'),
+              'generation': int(response.info().get('X-State-Generation'))}
+    state_cache[address] = cached
+    return cached
+
+def get_state(address, filters=None):
+    """
+    Getting the server state directly from remote queue
+
+    Args:
+        address: jsonrpc address of the server
+        filters: optional server-side filters, only supported with jsonrpc
+    """
+    # None marks an older server without a /state url
+    if not filters and state_cache.get(address, {}) is not None:
+        try:
+            cached = get_state_cached(address)
+            if cached is not None:
+                # decode every time, callers modify the state
+                return json_decode(cached['body'])
+            state_cache[address] = None
+        except Exception:
+            logger.info('error getting cached state, using jsonrpc', exc_info=True)
     c = Client(address=address)
     try:
-        return c.request('get_state', {})
+        return c.request('get_state', filters or {})
     except Exception:
         logger.warn('error getting state', exc_info=True)
 
+class StateSync(object):
+    """
+    Local copy of the server state, kept up to date with get_state_delta.
+
+    Only the rows that changed since the last call are transferred.
+    """
+    # fields of a row that are values rather than part of its identity
+    value_fields = ('count', 'raw_count', 'total_count')
+
+    def __init__(self, address, filters=None, uuid=None):
+        """
+        Args:
+            address: jsonrpc address of the server
+            filters: only sync rows matching these server-side filters
+            uuid: client uuid, for servers splitting the state between clients
+        """
+        self.address = address
+        self.filters = filters
+        self.uuid = uuid
+        self.epoch = None
+        self.generation = None
+        self.age = None
+        self.rows = {}
+
+    def apply(self, delta):
+        """Apply a get_state_delta response to the local copy"""
+        if delta['full']:
+            self.rows = {}
+            changed = delta['state']
+        else:
+            changed = delta['changed']
+            for row in delta['removed']:
+                self.rows.pop(self.row_key(row), None)
+        for row in changed:
+            self.rows[self.row_key(row)] = row
+        self.epoch = delta['epoch']
+        self.generation = delta['generation']
+        self.age = delta.get('age')
+
+    @classmethod
+    def row_key(cls, row):
+        return tuple(sorted((k, v) for k, v in row.items() if k not in cls.value_fields))
+
+    def get_state(self, metrics=None):
+        """
+        Get the server state.
+
+        Returns copies of the rows, as callers modify the state. Falls back
+        to separate get_state and monitoring calls for older servers.
+
+        Args:
+            metrics: optional monitoring bundle, sent in the same request
+        """
+        c = Client(address=self.address)
+        params = {'since_generation': self.generation,
+                  'epoch': self.epoch, 'filters': self.filters}
+        if self.uuid:
+            params['uuid'] = self.uuid
+        call = ('get_state_delta', params)
+        try:
+            if metrics is None:
+                delta = c.request(*call)
+            else:
+                ret, delta = c.batch([('monitoring', metrics), call])
+                metrics = None
+                if isinstance(ret, Exception):
+                    logger.warn('error sending monitoring: %r', ret)
+                if isinstance(delta, Exception):
+                    raise delta
+            self.apply(delta)
+        except Exception:
+            logger.info('error getting state delta, using get_state', exc_info=True)
+            self.generation = None
+            self.age = None
+            if metrics is not None:
+                monitoring(self.address, metrics)
+            return get_state(self.address, self.filters)
+        return [dict(row) for row in self.rows.values()]
+
+def wait_for_state(address, generation, epoch, timeout):
+    """
+    Wait for the server state to change, with a long-poll request.
+
+    Args:
+        address: jsonrpc address of the server
+        generation: state generation the client has
+        epoch: server epoch the generation belongs to
+        timeout: max time to wait, in seconds
+
+    Returns:
+        bool: True if the state changed, False on timeout
+    """
+    args = {'generation': generation or 0, 'timeout': int(timeout)}
+    if epoch is not None:
+        args['epoch'] = epoch
+    url = urljoin(address, 'wait') + '?' + urlencode(args)
+    response = urlopen(Request(url), timeout=timeout+60)
+    return json_decode(response.read())['changed']
+
 def monitoring(address,info=None):
     """Sending monitoring information back"""
     if info is None:
@@ -123,6 +328,37 @@ def config_options_dict(config):
     return config_dict
 
 
+minio_clients = {}
+minio_lock = threading.Lock()
+
+
+def get_minio_client(config, secrets):
+    """Get the Minio S3 client for the StartdLogging endpoint, created once.
+
+    Args:
+        config: Pyglidein cluster config dictionary
+        secrets: Pyglidein cluster secrets dictionary
+
+    Returns:
+        Minio: S3 client
+
+    """
+    from minio import Minio
+
+    config_startd_logging = config['StartdLogging']
+    secrets_startd_logging = secrets['StartdLogging']
+
+    key = (config_startd_logging['url'], secrets_startd_logging['access_key'])
+    with minio_lock:
+        if key not in minio_clients:
+            minio_clients[key] = Minio(config_startd_logging['url'],
+                                       access_key=secrets_startd_logging['access_key'],
+                                       secret_key=secrets_startd_logging['secret_key'],
+                                       secure=True
+                                       )
+        return minio_clients[key]
+
+
 def get_presigned_put_url(filename, config, secrets):
     """Generate a presigned put URL using the Minio S3 client.
 
@@ -135,23 +371,15 @@ def get_presigned_put_url(filename, config, secrets):
         string: Presigned Put URL
 
     """
-    from minio import Minio
     try:
         from minio.error import ResponseError
     except ImportError:
         from minio.error import S3Error as ResponseError
 
-    config_startd_logging = config['StartdLogging']
-    secrets_startd_logging = secrets['StartdLogging']
-
-    client = Minio(config_startd_logging['url'],
-                   access_key=secrets_startd_logging['access_key'],
-                   secret_key=secrets_startd_logging['secret_key'],
-                   secure=True
-                   )
+    client = get_minio_client(config, secrets)
 
     try:
-        return client.presigned_put_object(config_startd_logging['bucket'],
+        return client.presigned_put_object(config['StartdLogging']['bucket'],
                                            filename,
                                            datetime.timedelta(days=1))
     except ResponseError as err:
@@ -170,23 +398,61 @@ def get_presigned_get_url(filename, config, secrets):
         string: Presigned Get URL
 
     """
-    from minio import Minio
     try:
         from minio.error import ResponseError
     except ImportError:
         from minio.error import S3Error as ResponseError
-    
-    config_startd_logging = config['StartdLogging']
-    secrets_startd_logging = secrets['StartdLogging']
 
-    client = Minio(config_startd_logging['url'],
-                   access_key=secrets_startd_logging['access_key'],
-                   secret_key=secrets_startd_logging['secret_key'],
-                   secure=True
-                   )
+    client = get_minio_client(config, secrets)
 
     try:
-        return client.presigned_get_object(config_startd_logging['bucket'],
+        return client.presigned_get_object(config['StartdLogging']['bucket'],
                                            filename)
     except ResponseError as err:
         print(err)
+
+
+class PresignedURLProvider(object):
+    """Presigned URLs for the startd logs of glideins.
+
+    URLs are minted with one S3 client, which signs them locally, so
+    they are minted as glideins are submitted: one (put url, get url)
+    pair, for one log file, per glidein.
+    """
+
+    def __init__(self, config, secrets):
+        """
+        Args:
+            config: Pyglidein cluster config dictionary
+            secrets: Pyglidein cluster secrets dictionary
+        """
+        self.config = config
+        self.secrets = secrets
+
+    def mint(self, num):
+        """Mint URLs for `num` log files"""
+        client = get_minio_client(self.config, self.secrets)
+        bucket = self.config['StartdLogging']['bucket']
+        ret = []
+        for _ in range(num):
+            filename = '{}_{}.tar.gz'.format(self.config['Glidein']['site'], uuid.uuid4())
+            ret.append((client.presigned_put_object(bucket, filename,
+                                                    datetime.timedelta(days=1)),
+                        client.presigned_get_object(bucket, filename)))
+        return ret
+
+    def get(self, num=1):
+        """Get URLs for the logs of `num` glideins.
+
+        Args:
+            num: number of glideins
+
+        Returns:
+            list: (put url, get url) per glidein, empty if minting failed
+
+        """
+        try:
+            return self.mint(num)
+        except Exception:
+            logger.error('cannot mint presigned urls', exc_info=True)
+            return []
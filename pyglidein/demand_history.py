@@ -0,0 +1,273 @@
+"""
+Time series of the demand, and short term forecasts from it.
+
+Every refreshed state is recorded as a sample of the number of idle jobs
+in each bucket (a state row without its counts). Samples are kept in
+tiers of ring buffers: the first tier at a fine resolution for recent
+data, and coarser tiers averaging samples over longer periods for older
+data. Each tier has one array of slot times and one array of values per
+bucket, all of doubles.
+
+Forecasts add a linear trend, fitted to the recent samples, and a daily
+seasonal component, once there are a few days of history.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import base64
+import logging
+from array import array
+
+logger = logging.getLogger('server')
+
+day = 86400
+
+
+def encode_array(data):
+    return base64.b64encode(data.tobytes()).decode('ascii')
+
+
+def decode_array(dump):
+    ret = array('d')
+    ret.frombytes(base64.b64decode(dump))
+    return ret
+
+
+class DemandTier(object):
+    """
+    Ring buffer of the average demand per bucket, at one resolution.
+
+    A slot holds the sum of the samples recorded within it, and how many
+    there were, so values are averages over the slot.
+    """
+
+    def __init__(self, resolution, size):
+        """
+        Args:
+            resolution: seconds per slot
+            size: number of slots
+        """
+        self.resolution = resolution
+        self.size = size
+        # start time of each slot, 0 if empty
+        self.times = array('d', [0.]) * size
+        self.samples = array('d', [0.]) * size
+        # bucket -> sum of the samples in each slot
+        self.buckets = {}
+
+    def record(self, timestamp, values):
+        """
+        Add a sample.
+
+        Args:
+            timestamp: when the sample was taken
+            values: dict of bucket -> number of jobs
+
+        Returns:
+            bool: True if the sample started a new slot
+        """
+        start = timestamp // self.resolution * self.resolution
+        i = int(timestamp // self.resolution) % self.size
+        new_slot = self.times[i] != start
+        if new_slot:
+            if self.times[i] > start:
+                # older than what the slot holds
+                return False
+            # clear this slot, and slots left over from before a gap
+            cutoff = start - self.size*self.resolution
+            for j in range(self.size):
+                if j == i or (self.samples[j] and self.times[j] <= cutoff):
+                    self.times[j] = 0
+                    self.samples[j] = 0
+                    for data in self.buckets.values():
+                        data[j] = 0
+            self.times[i] = start
+        self.samples[i] += 1
+        for bucket, value in values.items():
+            if bucket not in self.buckets:
+                self.buckets[bucket] = array('d', [0.]) * self.size
+            self.buckets[bucket][i] += value
+        return new_slot
+
+    def series(self, bucket, since=0):
+        """
+        Get the average demand of a bucket, oldest first.
+
+        Args:
+            bucket: the bucket
+            since: only include slots starting at or after this time
+
+        Returns:
+            list: (slot start time, average number of jobs)
+        """
+        data = self.buckets.get(bucket)
+        ret = []
+        for i in range(self.size):
+            if self.samples[i] and self.times[i] >= since:
+                value = data[i] / self.samples[i] if data is not None else 0.
+                ret.append((self.times[i], value))
+        ret.sort()
+        return ret
+
+    def drop_empty(self, keep=()):
+        """Drop buckets without demand, except those in `keep`"""
+        for bucket in list(self.buckets):
+            if bucket not in keep and not any(self.buckets[bucket]):
+                del self.buckets[bucket]
+
+    def dump(self):
+        """Get the tier as a json-serializable dict"""
+        return {'resolution': self.resolution, 'size': self.size,
+                'times': encode_array(self.times),
+                'samples': encode_array(self.samples),
+                'buckets': [[list(bucket), encode_array(data)]
+                            for bucket, data in self.buckets.items()]}
+
+    @classmethod
+    def restore(cls, dump):
+        """Create a tier from `dump` output"""
+        ret = cls(dump['resolution'], dump['size'])
+        ret.times = decode_array(dump['times'])
+        ret.samples = decode_array(dump['samples'])
+        for bucket, data in dump['buckets']:
+            ret.buckets[tuple(tuple(item) for item in bucket)] = decode_array(data)
+        return ret
+
+
+def fit_trend(series, now):
+    """
+    Fit a line to a series with least squares.
+
+    Args:
+        series: list of (time, value)
+        now: time to get the level at
+
+    Returns:
+        tuple: (level at `now`, slope per second)
+    """
+    if not series:
+        return 0., 0.
+    n = len(series)
+    mean_t = sum(t for t, v in series) / n
+    mean_v = sum(v for t, v in series) / n
+    var = sum((t - mean_t)**2 for t, v in series)
+    if n < 2 or not var:
+        return mean_v, 0.
+    slope = sum((t - mean_t)*(v - mean_v) for t, v in series) / var
+    return mean_v + slope*(now - mean_t), slope
+
+
+def daily_profile(series, resolution):
+    """
+    Get the average deviation from the mean by time of day.
+
+    Args:
+        series: list of (time, value), covering at least two days
+        resolution: seconds per slot of the profile
+
+    Returns:
+        dict: slot of the day -> deviation, or None with too little history
+    """
+    if not series or series[-1][0] - series[0][0] < 2*day - resolution:
+        return None
+    mean = sum(v for t, v in series) / len(series)
+    sums = {}
+    for t, v in series:
+        slot = int(t % day // resolution)
+        total, count = sums.get(slot, (0., 0))
+        sums[slot] = (total + v - mean, count + 1)
+    return dict((slot, total / count) for slot, (total, count) in sums.items())
+
+
+class DemandHistory(object):
+    """
+    Demand history of all buckets, with forecasts.
+
+    Buckets are tuples of (column, value) pairs, see server.state_row_key.
+    """
+
+    def __init__(self, tiers=((300, 288), (3600, 336)), trend_window=3600):
+        """
+        Args:
+            tiers: (resolution, size) of each tier, finest first
+            trend_window: seconds of recent history the trend is fitted to
+        """
+        self.tiers = [DemandTier(resolution, size) for resolution, size in tiers]
+        self.trend_window = trend_window
+        self.last = None
+
+    def record(self, timestamp, values):
+        """
+        Add a sample of the demand.
+
+        Args:
+            timestamp: when the demand was measured
+            values: dict of bucket -> number of jobs
+        """
+        if timestamp is None or timestamp == self.last:
+            return
+        self.last = timestamp
+        for tier in self.tiers:
+            if tier.record(timestamp, values):
+                tier.drop_empty(keep=values)
+
+    def buckets(self):
+        """Get all buckets with demand in the history"""
+        ret = set()
+        for tier in self.tiers:
+            ret.update(tier.buckets)
+        return ret
+
+    def seasonal_tier(self):
+        """Get the finest tier holding enough days for a daily profile"""
+        for tier in self.tiers:
+            if tier.resolution <= 3600 and tier.resolution*tier.size >= 2*day:
+                return tier
+        return None
+
+    def forecast(self, bucket, now, times):
+        """
+        Forecast the demand of a bucket.
+
+        Args:
+            bucket: the bucket
+            now: current time
+            times: times to forecast the demand at
+
+        Returns:
+            dict: `current` demand, `trend` (jobs per hour), `seasonal`
+                  (True if a daily profile is used) and `forecast` (the
+                  number of jobs at each of `times`)
+        """
+        profile = None
+        tier = self.seasonal_tier()
+        if tier is not None:
+            profile = daily_profile(tier.series(bucket), tier.resolution)
+
+        def seasonal(t):
+            if not profile:
+                return 0.
+            return profile.get(int(t % day // tier.resolution), 0.)
+        # the trend is fitted to the demand without its daily profile
+        fine = self.tiers[0]
+        recent = fine.series(bucket, since=now - self.trend_window - fine.resolution)
+        level, slope = fit_trend([(t, v - seasonal(t)) for t, v in recent], now)
+        forecast = [max(0., level + slope*(t - now) + seasonal(t)) for t in times]
+        return {'current': recent[-1][1] if recent else 0.,
+                'trend': slope*3600,
+                'seasonal': profile is not None,
+                'forecast': forecast}
+
+    def dump(self):
+        """Get the history as a json-serializable dict"""
+        return {'last': self.last, 'tiers': [tier.dump() for tier in self.tiers]}
+
+    def restore(self, dump):
+        """Load `dump` output, if it has the same tiers"""
+        tiers = [DemandTier.restore(tier) for tier in dump['tiers']]
+        if ([(t.resolution, t.size) for t in tiers] !=
+            [(t.resolution, t.size) for t in self.tiers]):
+            logger.info('demand history tiers changed, not restoring it')
+            return
+        self.tiers = tiers
+        self.last = dump['last']
@@ -1,48 +1,61 @@
 import logging
-import pickle
-import socket
-import struct
 import sys
 
+from pyglidein.metrics_sinks import sink_classes, get_datapoints, client_metrics_namespace
+
 
 class MetricsSenderClient(object):
+    """
+    Forwards client metrics to the sinks listed in `sinks` in the
+    `[metrics]` section of the server config (default: graphite).
+
+    Sending never blocks the IOLoop. See `pyglidein.metrics_sinks` for the
+    sinks and their options.
+    """
 
-    client_metrics_namespace = {
-        'glideins_launched': 'glideins.launched',
-        'glideins_running': 'glideins.running',
-        'glideins_idle': 'glideins.idle',
-        'avg_idle_time': 'glideins.avg_idle_time',
-        'min_idle_time': 'glideins.min_idle_time',
-        'max_idle_time': 'glideins.max_idle_time'
-    }
+    client_metrics_namespace = client_metrics_namespace
 
     def __init__(self, config):
 
         self.logger = logging.getLogger('server')
-        self.graphite_server = config.get('graphite_server', None)
-        if self.graphite_server is None:
-            self.logger.error('graphite_server not defined in configuration.')
-            sys.exit(1)
-        self.graphite_port = config.get('graphite_port', 2004)
-        self.namespace = config.get('namespace', 'pyglidein')
+        self.sinks = []
+        for name in str(config.get('sinks', 'graphite')).split(','):
+            name = name.strip()
+            if not name:
+                continue
+            if name not in sink_classes:
+                self.logger.error('unknown metrics sink %r in configuration.', name)
+                sys.exit(1)
+            self.sinks.append(sink_classes[name](config))
+
+    def get_sink(self, name):
+        """Get a configured sink by name, or None"""
+        for sink in self.sinks:
+            if sink.name == name:
+                return sink
+        return None
+
+    def queue_depth(self):
+        """Number of datapoints waiting to be sent, over all sinks"""
+        return sum(sink.queue_depth() for sink in self.sinks)
 
     def send(self, metrics_bundle):
-
-            payload = []
-            uuid = metrics_bundle.get_uuid()
-            timestamp = metrics_bundle.get_timestamp()
-            metrics = metrics_bundle.get_metrics()
-            for metric in metrics:
-                for partition in metrics[metric]:
-                    path = str('.'.join([self.namespace, uuid, partition,
-                                        MetricsSenderClient.client_metrics_namespace[metric]]))
-                    payload.append((path, (timestamp, metrics[metric][partition])))
-            self.logger.debug(payload)
-            payload = pickle.dumps(payload, protocol=2)
-            header = struct.pack("!L", len(payload))
-            message = header + payload
-
-            sock = socket.socket()
-            sock.connect((self.graphite_server, self.graphite_port))
-            sock.sendall(message)
-            sock.close()
+        """
+        Queue the metrics of a client for all sinks.
+
+        Args:
+            metrics_bundle: ClientMetricsBundle
+        """
+        datapoints = get_datapoints(metrics_bundle)
+        self.logger.debug(datapoints)
+        for sink in self.sinks:
+            sink.put(datapoints)
+
+    def start(self):
+        """Start the sinks on the current IOLoop"""
+        for sink in self.sinks:
+            sink.start()
+
+    def stop(self):
+        for sink in self.sinks:
+            sink.stop()
@@ -0,0 +1,492 @@
+"""
+Sinks for forwarding client metrics to a monitoring system.
+
+A datapoint is a tuple (uuid, partition, metric, timestamp, value), with
+`metric` one of the keys of `client_metrics_namespace`. Sinks never block
+the IOLoop: queued sinks buffer datapoints in a bounded queue which is
+drained in batches by a coroutine, backing off when the endpoint fails.
+
+Available sinks:
+
+* graphite: Graphite pickle protocol over a persistent TCP connection
+* statsd: StatsD gauges over UDP
+* influxdb: InfluxDB line protocol over HTTP
+* prometheus: latest value of each metric, for scraping
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import re
+import sys
+import time
+import errno
+import pickle
+import socket
+import struct
+import logging
+from collections import deque
+
+import tornado.gen
+import tornado.web
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+
+logger = logging.getLogger('server')
+
+client_metrics_namespace = {
+    'glideins_launched': 'glideins.launched',
+    'glideins_running': 'glideins.running',
+    'glideins_idle': 'glideins.idle',
+    'avg_idle_time': 'glideins.avg_idle_time',
+    'min_idle_time': 'glideins.min_idle_time',
+    'max_idle_time': 'glideins.max_idle_time'
+}
+
+
+def get_datapoints(metrics_bundle):
+    """
+    Flatten a metrics bundle into datapoints.
+
+    Args:
+        metrics_bundle: ClientMetricsBundle
+
+    Returns:
+        list: (uuid, partition, metric, timestamp, value) tuples
+    """
+    ret = []
+    uuid = metrics_bundle.get_uuid()
+    timestamp = metrics_bundle.get_timestamp()
+    metrics = metrics_bundle.get_metrics()
+    for metric in metrics:
+        for partition in metrics[metric]:
+            ret.append((uuid, partition, metric, timestamp, metrics[metric][partition]))
+    return ret
+
+
+class MetricsSink(object):
+    """Base class for metrics sinks"""
+    name = None
+
+    def __init__(self, config):
+        """
+        Args:
+            config: the `[metrics]` config dict
+        """
+        self.config = config
+        self.namespace = config.get('namespace', 'pyglidein')
+
+    def option(self, key, default=None):
+        """Get a config option, preferring the sink specific `<sink>_<key>`"""
+        return self.config.get(self.name+'_'+key, self.config.get(key, default))
+
+    def path(self, datapoint):
+        """Dotted metric path of a datapoint"""
+        uuid, partition, metric = datapoint[:3]
+        return str('.'.join([self.namespace, uuid, partition,
+                             client_metrics_namespace[metric]]))
+
+    def put(self, datapoints):
+        raise NotImplementedError()
+
+    def queue_depth(self):
+        return 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class QueuedSink(MetricsSink):
+    """
+    Sink with a bounded queue, drained in batches by a coroutine.
+
+    Subclasses implement the `write` coroutine, which sends one batch and
+    raises on failure. Failed batches are put back in the queue and the
+    next attempt is delayed with exponential backoff.
+
+    When the queue is full, datapoints are appended to a spill file if one
+    is configured, and replayed before the queue on the next flush. Batches
+    are removed from the spill file once sent, so a failed replay resumes
+    after the last sent batch. Without a spill file they are dropped.
+    """
+
+    def __init__(self, config):
+        super(QueuedSink, self).__init__(config)
+        self.queue_size = self.option('queue_size', 10000)
+        self.batch_size = self.option('batch_size', 500)
+        self.flush_interval = self.option('flush_interval', 1)
+        self.max_backoff = self.option('max_backoff', 300)
+        self.spill_file = self.config.get(self.name+'_spill_file', None)
+        self.spill_max_size = self.option('spill_max_size', 100*2**20)
+
+        self.queue = deque()
+        self.backoff = 0
+        self.next_attempt = 0
+        self.dropped = 0
+        self.running = False
+
+    def put(self, datapoints):
+        """Queue datapoints for sending"""
+        if len(self.queue) + len(datapoints) > self.queue_size:
+            self.spill(datapoints)
+        else:
+            self.queue.extend(datapoints)
+
+    def queue_depth(self):
+        return len(self.queue)
+
+    def spill(self, datapoints):
+        """Write datapoints that do not fit in the queue to the spill file"""
+        if self.spill_file:
+            try:
+                size = os.path.getsize(self.spill_file)
+            except OSError:
+                size = 0
+            if size < self.spill_max_size:
+                try:
+                    with open(self.spill_file, 'ab') as f:
+                        data = pickle.dumps(datapoints, protocol=2)
+                        f.write(struct.pack('!L', len(data)) + data)
+                    return
+                except Exception:
+                    logger.warn('error writing %s spill file', self.name, exc_info=True)
+        if not self.dropped:
+            logger.warn('%s metrics queue full, dropping datapoints', self.name)
+        self.dropped += len(datapoints)
+
+    def has_spilled(self):
+        return bool(self.spill_file) and os.path.exists(self.spill_file)
+
+    def read_spilled(self):
+        """
+        Get the spilled batches.
+
+        Returns:
+            list: (batch, offset) tuples, with the offset of the end of
+            each batch in the spill file
+        """
+        with open(self.spill_file, 'rb') as f:
+            data = f.read()
+        ret = []
+        offset = 0
+        while offset + 4 <= len(data):
+            size = struct.unpack('!L', data[offset:offset+4])[0]
+            if offset + 4 + size > len(data):
+                break
+            offset += 4 + size
+            ret.append((pickle.loads(data[offset-size:offset]), offset))
+        return ret
+
+    def truncate_spilled(self, offset):
+        """
+        Remove the first `offset` bytes of the spill file.
+
+        Batches spilled while the file was being replayed are kept.
+        """
+        with open(self.spill_file, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        if data:
+            tmp = self.spill_file + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, self.spill_file)
+        else:
+            os.remove(self.spill_file)
+
+    def start(self):
+        """Start draining the queue on the current IOLoop"""
+        if not self.running:
+            self.running = True
+            IOLoop.current().spawn_callback(self.run)
+
+    def stop(self):
+        self.running = False
+
+    @tornado.gen.coroutine
+    def run(self):
+        while self.running:
+            try:
+                yield self.flush()
+            except Exception:
+                logger.warn('error sending %s metrics', self.name, exc_info=True)
+            yield tornado.gen.sleep(self.flush_interval)
+
+    @tornado.gen.coroutine
+    def write(self, batch):
+        """Send a batch of datapoints"""
+        raise NotImplementedError()
+
+    @tornado.gen.coroutine
+    def flush(self):
+        """Send the spilled and queued datapoints"""
+        if not self.queue and not self.has_spilled():
+            return
+        if time.time() < self.next_attempt:
+            return
+        try:
+            if self.has_spilled():
+                sent = 0
+                try:
+                    for batch, offset in self.read_spilled():
+                        yield self.write(batch)
+                        sent = offset
+                finally:
+                    if sent:
+                        self.truncate_spilled(sent)
+            while self.queue:
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                try:
+                    yield self.write(batch)
+                except Exception:
+                    self.queue.extendleft(reversed(batch))
+                    raise
+        except Exception as e:
+            self.backoff = min(max(1, self.backoff*2), self.max_backoff)
+            self.next_attempt = time.time() + self.backoff
+            logger.warn('error sending %s metrics, retry in %d seconds: %s',
+                        self.name, self.backoff, e)
+        else:
+            self.backoff = 0
+            if self.dropped:
+                logger.warn('dropped %d %s metrics datapoints', self.dropped, self.name)
+                self.dropped = 0
+
+
+class GraphiteSink(QueuedSink):
+    """
+    Graphite pickle protocol over a persistent TCP connection.
+
+    Config: graphite_server, graphite_port (2004), connect_timeout (10)
+    """
+    name = 'graphite'
+
+    def __init__(self, config):
+        super(GraphiteSink, self).__init__(config)
+        self.server = config.get('graphite_server', None)
+        if self.server is None:
+            logger.error('graphite_server not defined in configuration.')
+            sys.exit(1)
+        self.port = config.get('graphite_port', 2004)
+        self.connect_timeout = self.option('connect_timeout', 10)
+        if not self.spill_file:
+            self.spill_file = config.get('spill_file', None)
+        self.stream = None
+
+    def frame(self, batch):
+        """Encode a batch as one pickle protocol message"""
+        payload = [(self.path(d), (d[3], d[4])) for d in batch]
+        payload = pickle.dumps(payload, protocol=2)
+        return struct.pack("!L", len(payload)) + payload
+
+    def stop(self):
+        super(GraphiteSink, self).stop()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    @tornado.gen.coroutine
+    def write(self, batch):
+        if self.stream is None or self.stream.closed():
+            self.stream = yield TCPClient().connect(self.server, self.port,
+                                                    timeout=self.connect_timeout)
+        try:
+            yield self.stream.write(self.frame(batch))
+        except StreamClosedError:
+            self.stream = None
+            raise
+
+
+class StatsdSink(QueuedSink):
+    """
+    StatsD gauges over UDP.
+
+    Gauges are packed into datagrams of at most statsd_max_packet bytes.
+
+    Config: statsd_server, statsd_port (8125), statsd_max_packet (1432)
+    """
+    name = 'statsd'
+
+    def __init__(self, config):
+        super(StatsdSink, self).__init__(config)
+        self.server = config.get('statsd_server', None)
+        if self.server is None:
+            logger.error('statsd_server not defined in configuration.')
+            sys.exit(1)
+        self.port = config.get('statsd_port', 8125)
+        self.max_packet = config.get('statsd_max_packet', 1432)
+        self.sock = None
+
+    def packets(self, batch):
+        """Encode a batch as datagrams"""
+        ret = []
+        packet = b''
+        for d in batch:
+            line = '{}:{}|g'.format(self.path(d), d[4]).encode('utf-8')
+            if packet and len(packet) + 1 + len(line) > self.max_packet:
+                ret.append(packet)
+                packet = b''
+            packet = packet + b'\n' + line if packet else line
+        if packet:
+            ret.append(packet)
+        return ret
+
+    def stop(self):
+        super(StatsdSink, self).stop()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    @tornado.gen.coroutine
+    def write(self, batch):
+        if self.sock is None:
+            addr = socket.getaddrinfo(self.server, self.port, 0, socket.SOCK_DGRAM)[0]
+            self.sock = socket.socket(addr[0], socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+            self.sock.connect(addr[4])
+        for packet in self.packets(batch):
+            try:
+                self.sock.send(packet)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.sock.close()
+                    self.sock = None
+                    raise
+                # send buffer full, which statsd is lossy about anyway
+                self.dropped += packet.count(b'\n') + 1
+
+
+class InfluxdbSink(QueuedSink):
+    """
+    InfluxDB line protocol over HTTP.
+
+    Each client partition becomes one point of `influxdb_measurement`,
+    tagged with uuid and partition, with a field for each metric.
+
+    Config: influxdb_url (the full write url, e.g.
+    http://influxdb:8086/write?db=pyglidein&precision=s), influxdb_token,
+    influxdb_measurement (pyglidein), request_timeout (10)
+    """
+    name = 'influxdb'
+
+    def __init__(self, config):
+        super(InfluxdbSink, self).__init__(config)
+        self.url = config.get('influxdb_url', None)
+        if self.url is None:
+            logger.error('influxdb_url not defined in configuration.')
+            sys.exit(1)
+        self.token = config.get('influxdb_token', None)
+        self.measurement = config.get('influxdb_measurement', 'pyglidein')
+        self.request_timeout = self.option('request_timeout', 10)
+
+    @staticmethod
+    def escape(value):
+        return re.sub(r'([ ,=\\])', r'\\\1', str(value))
+
+    def lines(self, batch):
+        """Encode a batch in line protocol"""
+        points = {}
+        for uuid, partition, metric, timestamp, value in batch:
+            key = (uuid, partition, int(timestamp))
+            points.setdefault(key, []).append((metric, value))
+        ret = []
+        for (uuid, partition, timestamp), fields in sorted(points.items()):
+            ret.append('{},uuid={},partition={} {} {}'.format(
+                self.escape(self.measurement), self.escape(uuid), self.escape(partition),
+                ','.join('{}={}i'.format(m, int(v)) for m, v in fields), timestamp))
+        return '\n'.join(ret)
+
+    @tornado.gen.coroutine
+    def write(self, batch):
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.token:
+            headers['Authorization'] = 'Token ' + self.token
+        request = HTTPRequest(self.url, method='POST', headers=headers,
+                              body=self.lines(batch),
+                              request_timeout=self.request_timeout)
+        yield AsyncHTTPClient().fetch(request)
+
+
+class PrometheusHandler(tornado.web.RequestHandler):
+    def initialize(self, sink):
+        self.sink = sink
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.sink.exposition())
+
+
+class PrometheusSink(MetricsSink):
+    """
+    Latest value of each client metric, in the Prometheus text format.
+
+    Clients that have not reported for prometheus_ttl seconds are dropped.
+    With prometheus_port set, the metrics are served on their own port,
+    otherwise only through the server.
+
+    Config: prometheus_port, prometheus_address, prometheus_prefix
+    (namespace with dots as underscores, plus "_client"), prometheus_ttl
+    (86400)
+    """
+    name = 'prometheus'
+
+    def __init__(self, config):
+        super(PrometheusSink, self).__init__(config)
+        self.port = config.get('prometheus_port', None)
+        self.address = config.get('prometheus_address', '')
+        self.prefix = config.get('prometheus_prefix',
+                                 re.sub(r'\W', '_', self.namespace) + '_client')
+        self.ttl = config.get('prometheus_ttl', 86400)
+        # (metric, uuid, partition) -> (timestamp, value, last seen)
+        self.values = {}
+        self.http_server = None
+
+    def put(self, datapoints):
+        now = time.time()
+        for uuid, partition, metric, timestamp, value in datapoints:
+            self.values[(metric, uuid, partition)] = (timestamp, value, now)
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+    def exposition(self):
+        """Get the metrics in the Prometheus text format"""
+        cutoff = time.time() - self.ttl
+        for key in [k for k, v in self.values.items() if v[2] < cutoff]:
+            del self.values[key]
+        ret = []
+        last_metric = None
+        for (metric, uuid, partition), (_, value, _) in sorted(self.values.items()):
+            if metric != last_metric:
+                name = self.prefix + '_' + metric
+                ret.append('# TYPE {} gauge'.format(name))
+                last_metric = metric
+            ret.append('{}{{uuid="{}",partition="{}"}} {}'.format(
+                name, self.escape(uuid), self.escape(partition), value))
+        return '\n'.join(ret) + '\n' if ret else ''
+
+    def start(self):
+        if self.port and self.http_server is None:
+            app = tornado.web.Application([(r"/metrics", PrometheusHandler, {'sink': self})])
+            self.http_server = HTTPServer(app)
+            self.http_server.listen(self.port, address=self.address)
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.stop()
+            self.http_server = None
+
+
+sink_classes = {
+    'graphite': GraphiteSink,
+    'statsd': StatsdSink,
+    'influxdb': InfluxdbSink,
+    'prometheus': PrometheusSink,
+}
@@ -0,0 +1,209 @@
+"""
+Bounded store for client monitoring.
+
+Clients come and go, so entries expire after a TTL and the number of
+clients is capped. Each client also keeps a fixed-size ring buffer of its
+recent samples, stored in a flat array, for showing trends.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import base64
+import logging
+from array import array
+from collections import OrderedDict
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from pyglidein.client_metrics import ClientMetricsBundle
+
+logger = logging.getLogger('server')
+
+
+class MetricsRing(object):
+    """
+    Ring buffer of monitoring samples for one client.
+
+    A sample is the timestamp followed by the total of each metric, all
+    stored in one array of doubles.
+    """
+    metrics = sorted(ClientMetricsBundle.whitelist)
+
+    def __init__(self, size):
+        self.size = size
+        self.width = 1 + len(self.metrics)
+        self.data = array('d', [0.]) * (size * self.width)
+        self.next = 0
+        self.count = 0
+
+    def append(self, info):
+        """
+        Add a sample.
+
+        Args:
+            info: v1 monitoring bundle (timestamp and metric totals)
+        """
+        offset = self.next * self.width
+        self.data[offset] = info.get('timestamp', 0)
+        for i, m in enumerate(self.metrics):
+            try:
+                self.data[offset+1+i] = info.get(m, 0)
+            except TypeError:
+                self.data[offset+1+i] = 0
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def samples(self):
+        """Get the samples, oldest first, as v1 monitoring bundles"""
+        ret = []
+        start = (self.next - self.count) % self.size
+        for n in range(self.count):
+            offset = ((start + n) % self.size) * self.width
+            sample = {'timestamp': int(self.data[offset])}
+            for i, m in enumerate(self.metrics):
+                sample[m] = int(self.data[offset+1+i])
+            ret.append(sample)
+        return ret
+
+    def dump(self):
+        """Get the ring as a json-serializable dict"""
+        return {'data': base64.b64encode(self.data.tobytes()).decode('ascii'),
+                'next': self.next, 'count': self.count}
+
+    @classmethod
+    def restore(cls, size, dump):
+        """Create a ring from `dump` output"""
+        ret = cls(size)
+        data = array('d')
+        data.frombytes(base64.b64decode(dump['data']))
+        if len(data) == len(ret.data):
+            ret.data = data
+            ret.next = dump['next']
+            ret.count = dump['count']
+        return ret
+
+
+class MonitoringStore(MutableMapping):
+    """
+    Client uuid -> latest v1 monitoring bundle.
+
+    Entries expire `ttl` seconds after the client last reported, and the
+    clients that reported longest ago are dropped when there are more
+    than `max_clients`.
+    """
+
+    def __init__(self, ttl=86400, max_clients=10000, history=288):
+        """
+        Args:
+            ttl: seconds to keep a client after its last report
+            max_clients: max number of clients to keep
+            history: number of samples kept per client
+        """
+        self.ttl = ttl
+        self.max_clients = max_clients
+        self.history_size = history
+        # uuid -> (last seen, latest info, ring), least recently seen first
+        self.clients = OrderedDict()
+        # incremented on every change
+        self.version = 0
+
+    def __getitem__(self, uuid):
+        return self.clients[uuid][1]
+
+    def __setitem__(self, uuid, info):
+        self.set(uuid, info)
+
+    def set(self, uuid, info, last_seen=None):
+        """
+        Record a report from a client.
+
+        Args:
+            uuid: client uuid
+            info: v1 monitoring bundle
+            last_seen: when the client reported (default: now)
+        """
+        if last_seen is None:
+            last_seen = time.time()
+        if uuid in self.clients:
+            ring = self.clients.pop(uuid)[2]
+        else:
+            ring = MetricsRing(self.history_size)
+        ring.append(info)
+        self.clients[uuid] = (last_seen, info, ring)
+        self.version += 1
+        self.expire()
+        while len(self.clients) > self.max_clients:
+            old = next(iter(self.clients))
+            logger.info('too many monitoring clients, dropping %r', old)
+            del self.clients[old]
+
+    def __delitem__(self, uuid):
+        del self.clients[uuid]
+        self.version += 1
+
+    def __iter__(self):
+        return iter(self.clients)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __contains__(self, uuid):
+        return uuid in self.clients
+
+    def load(self, monitoring):
+        """
+        Add entries from a snapshot, aged by their own timestamp.
+
+        Args:
+            monitoring: dict of uuid -> v1 monitoring bundle
+        """
+        for uuid, info in sorted(monitoring.items(),
+                                 key=lambda x: x[1].get('timestamp', 0)):
+            self.set(uuid, info, last_seen=info.get('timestamp', 0))
+        # entries are only ordered by last seen if loaded into an empty store
+        cutoff = time.time() - self.ttl
+        for uuid in list(self.clients):
+            if self.clients[uuid][0] < cutoff:
+                del self.clients[uuid]
+
+    def expire(self):
+        """Drop clients that did not report within the TTL"""
+        cutoff = time.time() - self.ttl
+        while self.clients:
+            uuid = next(iter(self.clients))
+            if self.clients[uuid][0] >= cutoff:
+                break
+            del self.clients[uuid]
+            self.version += 1
+
+    def last_seen(self, uuid):
+        """When a client last reported, or None"""
+        if uuid in self.clients:
+            return self.clients[uuid][0]
+        return None
+
+    def recent(self, max_age):
+        """Get the latest info of clients that reported within max_age seconds"""
+        cutoff = time.time() - max_age
+        return [info for last_seen, info, ring in self.clients.values()
+                if last_seen >= cutoff]
+
+    def history(self, uuid):
+        """Get the recent samples of a client, oldest first"""
+        return self.clients[uuid][2].samples()
+
+    def dump(self):
+        """Get all clients as a json-serializable list, least recently seen first"""
+        return [[uuid, last_seen, info, ring.dump()]
+                for uuid, (last_seen, info, ring) in self.clients.items()]
+
+    def restore(self, dump):
+        """Replace all clients with `dump` output"""
+        self.clients = OrderedDict()
+        for uuid, last_seen, info, ring in dump:
+            self.clients[uuid] = (last_seen, info,
+                                  MetricsRing.restore(self.history_size, ring))
+        self.version += 1
@@ -0,0 +1,193 @@
+"""
+Net demand: idle jobs that no glidein is on its way to run.
+
+Glideins that are already up with unclaimed resources, and glideins that
+clients submitted but are still queued, will pick up idle jobs soon.
+Publishing the raw demand makes every client submit more glideins for the
+same jobs, which then exit after NOCLAIMTIME without running anything.
+
+The raw demand is fitted against the free resources of the unclaimed
+glidein slots, and what is left is reduced by the glideins clients
+reported as idle.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+from collections import Counter
+
+logger = logging.getLogger('server')
+
+# index of the fields of a state tuple, see server.state_columns
+CPUS, MEMORY, DISK, GPUS = 0, 1, 2, 3
+OS_ARCH, GPU_CAPABILITY, GPU_NAMES, SITE, CVMFS = 5, 6, 7, 8, 9
+
+glidein_slot_constraint = ('GLIDEIN_Site =!= undefined && State == "Unclaimed" && '
+                           'Activity == "Idle" && DynamicSlot =!= true')
+glidein_slot_attrs = ['Name', 'Cpus', 'Memory', 'Disk', 'GPUs', 'GLIDEIN_Site',
+                      'OS_ARCH', 'CUDACapability', 'GPU_NAMES',
+                      'HAS_CVMFS_icecube_opensciencegrid_org']
+
+
+def slot_from_ad(ad):
+    """
+    Get the free resources of a glidein slot.
+
+    Args:
+        ad: startd ad (or dict) with `glidein_slot_attrs`
+
+    Returns:
+        dict: cpus, memory (MB), disk (MB), gpus, site, os_arch,
+              gpu_capability, gpu_names and cvmfs
+    """
+    def get(attr, default=None):
+        try:
+            val = ad[attr] if attr in ad else default
+        except Exception:
+            val = default
+        return default if val is None else val
+    return {
+        'cpus': int(get('Cpus', 0)),
+        'memory': int(get('Memory', 0)),
+        'disk': int(get('Disk', 0))//1000, # KB to MB
+        'gpus': int(get('GPUs', 0)),
+        'site': get('GLIDEIN_Site'),
+        'os_arch': get('OS_ARCH'),
+        'gpu_capability': get('CUDACapability'),
+        'gpu_names': get('GPU_NAMES'),
+        'cvmfs': bool(get('HAS_CVMFS_icecube_opensciencegrid_org', False)),
+    }
+
+
+def query_glidein_slots():
+    """
+    Get the unclaimed glidein slots from the collector.
+
+    This is blocking, so should be run in an executor.
+
+    Returns:
+        list: slot dicts, see `slot_from_ad`
+    """
+    import htcondor
+    ads = htcondor.Collector().query(htcondor.AdTypes.Startd,
+                                     constraint=glidein_slot_constraint,
+                                     projection=glidein_slot_attrs)
+    ret = []
+    for ad in ads:
+        try:
+            ret.append(slot_from_ad(ad))
+        except Exception:
+            logger.info('error parsing glidein slot ad', exc_info=True)
+    return ret
+
+
+def slot_matches(key, slot):
+    """Check if a glidein slot meets the requirements of a state tuple"""
+    def allowed(values, value):
+        return values is None or value is None or value in values.split(',')
+    if len(key) > OS_ARCH:
+        if not allowed(key[SITE], slot['site']):
+            return False
+        if not allowed(key[OS_ARCH], slot['os_arch']):
+            return False
+        if key[CVMFS] and not slot['cvmfs']:
+            return False
+        if key[GPUS]:
+            if (key[GPU_CAPABILITY] is not None and slot['gpu_capability'] is not None
+                and slot['gpu_capability'] < key[GPU_CAPABILITY]):
+                return False
+            if (key[GPU_NAMES] is not None and slot['gpu_names'] is not None
+                and not any(name in slot['gpu_names'] for name in key[GPU_NAMES].split(','))):
+                return False
+    return True
+
+
+def fit_demand(counter, slots):
+    """
+    Take the jobs that fit in the free resources of glidein slots.
+
+    Larger jobs are fitted first, since small ones fit in the leftovers.
+    Jobs that request no resources at all are left alone, since they would
+    fit any number of times.
+
+    Args:
+        counter: Counter of state tuple -> number of jobs
+        slots: slot dicts, see `slot_from_ad`. Their resources are used up.
+
+    Returns:
+        Counter: state tuple -> number of jobs without a slot
+    """
+    ret = Counter(counter)
+    if not slots:
+        return ret
+    resources = ((CPUS, 'cpus'), (MEMORY, 'memory'), (DISK, 'disk'), (GPUS, 'gpus'))
+    for key in sorted(ret, key=lambda k: (k[GPUS], k[CPUS], k[MEMORY], k[DISK]),
+                      reverse=True):
+        if not any(key[i] > 0 for i, _ in resources):
+            continue
+        for slot in slots:
+            if ret[key] <= 0:
+                break
+            if not slot_matches(key, slot):
+                continue
+            fit = ret[key]
+            for i, name in resources:
+                if key[i] > 0:
+                    fit = min(fit, int(slot[name] // key[i]))
+            if fit <= 0:
+                continue
+            ret[key] -= fit
+            for i, name in resources:
+                slot[name] -= fit * key[i]
+    return ret
+
+
+def subtract_pending(counter, pending):
+    """
+    Take the jobs that pending glideins will run.
+
+    Which jobs a pending glidein was submitted for is unknown, so they are
+    taken from all rows in proportion to the number of jobs.
+
+    Args:
+        counter: Counter of state tuple -> number of jobs
+        pending: number of jobs pending glideins will run
+
+    Returns:
+        Counter: state tuple -> number of remaining jobs
+    """
+    ret = Counter(counter)
+    total = sum(ret.values())
+    pending = int(min(pending, total))
+    if pending <= 0:
+        return ret
+    taken = 0
+    for key in ret:
+        take = ret[key] * pending // total
+        ret[key] -= take
+        taken += take
+    # the rounding remainder comes from the largest rows
+    for key in sorted(ret, key=lambda k: ret[k], reverse=True):
+        if taken >= pending:
+            break
+        if ret[key] > 0:
+            ret[key] -= 1
+            taken += 1
+    return ret
+
+
+def net_demand(counter, slots, pending):
+    """
+    Get the net demand.
+
+    Args:
+        counter: Counter of state tuple -> number of idle jobs
+        slots: unclaimed glidein slots, see `slot_from_ad`
+        pending: number of jobs pending glideins will run
+
+    Returns:
+        Counter: state tuple -> number of jobs that need new glideins
+    """
+    slots = [dict(slot) for slot in slots]
+    ret = subtract_pending(fit_demand(counter, slots), pending)
+    return Counter(dict((k, v) for k, v in ret.items() if v > 0))
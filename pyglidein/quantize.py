@@ -0,0 +1,205 @@
+"""
+Quantization of the demand state.
+
+Jobs with slightly different memory or disk requests end up as separate
+state rows, and every row causes a separate submit on every client.
+Rounding the requests up into buckets, and optionally merging buckets
+until only a few rows are left, gives fewer and larger submissions.
+
+A bucket always has at least the resources of every job folded into it,
+so a glidein started for a bucket can run any of its jobs.
+
+Configured in the `[quantize]` section of the server config:
+
+    [quantize]
+    # round memory and disk (MB) up to a multiple of these
+    memory_step = 500
+    disk_step = 1000
+    # or round memory and disk up to log-scale bins, this many per doubling
+    log_bins = 4
+    # greedily merge rows until at most this many are left
+    max_rows = 20
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import math
+import heapq
+import bisect
+import itertools
+import logging
+from collections import Counter
+
+logger = logging.getLogger('quantize')
+
+# index of each resource in a state tuple (cpus, memory, disk, gpus, os, ...),
+# the fields from OS on are requirements that are never rounded or merged
+RESOURCES = (0, 1, 2, 3)
+OS = 4
+
+
+def round_up_step(value, step):
+    """Round value up to a multiple of step"""
+    if not step or value <= 0:
+        return value
+    return int(math.ceil(value / step) * step)
+
+
+def round_up_log(value, bins):
+    """
+    Round value up to a log-scale bin.
+
+    Bin edges are at 2**(k/bins), so there are `bins` bins per doubling.
+    """
+    if not bins or value <= 0:
+        return value
+    k = math.ceil(math.log(value, 2) * bins)
+    ret = int(math.ceil(2**(k / bins)))
+    while ret < value:
+        k += 1
+        ret = int(math.ceil(2**(k / bins)))
+    return ret
+
+
+def quantize_key(key, config):
+    """
+    Round the memory and disk of a state tuple up to its bucket.
+
+    Args:
+        key: state tuple (cpus, memory, disk, gpus, os, ...)
+        config: the quantize config dict
+
+    Returns:
+        tuple: the bucket state tuple
+    """
+    cpus, memory, disk, gpus = key[:OS]
+    if config.get('log_bins'):
+        memory = round_up_log(memory, config['log_bins'])
+        disk = round_up_log(disk, config['log_bins'])
+    else:
+        memory = round_up_step(memory, config.get('memory_step'))
+        disk = round_up_step(disk, config.get('disk_step'))
+    return (cpus, memory, disk, gpus) + tuple(key[OS:])
+
+
+def merge_cost(a, count_a, b, count_b):
+    """
+    Cost of merging two rows into one bucket.
+
+    This is the relative over-provisioning summed over all jobs in both
+    rows, or None if the rows should never be merged (different OS or
+    other requirements, or GPU and non-GPU jobs).
+    """
+    if a[OS:] != b[OS:] or bool(a[3]) != bool(b[3]):
+        return None
+    merged = merge_key(a, b)
+    cost = 0.
+    for i in RESOURCES:
+        if merged[i] > 0:
+            cost += count_a * (merged[i] - a[i]) / merged[i]
+            cost += count_b * (merged[i] - b[i]) / merged[i]
+    return cost
+
+
+def merge_key(a, b):
+    """Smallest bucket that covers both state tuples"""
+    return tuple(max(a[i], b[i]) for i in RESOURCES) + tuple(a[OS:])
+
+
+def merge_group(key):
+    """Rows can only be merged within a group: same requirements, GPU or not"""
+    return (tuple(key[OS:]), bool(key[3]))
+
+
+def resources(key):
+    """Resources of a state tuple, the sort order within a group"""
+    return tuple(key[:OS])
+
+
+def merge_rows(counter, max_rows, neighbors=4):
+    """
+    Greedily merge the cheapest pair of rows until at most max_rows are left.
+
+    Only pairs of rows at most `neighbors` apart in the resource order of
+    their group are candidates, so each merge costs O(neighbors**2) new
+    pairs instead of O(rows).
+
+    Args:
+        counter: Counter of state tuple -> number of jobs
+        max_rows: maximum number of rows
+        neighbors: how far apart in resource order rows may be to merge
+
+    Returns:
+        Counter: merged state tuple -> number of jobs
+    """
+    rows = dict(counter)
+    if not max_rows or len(rows) <= max_rows:
+        return Counter(rows)
+
+    # group -> (keys sorted by resources, their resources)
+    groups = {}
+    for key in sorted(rows, key=resources):
+        keys, res = groups.setdefault(merge_group(key), ([], []))
+        keys.append(key)
+        res.append(resources(key))
+
+    heap = []
+    order = itertools.count() # tie breaker, state tuples may not be comparable
+    def push(a, b):
+        cost = merge_cost(a, rows[a], b, rows[b])
+        if cost is not None:
+            heapq.heappush(heap, (cost, next(order), a, rows[a], b, rows[b]))
+    def push_near(keys, i):
+        # pairs at most `neighbors` apart that span position i
+        for j in range(max(0, i - neighbors), min(i + 1, len(keys))):
+            for k in range(max(i, j + 1), min(len(keys), j + neighbors + 1)):
+                push(keys[j], keys[k])
+    for keys, res in groups.values():
+        for j in range(len(keys)):
+            for k in range(j + 1, min(len(keys), j + neighbors + 1)):
+                push(keys[j], keys[k])
+
+    while len(rows) > max_rows and heap:
+        cost, _, a, count_a, b, count_b = heapq.heappop(heap)
+        # skip pairs where a row has already changed
+        if rows.get(a) != count_a or rows.get(b) != count_b:
+            continue
+        merged = merge_key(a, b)
+        keys, res = groups[merge_group(a)]
+        for key in (a, b):
+            i = bisect.bisect_left(res, resources(key))
+            del keys[i]
+            del res[i]
+            del rows[key]
+        i = bisect.bisect_left(res, resources(merged))
+        if merged in rows:
+            rows[merged] += count_a + count_b
+        else:
+            keys.insert(i, merged)
+            res.insert(i, resources(merged))
+            rows[merged] = count_a + count_b
+        for key in (a, b, merged):
+            push_near(keys, bisect.bisect_left(res, resources(key)))
+
+    if len(rows) > max_rows:
+        logger.info('cannot merge state below %d rows', len(rows))
+    return Counter(rows)
+
+
+def quantize(counter, config):
+    """
+    Quantize the demand state.
+
+    Args:
+        counter: Counter of state tuple -> number of jobs
+        config: the quantize config dict
+
+    Returns:
+        Counter: bucket state tuple -> number of jobs
+    """
+    if not config:
+        return counter
+    ret = Counter()
+    for key, count in counter.items():
+        ret[quantize_key(key, config)] += count
+    return merge_rows(ret, config.get('max_rows'))
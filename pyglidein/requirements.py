@@ -0,0 +1,288 @@
+"""
+Analysis of job Requirements expressions.
+
+The server needs to know what kind of glidein can run a job: its OS, GPU,
+site and CVMFS needs. Instead of pattern matching the expression text,
+the expression is matched with the classad library against probe machine
+ads, varying one attribute at a time. Sites and GPU names cannot be
+enumerated, so the string literals of the expression, and the items of
+string list literals, are used as the candidate values.
+
+A queue has far fewer distinct Requirements than jobs, so the results
+are kept in an LRU cache keyed by the expression text. Literals are only
+tried for the attributes the expression references, and each expression
+gets a budget of probe matches, after which the substring matching of
+`legacy_requirements` is used.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger('server')
+
+Requirements = namedtuple('Requirements', ['os', 'os_arch', 'gpu_capability',
+                                           'gpu_names', 'site', 'cvmfs'])
+Requirements.__doc__ = """
+What a job needs from a glidein. None means no constraint.
+
+os: legacy OS column, 'sl6' if the job only runs on RHEL 6
+os_arch: comma separated OS_ARCH values (see os_arch.sh) the job runs on
+gpu_capability: minimum CUDA capability
+gpu_names: comma separated GPU names the job runs on
+site: comma separated GLIDEIN_Site values the job runs on
+cvmfs: True if the job needs CVMFS
+"""
+
+no_requirements = Requirements(None, None, None, None, None, False)
+
+# OS_ARCH values from os_arch.sh, with the HTCondor OS attributes of
+# machines running them
+os_arch_probes = [
+    ('RHEL_6_x86_64', [('SL', 6, 'SL6'), ('CentOS', 6, 'CentOS6'), ('RedHat', 6, 'RedHat6')]),
+    ('RHEL_7_x86_64', [('CentOS', 7, 'CentOS7'), ('SL', 7, 'SL7'), ('RedHat', 7, 'RedHat7')]),
+    ('RHEL_8_x86_64', [('AlmaLinux', 8, 'AlmaLinux8'), ('Rocky', 8, 'Rocky8'),
+                       ('CentOS', 8, 'CentOS8'), ('RedHat', 8, 'RedHat8')]),
+    ('RHEL_9_x86_64', [('AlmaLinux', 9, 'AlmaLinux9'), ('Rocky', 9, 'Rocky9'),
+                       ('RedHat', 9, 'RedHat9')]),
+    ('Ubuntu_12.04_x86_64', [('Ubuntu', 12, 'Ubuntu12')]),
+    ('Ubuntu_14.04_x86_64', [('Ubuntu', 14, 'Ubuntu14')]),
+    ('Ubuntu_16.04_x86_64', [('Ubuntu', 16, 'Ubuntu16')]),
+]
+
+cuda_capabilities = [1.0, 2.0, 3.0, 3.5, 3.7, 5.0, 5.2, 6.0, 6.1, 7.0,
+                     7.5, 8.0, 8.6, 8.9, 9.0, 10.0, 12.0]
+
+cvmfs_attrs = ['HAS_CVMFS_icecube_opensciencegrid_org', 'ICECUBE_CVMFS_Exists',
+               'OASIS_CVMFS_Exists']
+
+# a machine that has everything, and the job attributes Requirements use
+probe_machine = {
+    'Requirements': True,
+    'Arch': 'X86_64',
+    'OpSys': 'LINUX',
+    'Cpus': 10**6,
+    'Memory': 10**9,
+    'Disk': 10**12,
+    'GPUs': 10**3,
+    'CUDACapability': 100.,
+    'CUDADriverVersion': 100.,
+    'CUDAGlobalMemoryMb': 10**9,
+    'HasFileTransfer': True,
+    'PYGLIDEIN_PARROT': False,
+}
+probe_machine.update((attr, True) for attr in cvmfs_attrs)
+probe_job = {
+    'RequestCpus': 1,
+    'RequestMemory': 1,
+    'RequestDisk': 1,
+    'RequestGPUs': 0,
+}
+
+string_literal = re.compile(r'"((?:[^"\\]|\\.)*)"')
+identifier = re.compile(r'[A-Za-z_][A-Za-z0-9_.]*')
+string_list_delimiter = re.compile(r'[,\s]+')
+
+
+class ProbeLimitExceeded(Exception):
+    pass
+
+
+def legacy_requirements(text):
+    """Requirements found by substring matching, if there is no classad library"""
+    if text and 'OpSysAndVer =?= "SL6"' in text:
+        return no_requirements._replace(os='sl6', os_arch='RHEL_6_x86_64')
+    return no_requirements
+
+
+class RequirementsAnalyzer(object):
+    """
+    Memoized analysis of Requirements expressions.
+
+    Thread safe, since queries are parsed in an executor.
+    """
+
+    def __init__(self, maxsize=10000, max_probes=500):
+        """
+        Args:
+            maxsize: max number of expressions to cache
+            max_probes: max number of probe matches per expression
+        """
+        self.maxsize = maxsize
+        self.max_probes = max_probes
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def check(self):
+        """
+        Log how requirements are analyzed, once at startup.
+
+        Returns:
+            bool: True if the classad library is available
+        """
+        try:
+            import classad
+        except ImportError:
+            logger.warn('classad library not found, requirements are analyzed '
+                        'in legacy mode: only SL6 jobs are detected')
+            return False
+        return True
+
+    def analyze(self, text):
+        """
+        Get the requirements of a job.
+
+        Args:
+            text: the Requirements expression as a string
+
+        Returns:
+            Requirements
+        """
+        if not text:
+            return no_requirements
+        with self.lock:
+            if text in self.cache:
+                self.hits += 1
+                ret = self.cache.pop(text)
+                self.cache[text] = ret
+                return ret
+            self.misses += 1
+        try:
+            ret = self._analyze(text)
+        except ImportError:
+            ret = legacy_requirements(text)
+        except ProbeLimitExceeded:
+            logger.info('requirements too complex to analyze: %r', text)
+            ret = legacy_requirements(text)
+        except Exception:
+            logger.info('cannot analyze requirements %r', text, exc_info=True)
+            ret = legacy_requirements(text)
+        with self.lock:
+            self.cache[text] = ret
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return ret
+
+    def _analyze(self, text):
+        import classad
+        try:
+            # registers stringListMember and the other HTCondor functions
+            import htcondor
+        except ImportError:
+            pass
+        requirements = classad.ExprTree(text)
+        literals = set(string_literal.findall(text))
+        # items of lists like stringListMember(GLIDEIN_Site, "SiteA,SiteB")
+        literals.update(item for literal in list(literals)
+                        for item in string_list_delimiter.split(literal) if item)
+        literals = sorted(literals)
+        # attribute names are case insensitive
+        referenced = set(name.split('.')[-1].lower()
+                         for name in identifier.findall(string_literal.sub('""', text)))
+        site_candidates = [None]
+        if 'glidein_site' in referenced:
+            site_candidates += literals
+        gpu_names_candidates = [None]
+        if 'gpu_names' in referenced:
+            gpu_names_candidates += literals
+
+        results = {}
+
+        def matches(attrs):
+            key = frozenset(attrs.items())
+            if key not in results:
+                if len(results) >= self.max_probes:
+                    raise ProbeLimitExceeded()
+                results[key] = match(attrs)
+            return results[key]
+
+        def match(attrs):
+            values = dict(probe_machine)
+            values.update(attrs)
+            machine = classad.ClassAd()
+            # machine attributes are also put in the job, for unqualified
+            # references that do not fall back to TARGET
+            job = classad.ClassAd()
+            for k, v in values.items():
+                if v is not None:
+                    machine[k] = v
+                    job[k] = v
+            for k, v in probe_job.items():
+                job[k] = v
+            job['Requirements'] = requirements
+            return bool(machine.matches(job))
+
+        def os_attrs(os_arch, name, version, name_and_version):
+            return {'OS_ARCH': os_arch, 'OpSysName': name, 'OpSysMajorVer': version,
+                    'OpSysAndVer': name_and_version, 'OpSysLongName': name_and_version}
+
+        # find any machine the job matches
+        base = None
+        for os_arch, alternatives in os_arch_probes:
+            for alt in alternatives:
+                for site in site_candidates:
+                    for gpu_names in gpu_names_candidates:
+                        attrs = os_attrs(os_arch, *alt)
+                        attrs.update({'GLIDEIN_Site': site, 'GPU_NAMES': gpu_names})
+                        if matches(attrs):
+                            base = attrs
+                            break
+                    if base:
+                        break
+                if base:
+                    break
+            if base:
+                break
+        if base is None:
+            logger.debug('requirements match no probe machine: %r', text)
+            return legacy_requirements(text)
+
+        def matching(attr, values):
+            return [v for v in values if matches(dict(base, **{attr: v}))]
+
+        os_arches = []
+        for os_arch, alternatives in os_arch_probes:
+            for alt in alternatives:
+                attrs = dict(base)
+                attrs.update(os_attrs(os_arch, *alt))
+                if matches(attrs):
+                    os_arches.append(os_arch)
+                    break
+        if len(os_arches) == len(os_arch_probes):
+            os_arches = None
+
+        sites = None
+        if base['GLIDEIN_Site'] is not None:
+            sites = matching('GLIDEIN_Site', site_candidates[1:])
+
+        gpu_names = None
+        if base['GPU_NAMES'] is not None:
+            gpu_names = matching('GPU_NAMES', gpu_names_candidates[1:])
+
+        gpu_capability = None
+        if not matches(dict(base, CUDACapability=None)):
+            for capability in cuda_capabilities:
+                if matches(dict(base, CUDACapability=capability)):
+                    if capability != cuda_capabilities[0]:
+                        gpu_capability = capability
+                    break
+
+        cvmfs = not matches(dict(base, **dict((attr, False) for attr in cvmfs_attrs)))
+
+        def join(values):
+            return None if values is None else ','.join(values)
+        return Requirements(os='sl6' if os_arches == ['RHEL_6_x86_64'] else None,
+                            os_arch=join(os_arches),
+                            gpu_capability=gpu_capability,
+                            gpu_names=join(gpu_names),
+                            site=join(sites),
+                            cvmfs=cvmfs)
+
+
+# shared by everything parsing jobs in the server
+analyzer = RequirementsAnalyzer()
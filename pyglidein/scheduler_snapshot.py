@@ -0,0 +1,309 @@
+"""
+One query of the local scheduler per client cycle.
+
+Without a snapshot, a cycle runs `running_cmd` and `idle_cmd` for every
+partition, then another query for the idle time metrics, and another for
+the cleanup, all going to the same scheduler daemon. A snapshot lists the
+glidein jobs once, with their state, partition, submit time and name, and
+everything is derived from that list. It is cached for a TTL, so all
+partitions of a cycle share one query, and invalidated at the start of
+the next cycle.
+
+Jobs are matched to a partition by the `partition` (slurm partition or
+queue) and `job_name` of its config section, if set. The jobs of job
+arrays are listed one by one, so arrays count as many jobs as they have.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import pwd
+import time
+import shlex
+import logging
+import threading
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from collections import namedtuple
+from subprocess import check_output, CalledProcessError, STDOUT
+
+logger = logging.getLogger('client')
+
+Job = namedtuple('Job', ['id', 'state', 'partition', 'submit_time', 'name'])
+Job.__doc__ = """
+A job in the local scheduler.
+
+state: 'idle', 'running' or 'other'
+submit_time: unix time the job was submitted, or None
+"""
+
+
+class SchedulerSnapshot(object):
+    """
+    Base class for the scheduler snapshots.
+
+    Subclasses implement `query`, returning the list of jobs of the user.
+    """
+
+    def __init__(self, config, ttl=60):
+        """
+        Args:
+            config: the client config
+            ttl: seconds to reuse a snapshot
+        """
+        self.config = config
+        self.ttl = ttl
+        if config.get('Cluster', {}).get('user', None) is not None:
+            self.user = config['Cluster']['user']
+        elif os.environ.get('USER', None) is not None:
+            self.user = os.environ['USER']
+        else:
+            self.user = pwd.getpwuid(os.getuid()).pw_name
+        self.jobs = None
+        self.updated = None
+        self.lock = threading.Lock()
+
+    def run(self, cmd):
+        """Run a query command, returning its output as a string"""
+        cmd = shlex.split(os.path.expandvars(cmd))
+        return check_output(cmd, shell=False, env=os.environ, stderr=STDOUT).decode()
+
+    def query(self):
+        raise NotImplementedError()
+
+    def get(self):
+        """
+        Get the jobs, querying the scheduler if the snapshot is too old.
+
+        Thread safe, so partitions running concurrently share one query.
+
+        Returns:
+            list: Job
+        """
+        with self.lock:
+            if self.updated is None or time.time() - self.updated > self.ttl:
+                self.jobs = self.query()
+                self.updated = time.time()
+                logger.debug('scheduler snapshot has %d jobs', len(self.jobs))
+            return self.jobs
+
+    def invalidate(self):
+        """Query the scheduler again on the next `get`, after submitting"""
+        with self.lock:
+            self.updated = None
+
+    def partition_jobs(self, partition='Cluster'):
+        """Get the jobs of a partition"""
+        cluster_config = self.config.get(partition, {})
+        ret = self.get()
+        if cluster_config.get('partition'):
+            ret = [job for job in ret if job.partition == cluster_config['partition']]
+        if cluster_config.get('job_name'):
+            ret = [job for job in ret if job.name == cluster_config['job_name']]
+        return ret
+
+    def running(self, partition='Cluster'):
+        """Number of running jobs of a partition"""
+        return sum(1 for job in self.partition_jobs(partition) if job.state == 'running')
+
+    def idle(self, partition='Cluster'):
+        """Number of idle jobs of a partition"""
+        return sum(1 for job in self.partition_jobs(partition) if job.state == 'idle')
+
+    def job_ids(self):
+        """Get the ids of all jobs, without server name or array index"""
+        return set(job.id.split('.')[0].split('[')[0] for job in self.get())
+
+    def get_mma_idle_time(self, partition='Cluster'):
+        """
+        Get the idle time metrics, like ClientMetrics.get_mma_idle_time.
+
+        Returns:
+            dict: avg_idle_time, min_idle_time and max_idle_time, each a
+                  dict of partition -> seconds
+        """
+        now = time.time()
+        deltas = [now - job.submit_time for job in self.partition_jobs(partition)
+                  if job.state == 'idle' and job.submit_time is not None]
+        metrics = {
+            'avg_idle_time': {partition: 0},
+            'min_idle_time': {partition: 0},
+            'max_idle_time': {partition: 0},
+        }
+        if deltas:
+            metrics['avg_idle_time'][partition] = int(sum(deltas) / len(deltas))
+            metrics['min_idle_time'][partition] = int(min(deltas))
+            metrics['max_idle_time'][partition] = int(max(deltas))
+        return metrics
+
+
+def parse_time(value, fmt):
+    """Convert a local time string to unix time, or None"""
+    try:
+        return time.mktime(datetime.strptime(value.strip(), fmt).timetuple())
+    except ValueError:
+        return None
+
+
+class SlurmSnapshot(SchedulerSnapshot):
+    """Snapshot of a SLURM queue, from one squeue call"""
+
+    states = {'PENDING': 'idle', 'RUNNING': 'running'}
+
+    def query(self):
+        # -r lists the tasks of pending job arrays one per line, and %A
+        # is the job id of each task, as in SLURM_JOB_ID
+        cmd = 'squeue -h -r -u {} -o "%A|%T|%P|%V|%j"'.format(self.user)
+        ret = []
+        for line in self.run(cmd).split('\n'):
+            parts = line.strip().split('|', 4)
+            if len(parts) != 5:
+                continue
+            job_id, state, partition, submit_time, name = parts
+            ret.append(Job(job_id, self.states.get(state, 'other'), partition,
+                           parse_time(submit_time, '%Y-%m-%dT%H:%M:%S'), name))
+        return ret
+
+
+class PBSSnapshot(SchedulerSnapshot):
+    """Snapshot of a PBS / Torque queue, from one qstat -f call"""
+
+    states = {'Q': 'idle', 'R': 'running'}
+
+    def query(self):
+        # -t lists the jobs of job arrays one by one
+        cmd = 'qstat -t -u {} -f'.format(self.user)
+        ret = []
+        attrs = None
+        for line in self.run(cmd).split('\n') + ['']:
+            if line.startswith('Job Id:') or not line.strip():
+                if attrs:
+                    ret.append(Job(attrs['id'], self.states.get(attrs.get('job_state'), 'other'),
+                                   attrs.get('queue'),
+                                   parse_time(attrs.get('qtime', ''), '%a %b %d %H:%M:%S %Y'),
+                                   attrs.get('Job_Name')))
+                attrs = {'id': line.split(':', 1)[1].strip()} if line.startswith('Job Id:') else None
+            elif attrs is not None and ' = ' in line:
+                key, value = line.split(' = ', 1)
+                attrs[key.strip()] = value.strip()
+        return ret
+
+
+class GridEngineSnapshot(SchedulerSnapshot):
+    """Snapshot of an SGE / UGE queue, from one qstat -xml call"""
+
+    def query(self):
+        # -g d lists the tasks of job arrays one by one, and -r adds the
+        # requested queue of pending jobs
+        cmd = 'qstat -u {} -g d -r -xml'.format(self.user)
+        ret = []
+        for job in ET.fromstring(self.run(cmd)).iter('job_list'):
+            state = job.findtext('state', '')
+            if 'E' in state or 'h' in state:
+                # error and hold states do not start by themselves
+                state = 'other'
+            else:
+                state = {'pending': 'idle', 'running': 'running'}.get(job.get('state'), 'other')
+            job_id = job.findtext('JB_job_number')
+            if job.findtext('tasks'):
+                job_id += '.' + job.findtext('tasks')
+            queue = job.findtext('queue_name') or job.findtext('hard_req_queue') or ''
+            submit_time = job.findtext('JB_submission_time') or job.findtext('JAT_start_time')
+            ret.append(Job(job_id, state, queue.split('@')[0] or None,
+                           parse_time((submit_time or '')[:19], '%Y-%m-%dT%H:%M:%S'),
+                           job.findtext('JB_name')))
+        return ret
+
+
+class LSFSnapshot(SchedulerSnapshot):
+    """Snapshot of an LSF queue, from one bjobs call"""
+
+    states = {'PEND': 'idle', 'RUN': 'running'}
+
+    def query(self):
+        # bjobs lists the elements of job arrays one by one, with the
+        # index in the job name
+        cmd = ('bjobs -u {} -noheader -o "jobid jobindex stat queue submit_time job_name '
+               'delimiter=\'|\'"'.format(self.user))
+        try:
+            output = self.run(cmd)
+        except CalledProcessError as e:
+            # bjobs fails when there are no jobs
+            if 'No unfinished job found' not in e.output.decode('utf-8', 'replace'):
+                raise
+            output = ''
+        ret = []
+        for line in output.split('\n'):
+            parts = line.strip().split('|', 5)
+            if len(parts) != 6:
+                continue
+            job_id, index, state, queue, submit_time, name = parts
+            if index.strip() not in ('', '0'):
+                job_id += '[{}]'.format(index.strip())
+            ret.append(Job(job_id, self.states.get(state, 'other'), queue,
+                           parse_lsf_time(submit_time), name.split('[')[0]))
+        return ret
+
+
+def parse_lsf_time(value):
+    """
+    Convert an LSF submit time to unix time, or None.
+
+    LSF only shows the year when LSB_DISPLAY_YEAR is set, otherwise the
+    time is taken to be within the last year.
+    """
+    value = ' '.join(value.split()[:4])
+    ret = parse_time(value, '%b %d %H:%M %Y')
+    if ret is None:
+        now = datetime.now()
+        ret = parse_time('{} {}'.format(value, now.year), '%b %d %H:%M %Y')
+        if ret is not None and ret > time.time() + 86400:
+            ret = parse_time('{} {}'.format(value, now.year - 1), '%b %d %H:%M %Y')
+    return ret
+
+
+class CondorSnapshot(SchedulerSnapshot):
+    """Snapshot of an HTCondor queue, from one schedd query"""
+
+    states = {1: 'idle', 2: 'running'}
+
+    def query(self):
+        import htcondor
+        schedd = htcondor.Schedd()
+        ret = []
+        for job in schedd.xquery(requirements='Owner == "{}"'.format(self.user),
+                                 projection=['ClusterId', 'ProcId', 'JobStatus', 'QDate']):
+            ret.append(Job('{}.{}'.format(job['ClusterId'], job['ProcId']),
+                           self.states.get(job['JobStatus'], 'other'), None,
+                           job.get('QDate'), None))
+        return ret
+
+
+snapshot_classes = {
+    'slurm': SlurmSnapshot,
+    'pbs': PBSSnapshot,
+    'sge': GridEngineSnapshot,
+    'uge': GridEngineSnapshot,
+    'lsf': LSFSnapshot,
+    'htcondor': CondorSnapshot,
+}
+
+
+def get_snapshot(config, sched_type):
+    """
+    Get the scheduler snapshot for the client, if enabled.
+
+    Args:
+        config: the client config
+        sched_type: scheduler name
+
+    Returns:
+        SchedulerSnapshot, or None if not enabled or not supported
+    """
+    config_cluster = config.get('Cluster', {})
+    if not config_cluster.get('scheduler_snapshot', False):
+        return None
+    if sched_type not in snapshot_classes:
+        logger.warn('scheduler_snapshot is not supported for %s', sched_type)
+        return None
+    return snapshot_classes[sched_type](config, ttl=config_cluster.get('snapshot_ttl', 60))
@@ -2,31 +2,61 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
+import sys
+import time
 import subprocess
 import logging
 from functools import partial
 from optparse import OptionParser
-from collections import Counter
+from collections import Counter, deque
 import distutils.version
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import re
+import threading
+import hashlib
+import uuid
+import gzip
+import socket
+import signal
+import atexit
+import tempfile
+import shutil
+from io import BytesIO
 
 from pyglidein.util import json_encode, json_decode
 from pyglidein.config import Config
 from pyglidein.metrics_sender_client import MetricsSenderClient
 from pyglidein.client_metrics import ClientMetricsBundle
+from pyglidein.quantize import quantize
+from pyglidein.requirements import analyzer
+from pyglidein.net_demand import net_demand, query_glidein_slots
+from pyglidein.allocation import DemandAllocator
+from pyglidein.demand_history import DemandHistory
+from pyglidein.snapshot_store import SnapshotStore
+from pyglidein.monitoring_store import MonitoringStore
+from pyglidein.server_metrics import Registry
+from pyglidein.shared_state import SharedStateWriter, SharedStateReader
 import tornado.escape
 tornado.escape.json_encode = json_encode
 tornado.escape.json_decode = json_decode
 
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.httpserver import HTTPServer
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_sockets
 from tornado.process import Subprocess
 import tornado.web
 import tornado.gen
+import tornado.locks
 
 logger = logging.getLogger('server')
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
 job_status = {
     1:'Idle',
     2:'Run',
@@ -60,6 +90,58 @@ client_metrics = {
     'max_idle_time': 'glideins.max_idle_time'
 }
 
+# server instrumentation, exported at /metrics. The collector metrics are
+# about the queue queries and client monitoring, which run in the collector
+# process when there are multiple worker processes.
+collector_metrics = Registry()
+server_metrics = Registry()
+condor_query_duration = collector_metrics.histogram(
+        'pyglidein_condor_query_duration_seconds',
+        'Duration of a full queue query', ['backend'])
+condor_query_errors = collector_metrics.counter(
+        'pyglidein_condor_query_errors_total',
+        'Failed queue queries', ['backend'])
+condor_parse_duration = collector_metrics.histogram(
+        'pyglidein_condor_parse_duration_seconds',
+        'Duration of reading and parsing the jobs of one query '
+        '(one schedd for the bindings)', ['backend'])
+condor_jobs_parsed = collector_metrics.counter(
+        'pyglidein_condor_jobs_parsed_total',
+        'Job lines or ads parsed', ['backend'])
+condor_jobs_dropped = collector_metrics.counter(
+        'pyglidein_condor_jobs_dropped_total',
+        'Job lines or ads dropped because they could not be parsed', ['backend'])
+state_rows = server_metrics.gauge(
+        'pyglidein_state_rows', 'Number of rows in the state')
+state_jobs = server_metrics.gauge(
+        'pyglidein_state_jobs', 'Number of idle jobs in the state')
+state_raw_jobs = server_metrics.gauge(
+        'pyglidein_state_raw_jobs',
+        'Number of idle jobs in the state, before subtracting glideins on their way')
+state_age = server_metrics.gauge(
+        'pyglidein_state_age_seconds', 'Seconds since the state was refreshed')
+state_generation = server_metrics.gauge(
+        'pyglidein_state_generation', 'Generation of the state')
+allocation_clients = server_metrics.gauge(
+        'pyglidein_allocation_clients', 'Clients holding a lease on a share of the state')
+rpc_duration = server_metrics.histogram(
+        'pyglidein_jsonrpc_duration_seconds',
+        'Duration of jsonrpc calls', ['method'])
+rpc_errors = server_metrics.counter(
+        'pyglidein_jsonrpc_errors_total',
+        'Failed jsonrpc calls', ['method'])
+glidein_slots = collector_metrics.gauge(
+        'pyglidein_glidein_free_slots', 'Number of unclaimed glidein slots')
+monitoring_clients = collector_metrics.gauge(
+        'pyglidein_monitoring_clients', 'Number of clients in the monitoring store')
+metrics_queue_depth = collector_metrics.gauge(
+        'pyglidein_metrics_sender_queue_depth',
+        'Client metrics datapoints waiting to be sent')
+
+# jsonrpc methods, other method names are counted as "unknown"
+jsonrpc_methods = ('get_state', 'get_state_delta', 'get_monitoring_history',
+                   'get_schedds', 'get_leases', 'get_forecast', 'monitoring')
+
 class MyHandler(tornado.web.RequestHandler):
     """Default Handler"""
     def initialize(self, cfg):
@@ -87,7 +169,8 @@ class JSONRPCHandler(MyHandler):
     """
     JSONRPC 2.0 Handler.
 
-    Call DB methods using RPC over json.
+    Call DB methods using RPC over json. Batch requests (an array of
+    calls) are answered with an array of responses.
     """
 
     def post(self):
@@ -100,66 +183,253 @@ class JSONRPCHandler(MyHandler):
         except Exception as e:
             raise tornado.web.HTTPError(400, 'POST request is not valid json')
 
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        if isinstance(request, list):
+            if not request:
+                response, error = self.json_error({'code':-32600, 'message':'Invalid Request',
+                                                   'data':'empty batch'})
+                self.set_status(400)
+                self.write(response)
+                return
+            responses = []
+            for r in request:
+                response, error = self.call(r)
+                # notifications do not get a response, even on errors
+                if not self.is_notification(r):
+                    responses.append(response)
+            if responses:
+                self.write(b'[' + b','.join(responses) + b']')
+            else:
+                # nothing to return for a batch of notifications
+                self.clear_header('Content-Type')
+                self.set_status(204)
+        else:
+            response, error = self.call(request)
+            if error:
+                self.set_status(400)
+            self.write(response)
+
+    @staticmethod
+    def is_notification(request):
+        """Check if a request is a valid request object without an id"""
+        return (isinstance(request, dict) and 'id' not in request and
+                request.get('jsonrpc') in ('2.0', 2.0) and
+                isinstance(request.get('method'), string_types))
+
+    def call(self, request):
+        """
+        Run a single jsonrpc call, recording its duration and errors.
+
+        Args:
+            request: the jsonrpc request object
+
+        Returns:
+            tuple: (json encoded response, True if it is an error)
+        """
+        method = request.get('method') if isinstance(request, dict) else None
+        if not isinstance(method, string_types) or method not in jsonrpc_methods:
+            method = 'unknown'
+        start = time.time()
+        response, error = self.run_call(request)
+        rpc_duration.observe(time.time()-start, method=method)
+        if error:
+            rpc_errors.inc(method=method)
+        return response, error
+
+    def run_call(self, request):
+        """Run a single jsonrpc call, see `call`"""
         # check for all parts of jsonrpc 2.0 spec
+        if not isinstance(request, dict):
+            return self.json_error({'code':-32600, 'message':'Invalid Request',
+                                    'data':'request is not an object'})
+        if 'id' in request:
+            request_id = request['id']
+        else:
+            request_id = None
         if 'jsonrpc' not in request or request['jsonrpc'] not in ('2.0', 2.0):
-            self.json_error({'code':-32600, 'message':'Invalid Request',
-                             'data':'jsonrpc is not 2.0'})
+            return self.json_error({'code':-32600, 'message':'Invalid Request',
+                                    'data':'jsonrpc is not 2.0'})
         elif 'method' not in request:
-            self.json_error({'code':-32600, 'message':'Invalid Request',
-                             'data':'method not in request'})
+            return self.json_error({'code':-32600, 'message':'Invalid Request',
+                                    'data':'method not in request'})
+        elif not isinstance(request['method'], string_types):
+            return self.json_error({'code':-32600, 'message':'Invalid Request',
+                                    'data':'method is not a string'})
         elif request['method'].startswith('_'):
-            self.json_error({'code':-32600, 'message':'Invalid Request',
-                             'data':'method name cannot start with underscore'})
+            return self.json_error({'code':-32600, 'message':'Invalid Request',
+                                    'data':'method name cannot start with underscore'})
+
+        method = request['method']
+        if 'params' in request:
+            params = request['params']
         else:
-            method = request['method']
-            if 'params' in request:
-                params = request['params']
-            else:
-                params = {}
-            if 'id' in request:
-                request_id = request['id']
-            else:
-                request_id = None
+            params = {}
 
-            # call method
-            try:
-                if method == 'get_state':
-                    ret = self.cfg['state']
-                elif method == 'monitoring':
-                    client_id = params.pop('uuid')
-                    client_id_clean = re.sub(r'\W+', '', client_id)
-                    # For Clients > 1.1
-                    if 'timestamp' in params and 'metrics' in params:
-                        metrics_bundle = ClientMetricsBundle(client_id_clean,
-                                                             timestamp=params['timestamp'],
-                                                             metrics=params['metrics'])
-                    # For Clients < 1.1
-                    else:
-                        metrics_bundle = ClientMetricsBundle(client_id_clean,
-                                                             metrics=params)
-                    if self.metrics_sender_client is not None:
-                        self.metrics_sender_client.send(metrics_bundle)
-                    # Continue sending metrics to old web interface
-                    self.cfg['monitoring'][client_id] = metrics_bundle.get_v1_bundle()
-                    ret = ''
+        # call method
+        try:
+            if method == 'get_state' and 'uuid' in params:
+                params = dict(params)
+                client_id = params.pop('uuid')
+                ret = get_allocated_state(self.cfg, client_id, params)
+            elif method == 'get_state':
+                # splice in the pre-serialized state
+                cache = self.cfg['state_cache']
+                self.set_header('X-State-Generation', str(cache['generation']))
+                self.set_header('X-State-Age', str(int(get_state_age(self.cfg))))
+                if params:
+                    body = self.cfg['state_history'][-1][1].encoded(params)
+                else:
+                    self.set_header('ETag', cache['etag'])
+                    body = cache['body']
+                return (b'{"jsonrpc":"2.0","result":' + body +
+                        b',"id":' + json_encode(request_id).encode('utf-8') + b'}', False)
+            elif method == 'get_state_delta':
+                ret = get_state_delta(self.cfg, params.get('since_generation'),
+                                      params.get('epoch'), params.get('filters'),
+                                      params.get('uuid'))
+            elif method == 'get_monitoring_history':
+                ret = self.cfg['monitoring'].history(params['uuid'])
+            elif method == 'get_schedds':
+                ret = get_schedd_status(self.cfg)
+            elif method == 'get_leases':
+                if self.cfg['allocator'] is None:
+                    raise Exception('allocation is not enabled')
+                ret = self.cfg['allocator'].get_leases(self.cfg['monitoring'])
+            elif method == 'get_forecast':
+                ret = get_forecast(self.cfg, params.get('horizon', 3600),
+                                   params.get('step'), params.get('filters'))
+            elif method == 'monitoring':
+                client_id = params.pop('uuid')
+                metrics_bundle = get_metrics_bundle(client_id, params)
+                if self.cfg.get('collector') is not None:
+                    forward_monitoring(self.cfg, client_id, metrics_bundle)
                 else:
-                    self.json_error({'code':-32601, 'message':'Method not found'},
-                                    request_id=request_id)
-                    return
-            except:
-                self.json_error({'code':-32602, 'message':'Invalid params',
-                                 'data':str(ret)}, request_id=request_id)
+                    record_monitoring(self.cfg, client_id, metrics_bundle)
+                ret = ''
             else:
-                # return response
-                self.write({'jsonrpc':'2.0', 'result':ret, 'id':request_id})
+                return self.json_error({'code':-32601, 'message':'Method not found'},
+                                       request_id=request_id)
+        except Exception as e:
+            return self.json_error({'code':-32602, 'message':'Invalid params',
+                                    'data':str(e)}, request_id=request_id)
+        else:
+            # return response
+            return (json_encode({'jsonrpc':'2.0', 'result':ret,
+                                 'id':request_id}).encode('utf-8'), False)
 
-    def json_error(self, error, status=400, request_id=None):
+    def json_error(self, error, request_id=None):
         """Create a proper jsonrpc error message"""
-        self.set_status(status)
         if isinstance(error, Exception):
             error = str(error)
         logger.info('json_error: %r', error)
-        self.write({'jsonrpc':'2.0', 'error':error, 'id':request_id})
+        return (json_encode({'jsonrpc':'2.0', 'error':error,
+                             'id':request_id}).encode('utf-8'), True)
+
+
+class StateHandler(MyHandler):
+    """
+    Serve the pre-serialized state.
+
+    Supports conditional requests with ETag / If-None-Match, and gzip.
+    The state generation is sent in the X-State-Generation header.
+    """
+    def get(self):
+        cache = self.cfg['state_cache']
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.set_header('ETag', cache['etag'])
+        self.set_header('X-State-Generation', str(cache['generation']))
+        self.set_header('X-State-Age', str(int(get_state_age(self.cfg))))
+        self.set_header('Vary', 'Accept-Encoding')
+        if self.check_etag_header():
+            self.set_status(304)
+        elif 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(cache['gzip'])
+        else:
+            self.write(cache['body'])
+
+
+# longest time a client can wait for a state change in one request
+max_wait_timeout = 3600
+
+class WaitHandler(MyHandler):
+    """
+    Long-poll for state changes.
+
+    Waits until the state generation is past `generation` (or the epoch
+    differs), or `timeout` seconds have passed, then returns the current
+    epoch and generation. Waiting requests only cost a pending future on
+    the IOLoop. A client disconnecting ends its wait right away.
+    """
+    def initialize(self, cfg):
+        super(WaitHandler, self).initialize(cfg)
+        self.waiter = None
+        self.closed = False
+
+    def on_connection_close(self):
+        self.closed = True
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(False)
+
+    @tornado.gen.coroutine
+    def get(self):
+        try:
+            generation = int(self.get_argument('generation', 0))
+            timeout = min(float(self.get_argument('timeout', 300)), max_wait_timeout)
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'invalid generation or timeout')
+        epoch = self.get_argument('epoch', None)
+        deadline = IOLoop.current().time() + timeout
+        while (not self.closed and
+               epoch == self.cfg['state_epoch'] and
+               self.cfg['state_generation'] <= generation and
+               IOLoop.current().time() < deadline):
+            self.waiter = self.cfg['state_changed'].wait(timeout=deadline)
+            yield self.waiter
+        self.waiter = None
+        if self.closed:
+            return
+        changed = (epoch != self.cfg['state_epoch'] or
+                   self.cfg['state_generation'] > generation)
+        self.write({'epoch': self.cfg['state_epoch'],
+                    'generation': self.cfg['state_generation'],
+                    'changed': changed})
+
+
+class MetricsHandler(MyHandler):
+    """
+    Prometheus metrics of the server.
+
+    Includes the client metrics if the prometheus metrics sink is enabled.
+    With multiple worker processes, the jsonrpc metrics are those of the
+    worker answering the request.
+    """
+    def get(self):
+        state_rows.set(len(self.cfg['state']))
+        state_jobs.set(sum(row['count'] for row in self.cfg['state']))
+        state_raw_jobs.set(sum(row.get('raw_count', row['count']) for row in self.cfg['state']))
+        state_age.set(get_state_age(self.cfg))
+        state_generation.set(self.cfg['state_generation'])
+        if self.cfg['allocator'] is not None:
+            allocation_clients.set(len(self.cfg['allocator'].active(self.cfg['monitoring'])))
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(server_metrics.exposition())
+        if self.cfg.get('collector') is not None:
+            self.write(self.cfg['published_metrics'])
+        else:
+            self.write(collector_exposition(self.cfg))
+
+def collector_exposition(cfg):
+    """Prometheus metrics of the queue queries and client monitoring"""
+    monitoring_clients.set(len(cfg['monitoring']))
+    glidein_slots.set(len(cfg.get('glidein_slots') or []))
+    sender = cfg['metrics_sender_client']
+    metrics_queue_depth.set(sender.queue_depth() if sender is not None else 0)
+    ret = collector_metrics.exposition()
+    sink = sender.get_sink('prometheus') if sender is not None else None
+    if sink is not None:
+        ret += sink.exposition()
+    return ret
 
 
 class DefaultHandler(MyHandler):
@@ -197,17 +467,35 @@ class DefaultHandler(MyHandler):
   <div class="reqs">
     <div><span class="num">Num</span><span>CPUs</span><span>Memory</span><span>Disk</span><span>GPUs</span><span>OS</span></div>""")
         for row in self.cfg['state']:
-            self.write('<div><span class="num">'+str(row['count'])+'</span><span>'+str(row['cpus'])+'</span><span>'+str(row['memory'])+'</span><span>'+str(row['disk'])+'</span><span>'+str(row['gpus'])+'</span><span>'+str(row['os'])+'</span></div>')
+            num = str(row['count'])
+            if 'raw_count' in row:
+                num += ' of '+str(row['raw_count'])
+            self.write('<div><span class="num">'+num+'</span><span>'+str(row['cpus'])+'</span><span>'+str(row['memory'])+'</span><span>'+str(row['disk'])+'</span><span>'+str(row['gpus'])+'</span><span>'+str(row['os'])+'</span></div>')
+        self.write("""
+  </div>
+  <h2>Schedds</h2>
+  <div class="clients">
+    <div><span>Name</span><span>Last update</span><span>Status</span></div>""")
+        for name, info in sorted(get_schedd_status(self.cfg).items()):
+            if info['updated'] is None:
+                timestamp = 'never'
+            else:
+                timestamp = datetime.fromtimestamp(info['updated']).strftime('%Y-%m-%d %H:%M:%S')
+            status = 'stale: '+str(info['error']) if info['stale'] else 'ok'
+            self.write('<div><span class="uuid">'+str(name)+'</span><span class="date">'+timestamp+'</span><span class="stats">'+status+'<br>jobs: '+str(info['jobs'])+'</span></div>')
         self.write("""
   </div>
   <h2>Clients</h2>
   <div class="clients">
     <div><span>UUID</span><span>Last update</span><span>Stats</span></div>""")
+        self.cfg['monitoring'].expire()
         for uuid in self.cfg['monitoring']:
             try:
                 info = self.cfg['monitoring'][uuid]
                 timestamp = datetime.fromtimestamp(info['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
                 stats = '<br>'.join(str(k)+': '+str(info[k]) for k in info if k != 'timestamp')
+                trend = [str(h['glideins_running']) for h in self.cfg['monitoring'].history(uuid)[-12:]]
+                stats += '<br>running trend: '+' '.join(trend)
                 self.write('<div><span class="uuid">'+str(uuid)+'</span><span class="date">'+timestamp+'</span><span class="stats">'+stats+'</span></div>')
             except Exception:
                 logging.info('error in monitoring display: %r %r',uuid,self.cfg['monitoring'][uuid],exc_info=True)
@@ -224,11 +512,17 @@ class server:
         handler_args = {'cfg':self.cfg}
         self.application = tornado.web.Application([
             (r"/jsonrpc", JSONRPCHandler, handler_args),
+            (r"/state", StateHandler, handler_args),
+            (r"/wait", WaitHandler, handler_args),
+            (r"/metrics", MetricsHandler, handler_args),
             (r"/.*", DefaultHandler, handler_args),
         ])
-    def start(self):
+    def start(self, sockets=None):
         self.http_server = HTTPServer(self.application, xheaders=True)
-        self.http_server.listen(self.cfg["options"].port)
+        if sockets is not None:
+            self.http_server.add_sockets(sockets)
+        else:
+            self.http_server.listen(self.cfg["options"].port)
         IOLoop.current().start()
     def stop(self):
         self.http_server.stop()
@@ -239,6 +533,987 @@ def get_condor_version():
      out = p.communicate()[0]
      return out.decode().split(" ")[1]
 
+# job attributes needed to build the state, in condor_q output order
+condor_q_attrs = ['RequestCPUs', 'RequestMemory', 'RequestDisk', 'RequestGPUs', 'Requirements']
+
+# fields of a state tuple, and the columns of state rows
+state_columns = ('cpus', 'memory', 'disk', 'gpus', 'os', 'os_arch',
+                 'gpu_capability', 'gpu_names', 'site', 'cvmfs')
+
+def parse_job(cpus, memory, disk, gpus, reqs):
+    """
+    Convert the resource request of an idle job into a state tuple.
+
+    Undefined values (None or 'undefined') are replaced with defaults.
+    What the job needs besides resources comes from its Requirements,
+    see `pyglidein.requirements`.
+
+    Args:
+        cpus: RequestCPUs
+        memory: RequestMemory in MB
+        disk: RequestDisk in KB
+        gpus: RequestGPUs
+        reqs: Requirements expression as a string
+
+    Returns:
+        tuple: values of `state_columns`
+    """
+    def undefined(v):
+        return v is None or v == 'undefined'
+    cpus = 1 if undefined(cpus) else int(cpus)
+    memory = 2000 if undefined(memory) else int(memory)
+    disk = 10000 if undefined(disk) else int(disk)/1000 # convert to MB
+    gpus = 0 if undefined(gpus) else int(gpus)
+    return (cpus, memory, disk, gpus) + tuple(analyzer.analyze(reqs))
+
+def parse_condor_q_line(line):
+    """Parse one line of `condor_q -autoformat` output into a state tuple"""
+    return parse_job(*line.split(', ',4))
+
+def state_from_counter(counter, raw=None):
+    """
+    Convert a Counter of state tuples into the state list served to clients.
+
+    Args:
+        counter: Counter of state tuple -> number of jobs
+        raw: Counter of state tuple -> number of jobs before subtracting
+             glideins on their way, added to the rows as `raw_count`
+    """
+    ret = []
+    for s, count in counter.items():
+        row = dict(zip(state_columns, s))
+        row['count'] = count
+        if raw is not None:
+            row['raw_count'] = raw[s]
+        ret.append(row)
+    return ret
+
+def set_state(cfg, state, updated=None, generation=None):
+    """
+    Publish a new state.
+
+    The state is serialized and compressed once here, instead of on every
+    client request. The generation number only changes when the state does.
+
+    Args:
+        cfg: the global config
+        state: the state list
+        updated: when the state was refreshed (default: now)
+        generation: generation of the state (default: the next one)
+    """
+    cfg['state_updated'] = time.time() if updated is None else updated
+    state = sorted(state, key=json_encode)
+    body = json_encode(state).encode('utf-8')
+    if cfg['state_cache'] is not None and cfg['state_cache']['body'] == body:
+        return
+    compressed = BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+        f.write(body)
+    cfg['state'] = state
+    if generation is None:
+        generation = cfg['state_generation'] + 1
+    cfg['state_generation'] = generation
+    cfg['state_history'].append((cfg['state_generation'], StateIndex(state)))
+    cfg['state_cache'] = {
+        'generation': cfg['state_generation'],
+        'etag': '"%s"' % hashlib.sha1(body).hexdigest(),
+        'body': body,
+        'gzip': compressed.getvalue(),
+    }
+    cfg['state_changed'].notify_all()
+
+def get_state_age(cfg):
+    """Seconds since the state was last refreshed"""
+    return time.time() - cfg['state_updated']
+
+# fields of a state row that are values rather than part of its identity
+state_value_fields = ('count', 'raw_count', 'total_count')
+
+def state_row_key(row):
+    """Identity of a state row, used to match rows between generations"""
+    return tuple(sorted((k, v) for k, v in row.items() if k not in state_value_fields))
+
+# resources that can be filtered on with min_<resource> and max_<resource>
+state_filter_resources = ('cpus', 'memory', 'disk', 'gpus')
+# filters on a single value, matching rows listing it in a comma separated
+# column, or not constraining the column
+state_list_filters = ('os_arch', 'site')
+state_filters = set(['gpu_only', 'cpu_only', 'os', 'cvmfs'] + list(state_list_filters) +
+                    [prefix+r for prefix in ('min_', 'max_') for r in state_filter_resources])
+
+class StateIndex(object):
+    """
+    Precomputed lookups on one state generation.
+
+    Rows are split into GPU and CPU rows, and filtered results are
+    memoized per filter, since many clients share the same limits.
+    """
+    max_cached_filters = 1000
+
+    def __init__(self, state):
+        self.state = state
+        self.rows = dict((state_row_key(row), row) for row in state)
+        self.gpu_rows = [row for row in state if row['gpus']]
+        self.cpu_rows = [row for row in state if not row['gpus']]
+        self.cache = {}
+
+    @staticmethod
+    def filter_key(filters):
+        """Validate filters and make them hashable"""
+        for name in filters:
+            if name not in state_filters:
+                raise Exception('unknown state filter %r' % name)
+        ret = []
+        for name, value in sorted(filters.items()):
+            if name == 'os':
+                value = tuple(sorted(value))
+            ret.append((name, value))
+        return tuple(ret)
+
+    def filter(self, filters=None):
+        """
+        Get the rows a client can use.
+
+        Args:
+            filters: dict with any of min_<resource>, max_<resource>,
+                     gpu_only, cpu_only, os (list of OS values; rows
+                     without an OS requirement always match), os_arch
+                     and site (the OS_ARCH and GLIDEIN_Site of the
+                     client's glideins), and cvmfs (False if the
+                     glideins have no CVMFS)
+
+        Returns:
+            dict: row key -> row
+        """
+        if not filters:
+            return self.rows
+        key = self.filter_key(filters)
+        if key in self.cache:
+            return self.cache[key][0]
+        if filters.get('gpu_only'):
+            rows = self.gpu_rows
+        elif filters.get('cpu_only'):
+            rows = self.cpu_rows
+        else:
+            rows = self.state
+        bounds = []
+        for r in state_filter_resources:
+            if 'min_'+r in filters:
+                bounds.append((r, filters['min_'+r], None))
+            if 'max_'+r in filters:
+                bounds.append((r, None, filters['max_'+r]))
+        ret = {}
+        for row in rows:
+            if 'os' in filters and row['os'] is not None and row['os'] not in filters['os']:
+                continue
+            if 'cvmfs' in filters and not filters['cvmfs'] and row.get('cvmfs'):
+                continue
+            if any(name in filters and row.get(name) is not None and
+                   filters[name] not in row[name].split(',')
+                   for name in state_list_filters):
+                continue
+            for r, low, high in bounds:
+                if (low is not None and row[r] < low) or (high is not None and row[r] > high):
+                    break
+            else:
+                ret[state_row_key(row)] = row
+        if len(self.cache) < self.max_cached_filters:
+            self.cache[key] = (ret, None)
+        return ret
+
+    def encoded(self, filters):
+        """Get the json encoded list of rows matching the filters"""
+        key = self.filter_key(filters)
+        if key in self.cache and self.cache[key][1] is not None:
+            return self.cache[key][1]
+        rows = self.filter(filters)
+        ret = json_encode([row for row in self.state if state_row_key(row) in rows]).encode('utf-8')
+        if len(self.cache) < self.max_cached_filters:
+            self.cache[key] = (rows, ret)
+        return ret
+
+def get_state_delta(cfg, since_generation=None, epoch=None, filters=None, client_id=None):
+    """
+    Get the changes to the state since a previous generation.
+
+    A full snapshot is returned if the generation is no longer in the
+    history, or comes from another server instance (different epoch).
+    With `--allocate`, clients sending their uuid always get a full
+    snapshot of their share, as shares change with the other clients.
+
+    Args:
+        cfg: the global config
+        since_generation: state generation the client has
+        epoch: server epoch the generation belongs to
+        filters: only include rows matching these (see StateIndex.filter)
+        client_id: uuid of the client, for its share of the state
+
+    Returns:
+        dict: with `epoch`, `generation`, `age` (seconds since the state
+              was refreshed) and `full`, then either the whole `state` or
+              the `changed` and `removed` rows
+    """
+    generation, index = cfg['state_history'][-1]
+    ret = {'epoch': cfg['state_epoch'], 'generation': generation,
+           'age': get_state_age(cfg)}
+    if client_id is not None and cfg['allocator'] is not None:
+        ret['full'] = True
+        ret['state'] = get_allocated_state(cfg, client_id, filters)
+        return ret
+    current = index.filter(filters)
+    old = None
+    if epoch == cfg['state_epoch']:
+        for gen, old_index in cfg['state_history']:
+            if gen == since_generation:
+                old = old_index.filter(filters)
+                break
+    if old is None:
+        ret['full'] = True
+        ret['state'] = list(current.values())
+    else:
+        ret['full'] = False
+        ret['changed'] = [row for key, row in current.items()
+                          if key not in old or old[key] != row]
+        ret['removed'] = [dict(key) for key in old if key not in current]
+    return ret
+
+def get_allocated_state(cfg, client_id, filters=None):
+    """
+    Get the share of the state of a client, with `--allocate`.
+
+    Without allocation, this is the state matching the filters. The
+    glideins the client reported as idle are taken out of its share,
+    unless `--net-demand` already took them out of the state.
+
+    Args:
+        cfg: the global config
+        client_id: uuid of the client
+        filters: state filters of the client (see StateIndex.filter)
+
+    Returns:
+        list: state rows
+    """
+    index = cfg['state_history'][-1][1]
+    # validates the filters before they are recorded
+    rows = index.filter(filters)
+    allocator = cfg['allocator']
+    if allocator is None:
+        return [row for row in index.state if state_row_key(row) in rows]
+    if allocator.touch(client_id, filters) and cfg.get('collector') is not None:
+        forward_allocation(cfg, client_id, filters)
+    options = cfg['options']
+    pending = 0
+    if not options.net_demand and client_id in cfg['monitoring']:
+        try:
+            idle = int(cfg['monitoring'][client_id].get('glideins_idle', 0))
+            pending = idle * options.pending_glidein_jobs
+        except (TypeError, ValueError):
+            pass
+    return allocator.allocate(client_id, index, cfg['monitoring'], pending)
+
+def record_history(cfg):
+    """Record the current state in the demand history"""
+    values = dict((state_row_key(row), row.get('raw_count', row['count']))
+                  for row in cfg['state'])
+    cfg['demand_history'].record(cfg['state_updated'], values)
+
+# limits of get_forecast
+max_forecast_horizon = 86400
+max_forecast_steps = 1000
+
+def get_forecast(cfg, horizon=3600, step=None, filters=None):
+    """
+    Forecast the demand per bucket, from the demand history.
+
+    Forecasts are memoized until the next sample is recorded.
+
+    Args:
+        cfg: the global config
+        horizon: seconds ahead to forecast
+        step: seconds between forecast points (default: the resolution
+              of the finest history tier)
+        filters: only include buckets matching these (see StateIndex.filter)
+
+    Returns:
+        dict: `time` of the forecast, `times` of the forecast points, and
+              `buckets`, the state columns of each bucket with its
+              `current` demand, `trend` (jobs per hour), `seasonal` (True
+              if a daily profile is used) and `forecast`, the number of
+              jobs at each of `times`
+    """
+    history = cfg['demand_history']
+    if step is None:
+        step = history.tiers[0].resolution
+    if not 0 < horizon <= max_forecast_horizon:
+        raise Exception('horizon must be between 0 and %d seconds' % max_forecast_horizon)
+    if step <= 0 or horizon / step > max_forecast_steps:
+        raise Exception('step must be positive, with at most %d steps' % max_forecast_steps)
+    cache = cfg['forecast_cache']
+    if cache.get('last') != history.last:
+        cache.clear()
+        cache['last'] = history.last
+    key = (horizon, step, StateIndex.filter_key(filters or {}))
+    if key in cache:
+        return cache[key]
+    now = time.time() if history.last is None else history.last
+    times = [now + step*(i+1) for i in range(int(horizon // step))]
+    rows = StateIndex([dict(bucket) for bucket in history.buckets()]).filter(filters)
+    buckets = []
+    for bucket, row in rows.items():
+        row = dict(row)
+        row.update(history.forecast(bucket, now, times))
+        buckets.append(row)
+    ret = {'time': now, 'times': times, 'buckets': sorted(buckets, key=json_encode)}
+    cache[key] = ret
+    return ret
+
+def make_state(counter, quantize_config, slots=None, pending_jobs=None):
+    """
+    Quantize the Counter of state tuples and convert it to the state list.
+
+    Args:
+        counter: Counter of state tuple -> number of jobs
+        quantize_config: the quantize config dict
+        slots: unclaimed glidein slots, for net demand
+        pending_jobs: jobs pending glideins will run, None without net demand
+
+    Returns:
+        list: the state
+    """
+    counter = quantize(counter, quantize_config)
+    if pending_jobs is None:
+        return state_from_counter(counter)
+    net = net_demand(counter, slots or [], pending_jobs)
+    return state_from_counter(net, raw=counter)
+
+@tornado.gen.coroutine
+def build_state(cfg, counter):
+    """
+    Build the state from a Counter of state tuples, in the executor.
+
+    With `--net-demand`, jobs that unclaimed glidein slots or pending
+    glideins will run are subtracted.
+    """
+    pending_jobs = None
+    if cfg['options'].net_demand:
+        pending_jobs = get_pending_jobs(cfg)
+    state = yield IOLoop.current().run_in_executor(
+            cfg['executor'], make_state, counter, cfg['config'].get('quantize', {}),
+            cfg.get('glidein_slots'), pending_jobs)
+    raise tornado.gen.Return(state)
+
+def get_pending_jobs(cfg):
+    """Number of jobs the glideins that clients reported as idle will run"""
+    options = cfg['options']
+    idle = 0
+    for info in cfg['monitoring'].recent(options.pending_glidein_age):
+        try:
+            idle += int(info.get('glideins_idle', 0))
+        except (TypeError, ValueError):
+            pass
+    return idle * options.pending_glidein_jobs
+
+def get_job_constraint(options):
+    """Build the job constraint used by the python bindings query"""
+    constraint = 'JobStatus =?= 1'
+    if options.constraint:
+        constraint += ' && (%s)' % options.constraint
+    if options.user:
+        constraint += ' && Owner =?= "%s"' % options.user
+    return constraint
+
+def job_ad_values(ad):
+    """
+    Get the state attributes out of a job ClassAd.
+
+    Resource requests are evaluated like condor_q -autoformat does,
+    the Requirements expression is kept as its string form.
+    """
+    import classad
+    ret = []
+    for attr in condor_q_attrs[:-1]:
+        val = None
+        if attr in ad:
+            val = ad.eval(attr)
+            if isinstance(val, classad.Value):
+                # undefined or error
+                val = None
+        ret.append(val)
+    ret.append(str(ad['Requirements']) if 'Requirements' in ad else '')
+    return ret
+
+def locate_schedds():
+    """Get the ads of all schedds in the pool from the collector"""
+    import htcondor
+    return htcondor.Collector().locateAll(htcondor.DaemonTypes.Schedd)
+
+def query_schedd(schedd_ad, options):
+    """
+    Query a single schedd with the HTCondor python bindings.
+
+    This is blocking, so should be run in an executor.
+
+    With `options.aggregate`, the schedd groups its jobs into autoclusters
+    and returns one ad per autocluster with the number of jobs in it.
+
+    Args:
+        schedd_ad: the schedd ad from the collector
+        options: server options
+
+    Returns:
+        Counter: state tuple -> number of idle jobs
+    """
+    import htcondor
+    constraint = get_job_constraint(options)
+    projection = list(condor_q_attrs)
+    query_opts = htcondor.QueryOpts.Default
+    if options.aggregate:
+        projection.append('JobCount')
+        query_opts = htcondor.QueryOpts.AutoCluster
+    counter = Counter()
+    parsed = dropped = 0
+    schedd = htcondor.Schedd(schedd_ad)
+    with condor_parse_duration.time(backend='bindings'):
+        for ad in schedd.xquery(requirements=constraint, projection=projection,
+                                opts=query_opts):
+            try:
+                count = int(ad.eval('JobCount')) if options.aggregate else 1
+                counter[parse_job(*job_ad_values(ad))] += count
+                parsed += 1
+            except Exception:
+                logger.info('error parsing job ad', exc_info=True)
+                dropped += 1
+    condor_jobs_parsed.inc(parsed, backend='bindings')
+    condor_jobs_dropped.inc(dropped, backend='bindings')
+    return counter
+
+@tornado.gen.coroutine
+def condor_q_bindings(cfg):
+    """
+    Query all schedds in the pool concurrently with the python bindings.
+
+    Each schedd query gets its own timeout. A schedd that fails or times
+    out keeps its last good result, marked as stale in `cfg['schedds']`,
+    so one slow schedd does not hold up the others. If no schedd could be
+    queried, an exception is raised, so condor_q falls back to the CLI.
+
+    Args:
+        cfg: the global config
+
+    Returns:
+        Counter: state tuple -> number of idle jobs, merged over all schedds
+    """
+    options = cfg['options']
+    schedd_ads = yield IOLoop.current().run_in_executor(cfg['executor'], locate_schedds)
+    slots = cfg['schedd_slots']
+
+    @tornado.gen.coroutine
+    def query(schedd_ad):
+        name = str(schedd_ad.get('Name'))
+        schedd = cfg['schedds'].setdefault(name, {'counter': None, 'updated': None,
+                                                  'error': None})
+        tracker = cfg['tracker']
+        if tracker is not None and tracker.schedd_name == name:
+            func = tracker.resync
+        else:
+            func = partial(query_schedd, schedd_ad, options)
+        # wait for a free query thread first, so the timeout only counts
+        # the query itself
+        try:
+            yield slots.acquire(timedelta(seconds=options.delay))
+        except tornado.gen.TimeoutError:
+            logger.warn('no free query thread for schedd %s', name)
+            schedd['error'] = 'timeout'
+            return
+        future = IOLoop.current().run_in_executor(cfg['schedd_executor'], func)
+        # the thread is only free again once the schedd answers, even after
+        # a timeout, so hung schedds cannot pile up queries in the pool
+        future.add_done_callback(lambda f: slots.release())
+        try:
+            counter = yield tornado.gen.with_timeout(
+                    timedelta(seconds=options.schedd_timeout), future)
+        except tornado.gen.TimeoutError:
+            logger.warn('timeout querying schedd %s', name)
+            schedd['error'] = 'timeout'
+        except Exception as e:
+            logger.warn('error querying schedd %s', name, exc_info=True)
+            schedd['error'] = str(e)
+        else:
+            schedd['counter'] = counter
+            schedd['updated'] = time.time()
+            schedd['error'] = None
+
+    yield [query(ad) for ad in schedd_ads]
+    if not any(cfg['schedds'][str(ad.get('Name'))]['error'] is None for ad in schedd_ads):
+        raise Exception('no schedd could be queried')
+
+    # forget schedds that left the pool
+    names = set(str(ad.get('Name')) for ad in schedd_ads)
+    for name in list(cfg['schedds']):
+        if name not in names:
+            del cfg['schedds'][name]
+
+    raise tornado.gen.Return(merge_schedds(cfg))
+
+def merge_schedds(cfg):
+    """Merge the per-schedd Counters into one"""
+    counter = Counter()
+    for schedd in cfg['schedds'].values():
+        if schedd['counter']:
+            counter.update(schedd['counter'])
+    return counter
+
+class JobEventTracker(object):
+    """
+    Incrementally track the idle jobs of one schedd from its event log.
+
+    The schedd's global event log (the EVENT_LOG knob) is followed, and
+    submits, executes, evictions, holds, releases and removals are applied
+    to a Counter of idle jobs keyed by state tuple. Only newly submitted or
+    requeued jobs are looked up in the schedd, so an update costs
+    O(changes) instead of O(queue). A full resync rebuilds everything and
+    should still be run periodically.
+    """
+    def __init__(self, event_log, options, schedd_name=None):
+        """
+        Args:
+            event_log: path to the schedd event log
+            options: server options
+            schedd_name: name of the schedd (default: local schedd)
+        """
+        import htcondor
+        self.event_log = event_log
+        self.options = options
+        if schedd_name is None:
+            schedd_ad = htcondor.Collector().locate(htcondor.DaemonTypes.Schedd)
+            schedd_name = str(schedd_ad.get('Name'))
+        else:
+            schedd_ad = htcondor.Collector().locate(htcondor.DaemonTypes.Schedd,
+                                                    schedd_name)
+        self.schedd_name = schedd_name
+        self.schedd = htcondor.Schedd(schedd_ad)
+        self.jobs = {} # (cluster, proc) -> state tuple of idle jobs
+        self.counter = Counter()
+        self.lock = threading.Lock()
+        self.log = None
+
+        event_type = htcondor.JobEventType
+        self.idle_events = set([event_type.SUBMIT, event_type.JOB_EVICTED,
+                                event_type.JOB_RELEASED,
+                                event_type.JOB_RECONNECT_FAILED,
+                                event_type.SHADOW_EXCEPTION])
+        self.gone_events = set([event_type.EXECUTE, event_type.JOB_HELD,
+                                event_type.JOB_ABORTED, event_type.JOB_TERMINATED])
+
+    def _set(self, job_id, key):
+        self._remove(job_id)
+        self.jobs[job_id] = key
+        self.counter[key] += 1
+
+    def _remove(self, job_id):
+        key = self.jobs.pop(job_id, None)
+        if key is not None:
+            self.counter[key] -= 1
+            if self.counter[key] <= 0:
+                del self.counter[key]
+
+    def _query(self, constraint):
+        """Query idle jobs matching the constraint, returning job id -> state tuple"""
+        ret = {}
+        constraint = '(%s) && (%s)' % (get_job_constraint(self.options), constraint)
+        projection = ['ClusterId', 'ProcId'] + condor_q_attrs
+        for ad in self.schedd.xquery(requirements=constraint, projection=projection):
+            try:
+                ret[(ad['ClusterId'], ad['ProcId'])] = parse_job(*job_ad_values(ad))
+            except Exception:
+                logger.info('error parsing job ad', exc_info=True)
+        return ret
+
+    def _read_events(self):
+        """Read all new events from the event log, without waiting"""
+        import htcondor
+        if self.log is None:
+            self.log = htcondor.JobEventLog(self.event_log)
+        return list(self.log.events(stop_after=0))
+
+    def resync(self):
+        """
+        Rebuild the idle jobs from a full schedd query.
+
+        Returns:
+            Counter: state tuple -> number of idle jobs
+        """
+        with self.lock:
+            # skip pending events, the query below supersedes them
+            self._read_events()
+            self.jobs = {}
+            self.counter = Counter()
+            for job_id, key in self._query('true').items():
+                self._set(job_id, key)
+            return Counter(self.counter)
+
+    def update(self):
+        """
+        Apply new events from the event log.
+
+        Returns:
+            Counter: state tuple -> number of idle jobs, or None if unchanged
+        """
+        with self.lock:
+            events = self._read_events()
+            if not events:
+                return None
+            lookup = {}
+            for event in events:
+                job_id = (event.cluster, event.proc)
+                if event.type in self.idle_events:
+                    lookup[job_id] = True
+                elif event.type in self.gone_events:
+                    lookup.pop(job_id, None)
+                    self._remove(job_id)
+            if lookup:
+                clusters = set(cluster for cluster, proc in lookup)
+                constraint = ' || '.join('ClusterId == %d' % c for c in sorted(clusters))
+                idle = self._query(constraint)
+                for job_id in lookup:
+                    if job_id in idle:
+                        self._set(job_id, idle[job_id])
+                    else:
+                        self._remove(job_id)
+            return Counter(self.counter)
+
+@tornado.gen.coroutine
+def track_events(cfg):
+    """Apply new events from the schedd event log to the state"""
+    tracker = cfg['tracker']
+    try:
+        counter = yield IOLoop.current().run_in_executor(cfg['executor'],
+                                                         tracker.update)
+        schedd = cfg['schedds'].get(tracker.schedd_name)
+        if counter is not None and schedd is not None and schedd['updated'] is not None:
+            schedd['counter'] = counter
+            schedd['updated'] = time.time()
+            state = yield build_state(cfg, merge_schedds(cfg))
+            set_state(cfg, state)
+            record_history(cfg)
+            logger.debug('state is updated from the event log to %r', cfg['state'])
+    except Exception:
+        logger.warn('error reading the event log', exc_info=True)
+    finally:
+        IOLoop.current().call_later(cfg['options'].event_poll,
+                                    partial(track_events, cfg))
+
+def snapshot(cfg):
+    """Save the state, monitoring and demand history to the snapshot store"""
+    store = cfg['snapshot_store']
+    try:
+        store.save_state(cfg['state'], cfg['state_updated'])
+        store.save_monitoring(cfg['monitoring'])
+        store.save_history(cfg['demand_history'])
+        if time.time() - store.last_compact > cfg['options'].snapshot_compact:
+            store.compact(cfg['options'].monitoring_ttl)
+    except Exception:
+        logger.warn('error saving snapshot', exc_info=True)
+    finally:
+        IOLoop.current().call_later(cfg['options'].snapshot_interval,
+                                    partial(snapshot, cfg))
+
+def load_snapshot(cfg):
+    """Load the last state, monitoring and demand history from the snapshot store"""
+    state, timestamp, monitoring = cfg['snapshot_store'].load()
+    if state is not None:
+        logger.info('loaded state from snapshot, %d seconds old', time.time()-timestamp)
+        set_state(cfg, state, updated=timestamp)
+    cfg['monitoring'].load(monitoring)
+    cfg['snapshot_store'].load_history(cfg['demand_history'])
+
+def get_schedd_status(cfg):
+    """Per-schedd query status, showing how stale each result is"""
+    now = time.time()
+    if cfg.get('collector') is not None:
+        # published by the collector process
+        ret = cfg['published_schedds']
+        for info in ret.values():
+            if info['updated'] is not None:
+                info['age'] = now - info['updated']
+        return ret
+    ret = {}
+    for name, schedd in cfg['schedds'].items():
+        ret[name] = {
+            'updated': schedd['updated'],
+            'age': None if schedd['updated'] is None else now - schedd['updated'],
+            'stale': schedd['error'] is not None,
+            'error': schedd['error'],
+            'jobs': sum(schedd['counter'].values()) if schedd['counter'] else 0,
+        }
+    return ret
+
+def get_metrics_bundle(client_id, params):
+    """Convert the params of a monitoring call to a ClientMetricsBundle"""
+    client_id_clean = re.sub(r'\W+', '', client_id)
+    # For Clients > 1.1
+    if 'timestamp' in params and 'metrics' in params:
+        return ClientMetricsBundle(client_id_clean,
+                                   timestamp=params['timestamp'],
+                                   metrics=params['metrics'])
+    # For Clients < 1.1
+    else:
+        return ClientMetricsBundle(client_id_clean, metrics=params)
+
+def record_monitoring(cfg, client_id, metrics_bundle):
+    """Store a monitoring report and forward it to the metrics sinks"""
+    if cfg['metrics_sender_client'] is not None:
+        cfg['metrics_sender_client'].send(metrics_bundle)
+    # Continue sending metrics to old web interface
+    cfg['monitoring'][client_id] = metrics_bundle.get_v1_bundle()
+
+def forward_monitoring(cfg, client_id, metrics_bundle):
+    """Send a monitoring report from a worker process to the collector"""
+    msg = {'uuid': client_id, 'bundle': metrics_bundle.get_bundle()}
+    cfg['collector'].write(json_encode(msg).encode('utf-8') + b'\n')
+
+def forward_allocation(cfg, client_id, filters):
+    """Send a new allocation client from a worker process to the collector"""
+    msg = {'uuid': client_id, 'filters': filters or {}}
+    cfg['collector'].write(json_encode(msg).encode('utf-8') + b'\n')
+
+@tornado.gen.coroutine
+def read_forwarded(cfg, stream):
+    """Record monitoring reports and allocation clients forwarded by a worker process"""
+    while True:
+        try:
+            line = yield stream.read_until(b'\n')
+        except StreamClosedError:
+            logger.error('worker process went away')
+            return
+        try:
+            msg = json_decode(line)
+            if 'filters' in msg:
+                if cfg['allocator'] is not None:
+                    cfg['allocator'].touch(msg['uuid'], msg['filters'])
+                continue
+            bundle = msg['bundle']
+            record_monitoring(cfg, msg['uuid'], get_metrics_bundle(msg['uuid'], bundle))
+        except Exception:
+            logger.warn('error in forwarded monitoring', exc_info=True)
+
+@tornado.gen.coroutine
+def publish_state(cfg):
+    """Publish the state to the worker processes whenever it is refreshed"""
+    last = None
+    while True:
+        key = (cfg['state_epoch'], cfg['state_generation'], cfg['state_updated'])
+        if key != last:
+            doc = {'epoch': cfg['state_epoch'], 'generation': cfg['state_generation'],
+                   'updated': cfg['state_updated'], 'state': cfg['state'],
+                   'schedds': get_schedd_status(cfg),
+                   'history': cfg['demand_history'].last == cfg['state_updated']}
+            cfg['shared_state'].publish(json_encode(doc).encode('utf-8'))
+            last = key
+        yield cfg['state_changed'].wait(timeout=timedelta(seconds=1))
+
+def publish_monitoring(cfg):
+    """Publish the client monitoring and collector metrics to the worker processes"""
+    try:
+        doc = {'monitoring': cfg['monitoring'].dump(),
+               'metrics': collector_exposition(cfg)}
+        if cfg['allocator'] is not None:
+            cfg['allocator'].expire(cfg['monitoring'])
+            doc['allocation'] = cfg['allocator'].dump()
+        cfg['shared_monitoring'].publish(json_encode(doc).encode('utf-8'))
+    except Exception:
+        logger.warn('error publishing monitoring', exc_info=True)
+    finally:
+        IOLoop.current().call_later(cfg['options'].monitoring_publish,
+                                    partial(publish_monitoring, cfg))
+
+def poll_shared(cfg, state_reader, monitoring_reader):
+    """Apply new versions published by the collector, in a worker process"""
+    try:
+        data = state_reader.read()
+        if data is not None:
+            doc = json_decode(data)
+            if doc['epoch'] != cfg['state_epoch']:
+                cfg['state_epoch'] = doc['epoch']
+                cfg['state_history'].clear()
+            cfg['published_schedds'] = doc['schedds']
+            set_state(cfg, doc['state'], updated=doc['updated'],
+                      generation=doc['generation'])
+            if doc.get('history'):
+                # a refresh the collector recorded in its demand history
+                record_history(cfg)
+        data = monitoring_reader.read()
+        if data is not None:
+            doc = json_decode(data)
+            cfg['monitoring'].restore(doc['monitoring'])
+            cfg['published_metrics'] = doc['metrics']
+            if cfg['allocator'] is not None and 'allocation' in doc:
+                cfg['allocator'].restore(doc['allocation'])
+    except Exception:
+        logger.warn('error reading shared state', exc_info=True)
+
+def run_worker(cfg, sockets, conn):
+    """
+    Serve requests in a worker process.
+
+    The state comes from the collector process through the shared files,
+    and monitoring reports are forwarded to it over `conn`.
+
+    Args:
+        cfg: the global config
+        sockets: listening sockets to serve from
+        conn: socket connected to the collector
+    """
+    options = cfg['options']
+    cfg['collector'] = IOStream(conn)
+    cfg['metrics_sender_client'] = None
+    cfg['published_schedds'] = {}
+    cfg['published_metrics'] = ''
+    if options.snapshot:
+        # the collector keeps saving it, the workers record their own
+        store = SnapshotStore(options.snapshot)
+        store.load_history(cfg['demand_history'])
+        store.close()
+    state_reader = SharedStateReader(os.path.join(options.shared_dir, 'state'))
+    monitoring_reader = SharedStateReader(os.path.join(options.shared_dir, 'monitoring'))
+    poll_shared(cfg, state_reader, monitoring_reader)
+    PeriodicCallback(partial(poll_shared, cfg, state_reader, monitoring_reader),
+                     options.worker_poll*1000).start()
+
+    # exit with the collector
+    def collector_gone(future):
+        logger.error('collector process went away')
+        IOLoop.current().stop()
+    cfg['collector'].read_until_close().add_done_callback(collector_gone)
+
+    s = server(cfg)
+    s.start(sockets)
+
+def start_workers(cfg):
+    """
+    Fork the worker processes, turning this process into the collector.
+
+    Must be called before the IOLoop or any threads are started.
+
+    Returns:
+        list: (pid, socket connected to the worker) for each worker
+    """
+    options = cfg['options']
+    temp_dir = not options.shared_dir
+    if temp_dir:
+        options.shared_dir = tempfile.mkdtemp(prefix='pyglidein_server_')
+    cfg['shared_state'] = SharedStateWriter(os.path.join(options.shared_dir, 'state'))
+    cfg['shared_monitoring'] = SharedStateWriter(os.path.join(options.shared_dir, 'monitoring'))
+    cfg['shared_state'].publish(json_encode({
+            'epoch': cfg['state_epoch'], 'generation': cfg['state_generation'],
+            'updated': cfg['state_updated'], 'state': cfg['state'], 'schedds': {}}).encode('utf-8'))
+    cfg['shared_monitoring'].publish(json_encode({'monitoring': [],
+                                                  'metrics': ''}).encode('utf-8'))
+    sockets = bind_sockets(options.port)
+    workers = []
+    for i in range(options.workers):
+        parent_conn, child_conn = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_conn.close()
+            for _, conn in workers:
+                conn.close()
+            try:
+                run_worker(cfg, sockets, child_conn)
+            except Exception:
+                logger.error('error in worker process', exc_info=True)
+            finally:
+                os._exit(0)
+        child_conn.close()
+        workers.append((pid, parent_conn))
+    for s in sockets:
+        s.close()
+    logger.info('started %d worker processes', options.workers)
+
+    def stop_workers():
+        for pid, conn in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        if temp_dir:
+            shutil.rmtree(options.shared_dir, ignore_errors=True)
+    atexit.register(stop_workers)
+    # exit normally on SIGTERM, so the workers are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    return workers
+
+def parse_condor_q_output(output, aggregate):
+    """
+    Parse the condor_q output, in the executor.
+
+    Args:
+        output: condor_q output
+        aggregate: True if the lines are prefixed with a job count
+
+    Returns:
+        Counter: state tuple -> number of idle jobs
+    """
+    counter = Counter()
+    parsed = dropped = 0
+    with condor_parse_duration.time(backend='cli'):
+        for line in output.splitlines():
+            logger.debug(line)
+            try:
+                count = 1
+                if aggregate:
+                    count, line = line.split(', ',1)
+                    count = int(count)
+                counter[parse_condor_q_line(line)] += count
+                parsed += 1
+            except Exception:
+                logger.info('error parsing line', exc_info=True)
+                dropped += 1
+                continue
+    condor_jobs_parsed.inc(parsed, backend='cli')
+    condor_jobs_dropped.inc(dropped, backend='cli')
+    return counter
+
+@tornado.gen.coroutine
+def condor_q_cli(cfg):
+    """
+    Query the pool with the condor_q command line tool.
+
+    With `options.aggregate`, condor_q prints one line per autocluster,
+    prefixed with the number of jobs in it. The output is parsed in the
+    executor, since analyzing Requirements is CPU bound.
+
+    Args:
+        cfg: the global config
+
+    Returns:
+        Counter: state tuple -> number of idle jobs
+    """
+    options = cfg['options']
+    cmd = ['condor_q', '-global']
+    if options.aggregate:
+        cmd += ['-autocluster', '-autoformat:,', 'JobCount']
+    else:
+        cmd += ['-autoformat:,']
+    cmd += ['RequestCPUs', 'RequestMemory', 'RequestDisk', 'RequestGPUs',
+            '-format', '"%s"', 'Requirements', '-constraint', '"JobStatus =?= 1"']
+    if options.constraint:
+        cmd += ['-constraint', options.constraint]
+    if options.user:
+        cmd += [options.user]
+    if (distutils.version.LooseVersion(get_condor_version()) >=
+         distutils.version.LooseVersion("8.5.2") and
+         not options.user):
+        cmd += ["-allusers"]
+
+    cmd = ' '.join(cmd)
+    logger.debug(cmd)
+    p = Subprocess(cmd, shell=True, stdout=Subprocess.STREAM)
+    output = yield p.stdout.read_until_close()
+    counter = yield IOLoop.current().run_in_executor(
+            cfg['executor'], parse_condor_q_output, output.decode(), options.aggregate)
+    raise tornado.gen.Return(counter)
+
 @tornado.gen.coroutine
 def condor_q(cfg):
     """Get the status of the HTCondor queue"""
@@ -248,42 +1523,37 @@ def condor_q(cfg):
     cfg['condor_q'] = True
 
     logger.info('condor_q')
-    cmd = ['condor_q', '-global', '-autoformat:,', 'RequestCPUs', 'RequestMemory',
-           'RequestDisk', 'RequestGPUs', '-format', '"%s"', 'Requirements',
-           '-constraint', '"JobStatus =?= 1"']
-    if cfg['options'].constraint:
-        cmd += ['-constraint', cfg['options'].constraint]
-    if cfg['options'].user:
-        cmd += [cfg['options'].user]
-    if (distutils.version.LooseVersion(get_condor_version()) >=
-         distutils.version.LooseVersion("8.5.2") and
-         not cfg['options'].user):
-        cmd += ["-allusers"]
-
     state = []
     try:
-        cmd = ' '.join(cmd)
-        print(cmd)
-        p = Subprocess(cmd, shell=True, stdout=Subprocess.STREAM)
-        output = yield p.stdout.read_until_close()
-        for line in output.decode().splitlines():
-            logger.debug(line)
+        counter = None
+        if cfg['options'].condor_backend == 'bindings':
+            start = time.time()
             try:
-                cpus, memory, disk, gpus, reqs = line.split(', ',4)
-                cpus = 1 if cpus == 'undefined' else int(cpus)
-                memory = 2000 if memory == 'undefined' else int(memory)
-                disk = 10000 if disk == 'undefined' else int(disk)/1000 # convert to MB
-                gpus = 0 if gpus == 'undefined' else int(gpus)
-                req_os = None
-                if 'OpSysAndVer =?= "SL6"' in reqs:
-                    req_os = 'sl6'
-                state.append((cpus, memory, disk, gpus, req_os))
+                counter = yield condor_q_bindings(cfg)
             except Exception:
-                logger.info('error parsing line', exc_info=True)
-                continue
-        state = [{'cpus':s[0], 'memory':s[1], 'disk':s[2],
-                  'gpus':s[3], 'os':s[4], 'count': count} 
-                  for s, count in Counter(state).items()]
+                condor_query_errors.inc(backend='bindings')
+                logger.warn('error in python bindings query, '
+                            'falling back to condor_q', exc_info=True)
+            else:
+                condor_query_duration.observe(time.time()-start, backend='bindings')
+        if counter is None:
+            start = time.time()
+            try:
+                counter = yield condor_q_cli(cfg)
+            except Exception:
+                condor_query_errors.inc(backend='cli')
+                raise
+            condor_query_duration.observe(time.time()-start, backend='cli')
+        if cfg['options'].net_demand:
+            try:
+                future = IOLoop.current().run_in_executor(cfg['executor'],
+                                                          query_glidein_slots)
+                cfg['glidein_slots'] = yield tornado.gen.with_timeout(
+                        timedelta(seconds=cfg['options'].schedd_timeout), future)
+            except Exception:
+                logger.warn('error querying glidein slots, using the last result',
+                            exc_info=True)
+        state = yield build_state(cfg, counter)
     except Exception:
         logger.warn('error in condor_q', exc_info=True)
         state = None
@@ -292,7 +1562,8 @@ def condor_q(cfg):
             # update state only on the main io loop
             logger.info('state is updated to %r', state)
             if state is not None:
-                cfg['state'] = state
+                set_state(cfg, state)
+                record_history(cfg)
             cfg['condor_q'] = False
             IOLoop.current().call_later(cfg['options'].delay,
                                          partial(condor_q, cfg))
@@ -307,6 +1578,72 @@ def main():
                       help='Only track a single user')
     parser.add_option('--constraint', type='string', default=None,
                       help='HTCondor constraint expression')
+    parser.add_option('--condor-backend', type='choice', default='bindings',
+                      choices=['bindings', 'cli'],
+                      help='query the queue with the python bindings or condor_q '
+                           '(default: bindings, falls back to condor_q)')
+    parser.add_option('--aggregate', action='store_true', default=False,
+                      help='let each schedd group idle jobs into autoclusters '
+                           'and only transfer the per-autocluster job counts')
+    parser.add_option('--schedd-timeout', type='int', default=60,
+                      help='timeout for querying a single schedd (default: 60 seconds)')
+    parser.add_option('--monitoring-ttl', type='int', default=86400,
+                      help='forget clients that have not reported for this long '
+                           '(default: 86400 seconds)')
+    parser.add_option('--monitoring-max-clients', type='int', default=10000,
+                      help='max number of clients to keep monitoring for (default: 10000)')
+    parser.add_option('--monitoring-history', type='int', default=288,
+                      help='number of monitoring samples kept per client (default: 288)')
+    parser.add_option('--snapshot', type='string', default=None,
+                      help='sqlite file to save state and monitoring in, '
+                           'loaded again at startup')
+    parser.add_option('--snapshot-interval', type='int', default=60,
+                      help='delay between snapshots (default: 60 seconds)')
+    parser.add_option('--snapshot-compact', type='int', default=3600,
+                      help='delay between compactions of the snapshot file '
+                           '(default: 3600 seconds)')
+    parser.add_option('--state-history', type='int', default=10,
+                      help='number of state generations kept for get_state_delta (default: 10)')
+    parser.add_option('--event-log', type='string', default=None,
+                      help='event log (EVENT_LOG) of the local schedd; if set, '
+                           'its idle jobs are tracked incrementally between '
+                           'full queries (needs --condor-backend bindings)')
+    parser.add_option('--event-poll', type='int', default=5,
+                      help='delay between reads of the event log (default: 5 seconds)')
+    parser.add_option('--net-demand', action='store_true', default=False,
+                      help='subtract the jobs that unclaimed glidein slots and '
+                           'pending glideins will run from the state')
+    parser.add_option('--pending-glidein-jobs', type='float', default=1,
+                      help='with --net-demand, number of jobs a glidein that a '
+                           'client reported as idle is expected to run (default: 1)')
+    parser.add_option('--pending-glidein-age', type='int', default=3600,
+                      help='with --net-demand, only count idle glideins of clients '
+                           'that reported within this long (default: 3600 seconds)')
+    parser.add_option('--allocate', action='store_true', default=False,
+                      help='split the state between the clients sending their '
+                           'uuid, instead of giving each the whole state')
+    parser.add_option('--lease-time', type='int', default=900,
+                      help='with --allocate, seconds a client keeps its share '
+                           'after it last asked for the state or reported '
+                           'monitoring (default: 900)')
+    parser.add_option('--requirements-cache', type='int', default=10000,
+                      help='number of distinct job Requirements to keep the '
+                           'analysis of (default: 10000)')
+    parser.add_option('--query-threads', type='int', default=10,
+                      help='number of schedds to query at the same time (default: 10)')
+    parser.add_option('--workers', type='int', default=1,
+                      help='number of processes serving requests; with more than '
+                           'one, a separate collector process queries the queue '
+                           '(default: 1)')
+    parser.add_option('--shared-dir', type='string', default=None,
+                      help='directory for the state shared with worker processes '
+                           '(default: a new temporary directory)')
+    parser.add_option('--worker-poll', type='float', default=0.2,
+                      help='delay between checks for a new state in worker '
+                           'processes (default: 0.2 seconds)')
+    parser.add_option('--monitoring-publish', type='int', default=5,
+                      help='delay between publishing client monitoring to worker '
+                           'processes (default: 5 seconds)')
     parser.add_option('--delay', type='int', default=300,
                       help='delay between calls to condor_q (default: 300 seconds)')
     parser.add_option('--debug', action='store_true', default=False,
@@ -330,20 +1667,79 @@ def main():
 
     if options.delay < 0 or options.delay > 1000:
         raise Exception('delay out of range')
+    if options.event_log and options.condor_backend != 'bindings':
+        # condor_q reports the whole pool at once, so the events of one
+        # schedd cannot be applied to its result
+        raise Exception('--event-log needs --condor-backend bindings')
+    analyzer.maxsize = options.requirements_cache
         
     if config.get('metrics', {}).get('enable_metrics', False):
         metrics_sender_client = MetricsSenderClient(config['metrics'])
     else:
         metrics_sender_client = None
 
-    cfg = {'options': options, 'config': config, 'condor_q': False, 'state': [], 'monitoring': {},
-           'metrics_sender_client': metrics_sender_client}
+    history_config = config.get('demand_history', {})
+    demand_history = DemandHistory(tiers=history_config.get('tiers', [(300, 288), (3600, 336)]),
+                                   trend_window=history_config.get('trend_window', 3600))
+
+    monitoring = MonitoringStore(ttl=options.monitoring_ttl,
+                                 max_clients=options.monitoring_max_clients,
+                                 history=options.monitoring_history)
+    cfg = {'options': options, 'config': config, 'condor_q': False, 'state': [], 'monitoring': monitoring,
+           'metrics_sender_client': metrics_sender_client, 'schedds': {}, 'tracker': None,
+           'executor': ThreadPoolExecutor(max_workers=4),
+           'schedd_executor': ThreadPoolExecutor(max_workers=options.query_threads),
+           'schedd_slots': tornado.locks.Semaphore(options.query_threads),
+           'state_generation': 0, 'state_cache': None, 'state_epoch': uuid.uuid4().hex,
+           'state_history': deque(maxlen=options.state_history),
+           'state_changed': tornado.locks.Condition(), 'state_updated': None,
+           'snapshot_store': None, 'glidein_slots': None,
+           'allocator': DemandAllocator(options.lease_time) if options.allocate else None,
+           'demand_history': demand_history, 'forecast_cache': {}}
+    set_state(cfg, [])
     
     def starter():
         logging.basicConfig(**kwargs)
+        analyzer.check()
+
+        workers = None
+        if options.workers > 1:
+            # fork before starting anything, workers do not return
+            workers = start_workers(cfg)
+
+        if options.snapshot:
+            cfg['snapshot_store'] = SnapshotStore(options.snapshot)
+            load_snapshot(cfg)
+            IOLoop.current().call_later(options.snapshot_interval,
+                                        partial(snapshot, cfg))
+
+        if cfg['metrics_sender_client'] is not None:
+            cfg['metrics_sender_client'].start()
 
         # load condor_q
         IOLoop.current().call_later(5, partial(condor_q, cfg))
+        if options.event_log:
+            try:
+                cfg['tracker'] = JobEventTracker(options.event_log, options)
+            except ImportError:
+                logger.error('--event-log needs the HTCondor python bindings, '
+                             'polling the queue instead')
+            except Exception:
+                logger.error('cannot follow the event log, polling the queue instead',
+                             exc_info=True)
+            else:
+                IOLoop.current().call_later(5+options.event_poll,
+                                            partial(track_events, cfg))
+
+        if workers is not None:
+            # collector process
+            for pid, conn in workers:
+                IOLoop.current().spawn_callback(read_forwarded, cfg, IOStream(conn))
+            IOLoop.current().spawn_callback(publish_state, cfg)
+            IOLoop.current().call_later(options.monitoring_publish,
+                                        partial(publish_monitoring, cfg))
+            IOLoop.current().start()
+            return
 
         # setup server
         s = server(cfg)
@@ -0,0 +1,152 @@
+"""
+Minimal Prometheus instrumentation for the server.
+
+Counters, gauges and histograms with labels, rendered in the Prometheus
+text exposition format. Updates are thread safe, since queries run in an
+executor.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import threading
+from contextlib import contextmanager
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """Base class for metrics, keeping a value per label set"""
+    type = None
+
+    def __init__(self, name, doc, labels=()):
+        """
+        Args:
+            name: metric name
+            doc: help text
+            labels: label names
+        """
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('labels of %s must be %r' % (self.name, self.labels))
+        return tuple(str(labels[l]) for l in self.labels)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, escape(v)) for k, v in pairs) + '}'
+
+    def samples(self):
+        """Get (name, label string, value) of each sample"""
+        with self.lock:
+            return [(self.name, self.format_labels(k), v)
+                    for k, v in sorted(self.values.items())]
+
+    def exposition(self):
+        ret = ['# HELP %s %s' % (self.name, self.doc),
+               '# TYPE %s %s' % (self.name, self.type)]
+        for name, labels, value in self.samples():
+            ret.append('%s%s %s' % (name, labels, format_value(value)))
+        return ret
+
+
+class CounterMetric(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class GaugeMetric(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class HistogramMetric(Metric):
+    type = 'histogram'
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name, doc, labels=(), buckets=None):
+        super(HistogramMetric, self).__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets or self.default_buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                # bucket counts, then sum
+                self.values[key] = [0]*len(self.buckets) + [0.]
+            counts = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        ret = []
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    ret.append((self.name+'_bucket',
+                                self.format_labels(key, [('le', format_value(bound))]),
+                                count))
+                ret.append((self.name+'_sum', self.format_labels(key), counts[-1]))
+                ret.append((self.name+'_count', self.format_labels(key), counts[-2]))
+        return ret
+
+
+class Registry(object):
+    """A set of metrics, exposed together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, doc, labels=()):
+        return self.register(CounterMetric(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self.register(GaugeMetric(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=None):
+        return self.register(HistogramMetric(name, doc, labels, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        """Get all metrics in the Prometheus text format"""
+        ret = []
+        for metric in self.metrics:
+            ret.extend(metric.exposition())
+        return '\n'.join(ret) + '\n'
@@ -0,0 +1,110 @@
+"""
+Publish a document from one process to many through an mmap'd file.
+
+Used by the multi-process server: the collector process publishes the
+serialized state, and the worker processes poll for new versions. Polling
+only reads the header, so it is cheap to do often.
+
+The file starts with a header of two unsigned 64 bit ints, a sequence
+number and the payload length, followed by the payload. The writer makes
+the sequence number odd while it updates the payload, and even when done,
+so readers can detect and retry torn reads (a seqlock).
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import mmap
+import struct
+import logging
+
+logger = logging.getLogger('server')
+
+header = struct.Struct('!QQ')
+
+
+class SharedStateWriter(object):
+    """Writes versions of a document to a shared file"""
+
+    def __init__(self, path, size=2**20):
+        """
+        Args:
+            path: file to publish to, created or truncated
+            size: initial size of the file, it grows as needed
+        """
+        self.path = path
+        self.seq = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.size = 0
+        self.map = None
+        self._resize(max(size, header.size))
+
+    def _resize(self, size):
+        if self.map is not None:
+            self.map.close()
+        os.ftruncate(self.fd, size)
+        self.size = size
+        self.map = mmap.mmap(self.fd, size)
+
+    def publish(self, data):
+        """
+        Publish a new version.
+
+        Args:
+            data: the document, as bytes
+        """
+        if header.size + len(data) > self.size:
+            # readers notice the larger length and map the file again
+            self._resize(2*(header.size + len(data)))
+        self.seq += 1
+        header.pack_into(self.map, 0, self.seq, 0)
+        self.map[header.size:header.size+len(data)] = data
+        self.seq += 1
+        header.pack_into(self.map, 0, self.seq, len(data))
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class SharedStateReader(object):
+    """Reads the latest version of a document from a shared file"""
+
+    def __init__(self, path):
+        """
+        Args:
+            path: file published to by a SharedStateWriter
+        """
+        self.path = path
+        self.seq = 0
+        self.fd = os.open(path, os.O_RDONLY)
+        self.map = None
+        self._remap()
+
+    def _remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.fd, os.fstat(self.fd).st_size, access=mmap.ACCESS_READ)
+
+    def read(self):
+        """
+        Get the latest version if there is a new one.
+
+        Returns:
+            bytes: the document, or None if unchanged or being written
+        """
+        seq, length = header.unpack_from(self.map, 0)
+        if seq == self.seq or seq % 2:
+            return None
+        if header.size + length > len(self.map):
+            self._remap()
+        data = self.map[header.size:header.size+length]
+        if header.unpack_from(self.map, 0)[0] != seq:
+            # written to while reading, retry on the next poll
+            return None
+        self.seq = seq
+        return data
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
@@ -0,0 +1,145 @@
+"""
+Local snapshot store for the server state, client monitoring and demand
+history.
+
+Lets the server restart warm: instead of serving an empty state until the
+first queue query finishes, it loads the last snapshot at startup.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import sqlite3
+import logging
+
+from pyglidein.util import json_encode, json_decode
+
+logger = logging.getLogger('server')
+
+
+class SnapshotStore(object):
+    """
+    Snapshots in a sqlite database.
+
+    States are appended, and compaction drops all but the latest few.
+    Monitoring has one row per client, the demand history a single row.
+    """
+
+    def __init__(self, path, keep_states=1):
+        """
+        Args:
+            path: filename of the sqlite database
+            keep_states: number of states kept by compaction
+        """
+        self.path = path
+        self.keep_states = keep_states
+        self.last_state_timestamp = None
+        self.last_compact = time.time()
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('create table if not exists state ('
+                              'id integer primary key autoincrement, '
+                              'timestamp real, state text)')
+            self.conn.execute('create table if not exists monitoring ('
+                              'uuid text primary key, timestamp real, info text)')
+            self.conn.execute('create table if not exists history ('
+                              'id integer primary key, timestamp real, history text)')
+
+    def save_state(self, state, timestamp=None):
+        """
+        Append a state snapshot.
+
+        Args:
+            state: the state list
+            timestamp: when the state was refreshed (default: now)
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        elif timestamp == self.last_state_timestamp:
+            # already saved
+            return
+        with self.conn:
+            self.conn.execute('insert into state (timestamp, state) values (?, ?)',
+                              (timestamp, json_encode(state)))
+        self.last_state_timestamp = timestamp
+
+    def save_monitoring(self, monitoring):
+        """
+        Save the monitoring info of all clients.
+
+        Args:
+            monitoring: dict of client uuid -> monitoring info
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('insert or replace into monitoring (uuid, timestamp, info) '
+                                  'values (?, ?, ?)',
+                                  [(uuid, info.get('timestamp', now), json_encode(info))
+                                   for uuid, info in monitoring.items()])
+
+    def save_history(self, history):
+        """
+        Save the demand history.
+
+        Args:
+            history: DemandHistory
+        """
+        with self.conn:
+            self.conn.execute('insert or replace into history (id, timestamp, history) '
+                              'values (1, ?, ?)', (time.time(), json_encode(history.dump())))
+
+    def load_history(self, history):
+        """
+        Load the demand history, if saved.
+
+        Args:
+            history: DemandHistory to restore into
+        """
+        row = self.conn.execute('select history from history where id = 1').fetchone()
+        if row:
+            try:
+                history.restore(json_decode(row[0]))
+            except Exception:
+                logger.info('error loading demand history', exc_info=True)
+
+    def load(self):
+        """
+        Load the latest snapshot.
+
+        Returns:
+            tuple: (state, state timestamp, monitoring dict), with the
+                   state and timestamp None if there is no snapshot
+        """
+        state, timestamp = None, None
+        row = self.conn.execute('select timestamp, state from state '
+                                'order by id desc limit 1').fetchone()
+        if row:
+            timestamp = row[0]
+            state = json_decode(row[1])
+            self.last_state_timestamp = timestamp
+        monitoring = {}
+        for uuid, info in self.conn.execute('select uuid, info from monitoring'):
+            try:
+                monitoring[uuid] = json_decode(info)
+            except Exception:
+                logger.info('error loading monitoring for %r', uuid, exc_info=True)
+        return state, timestamp, monitoring
+
+    def compact(self, max_monitoring_age=None):
+        """
+        Drop old states and monitoring, and shrink the database file.
+
+        Args:
+            max_monitoring_age: drop monitoring older than this many seconds
+        """
+        with self.conn:
+            self.conn.execute('delete from state where id not in (select id from state '
+                              'order by id desc limit ?)', (self.keep_states,))
+            if max_monitoring_age:
+                self.conn.execute('delete from monitoring where timestamp < ?',
+                                  (time.time() - max_monitoring_age,))
+        self.conn.execute('vacuum')
+        self.last_compact = time.time()
+
+    def close(self):
+        self.conn.close()
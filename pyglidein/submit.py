@@ -2,13 +2,13 @@
 from __future__ import absolute_import, division, print_function
 
 import os
+import re
 import subprocess
 import logging
 import shutil
 import glob
-import uuid
 
-from pyglidein.client_util import get_presigned_put_url, get_presigned_get_url
+from pyglidein.client_util import PresignedURLProvider
 
 
 class Submit(object):
@@ -31,10 +31,26 @@ class Submit(object):
                                     'gridftp_test.py',
                                     'post_cvmfs.sh',
                                     'pre_cvmfs.sh']
+        self.presigned_urls = PresignedURLProvider(config, secrets)
 
     def submit(self):
         raise NotImplementedError()
 
+    def get_presigned_urls(self, num):
+        """
+        Get presigned urls for the startd logs of glideins, if they are sent.
+
+        Args:
+            num: number of glideins
+
+        Returns:
+            list: (put url, get url) per glidein, or None
+        """
+        if self.config.get('StartdLogging', {}).get('send_startd_logs', False) is not True:
+            return None
+        urls = self.presigned_urls.get(num)
+        return urls if len(urls) == num else None
+
     def write_line(self, f, line):
         """
         Wrapper function so we dont have to write \n a million times
@@ -85,7 +101,7 @@ class Submit(object):
 
         return scale
 
-    def cleanup(self, cmd, direc):
+    def cleanup(self, cmd, direc, job_ids=None):
         pass
 
 
@@ -93,10 +109,62 @@ class SubmitPBS(Submit):
     """Submit a PBS / Torque job"""
 
     option_tag = "#PBS"
+    # job id in the output of the submit command
+    job_id_pattern = re.compile(r'^\s*(\S+)')
+    # index of a job in its array (PBS_ARRAYID for Torque, PBS_ARRAY_INDEX for PBS Pro)
+    array_index = '${PBS_ARRAYID:-$PBS_ARRAY_INDEX}'
 
     def write_option(self, f, line):
         self.write_line(f, self.option_tag+" "+line)
 
+    def get_array_throttle(self, cluster_config, num_jobs):
+        """
+        Get the max number of jobs of an array to run at the same time.
+
+        Only an explicit `array_throttle` limits an array. The number of
+        glideins submitted already fits `max_idle_jobs`, and a throttle
+        limits running jobs, not idle ones.
+
+        Args:
+            cluster_config: the Cluster config dict (or that of an alternate partition)
+            num_jobs: number of jobs in the array
+
+        Returns:
+            the throttle, or None if it would not limit the array
+        """
+        throttle = cluster_config.get("array_throttle")
+        if throttle and throttle < num_jobs:
+            return int(throttle)
+        return None
+
+    def write_array_option(self, f, cluster_config, num_jobs):
+        """
+        Make the job an array of identical jobs.
+
+        Args:
+            f: python file object
+            cluster_config: the Cluster config dict (or that of an alternate partition)
+            num_jobs: number of jobs in the array
+        """
+        line = "-t 1-%d" % num_jobs
+        throttle = self.get_array_throttle(cluster_config, num_jobs)
+        if throttle:
+            line += "%%%d" % throttle
+        self.write_option(f, line)
+
+    def parse_job_id(self, output):
+        """
+        Get the job id from the output of the submit command.
+
+        Args:
+            output: output of the submit command
+
+        Returns:
+            the job id, or None if not found
+        """
+        match = self.job_id_pattern.search(output)
+        return match.group(1) if match else None
+
     def write_general_header(self, f, cluster_config, mem=3000, walltime_hours=14, disk=1,
                              num_nodes=1, num_cpus=1, num_gpus=0,
                              num_jobs=0):
@@ -146,7 +214,7 @@ class SubmitPBS(Submit):
             self.write_option(f, "-o /dev/null")
             self.write_option(f, "-e /dev/null")
         if num_jobs > 0:
-            self.write_option(f, "-t 0-%d" % num_jobs)
+            self.write_array_option(f, cluster_config, num_jobs)
         env_vars = '-v '
         if not self.config.get("StartdChecks", {}).get("enable_startd_checks", True):
             env_vars += 'DISABLE_STARTD_CHECKS=1'
@@ -189,8 +257,30 @@ class SubmitPBS(Submit):
         if 'cluster' in self.config['Glidein']:
             self.write_line(f, 'CLUSTER="%s"' % self.config['Glidein']['cluster'])
 
-    def write_glidein_part(self, f, local_dir=None, glidein_tarball=None, presigned_put_url=None,
-                           presigned_get_url=None):
+    def write_presigned_urls(self, f, presigned_urls):
+        """
+        Pick the presigned urls of each job of an array.
+
+        The urls of all jobs are written into the script, and each job
+        picks its own by its array index.
+
+        Args:
+            f: python file object
+            presigned_urls: (put url, get url) per job of the array
+        """
+        self.write_line(f, 'PRESIGNED_PUT_URLS=(')
+        for put_url, _ in presigned_urls:
+            self.write_line(f, '"%s"' % put_url)
+        self.write_line(f, ')')
+        self.write_line(f, 'PRESIGNED_GET_URLS=(')
+        for _, get_url in presigned_urls:
+            self.write_line(f, '"%s"' % get_url)
+        self.write_line(f, ')')
+        self.write_line(f, 'ARRAY_INDEX=$((%s-1))' % self.array_index)
+        self.write_line(f, 'PRESIGNED_PUT_URL="${PRESIGNED_PUT_URLS[$ARRAY_INDEX]}"')
+        self.write_line(f, 'PRESIGNED_GET_URL="${PRESIGNED_GET_URLS[$ARRAY_INDEX]}"')
+
+    def write_glidein_part(self, f, local_dir=None, glidein_tarball=None, presigned_urls=None):
         """
         Writing the pieces needed to execute the glidein
 
@@ -198,7 +288,10 @@ class SubmitPBS(Submit):
             f: python file object
             local_dir: what is the local directory
             glidein_tarball: file name of tarball
+            presigned_urls: (put url, get url) for the startd logs of each job
         """
+        if presigned_urls and len(presigned_urls) > 1:
+            self.write_presigned_urls(f, presigned_urls)
         self.write_line(f, 'CLEANUP=0')
         self.write_line(f, 'LOCAL_DIR=%s' % local_dir)
         self.write_line(f, 'if [ ! -d $LOCAL_DIR ]; then')
@@ -242,9 +335,10 @@ class SubmitPBS(Submit):
             f.write('CLUSTER=$CLUSTER ')
         if self.config['SubmitFile'].get('cvmfs_job_wrapper', False):
             f.write('CVMFS_JOB_WRAPPER=1 ')
-        if presigned_put_url is not None and presigned_get_url is not None:
-            f.write('PRESIGNED_PUT_URL="{}" PRESIGNED_GET_URL="{}" '.format(presigned_put_url,
-                                                                            presigned_get_url))
+        if presigned_urls and len(presigned_urls) > 1:
+            f.write('PRESIGNED_PUT_URL="$PRESIGNED_PUT_URL" PRESIGNED_GET_URL="$PRESIGNED_GET_URL" ')
+        elif presigned_urls:
+            f.write('PRESIGNED_PUT_URL="{}" PRESIGNED_GET_URL="{}" '.format(*presigned_urls[0]))
         if "CustomEnv" in self.config:
             for k, v in self.config["CustomEnv"].items():
                 f.write(k + '=' + v + ' ')
@@ -291,7 +385,7 @@ class SubmitPBS(Submit):
         return num_cpus, mem_requested, mem_advertised
 
     def write_submit_file(self, filename, state, group_jobs, cluster_config,
-                          presigned_put_url=None, presigned_get_url=None):
+                          presigned_urls=None):
         """
         Writing the submit file
 
@@ -300,6 +394,7 @@ class SubmitPBS(Submit):
             state: what resource requirements a given glidein has
             group_jobs: if True, group jobs into arrays
             cluster_config: the Cluster config dict (or that of an alternate partition)
+            presigned_urls: (put url, get url) for the startd logs of each job
         """
         with open(filename, 'w') as f:
             if cluster_config['whole_node']:
@@ -341,8 +436,7 @@ class SubmitPBS(Submit):
 
             kwargs = {
                 'local_dir': self.config["SubmitFile"]["local_dir"],
-                'presigned_put_url': presigned_put_url,
-                'presigned_get_url': presigned_get_url
+                'presigned_urls': presigned_urls
             }
             if "tarball" in self.config["Glidein"]:
                 if "loc" in self.config["Glidein"]:
@@ -364,38 +458,47 @@ class SubmitPBS(Submit):
         """
         Writing submit file and submitting a job for PBS-like batch managers
 
+        With `group_jobs` (the default), the glideins of a state are
+        submitted as one job array. The scheduler snapshots count the jobs
+        of arrays one by one, and so must `running_cmd` and `idle_cmd`.
+
         Args:
             state: what resource requirements a given glidein has
+
+        Returns:
+            list: ids of the submitted jobs (or job arrays)
         """
         submit_filename = 'submit.pbs'
         if 'filename' in self.config["SubmitFile"]:
             submit_filename = self.config["SubmitFile"]["filename"]
 
         cluster_config = self.config[partition]
-        group_jobs = ("group_jobs" in cluster_config and
-                      cluster_config["group_jobs"] and
-                      "count" in state)
+        group_jobs = (cluster_config.get("group_jobs", True) and
+                      state.get("count", 1) > 1)
 
-        self.write_submit_file(submit_filename, state, group_jobs, cluster_config)
         num_submits = 1 if group_jobs else state["count"] if "count" in state else 1
+        presigned_urls = self.get_presigned_urls(state.get("count", 1))
+        job_ids = []
         for i in range(num_submits):
-            if self.config['StartdLogging']['send_startd_logs'] is True:
-                startd_logfile_name = '{}_{}.tar.gz'.format(self.config['Glidein']['site'], uuid.uuid4())
-                presigned_put_url = get_presigned_put_url(startd_logfile_name, self.config, self.secrets)
-                presigned_get_url = get_presigned_get_url(startd_logfile_name, self.config, self.secrets)
-                self.write_submit_file(submit_filename,
-                                       state,
-                                       group_jobs,
-                                       cluster_config,
-                                       presigned_put_url,
-                                       presigned_get_url)
+            if presigned_urls is not None and not group_jobs:
+                # every job needs its own urls
+                self.write_submit_file(submit_filename, state, group_jobs, cluster_config,
+                                       presigned_urls[i:i+1])
+            elif i == 0:
+                self.write_submit_file(submit_filename, state, group_jobs, cluster_config,
+                                       presigned_urls)
             cmd = self.config[partition]["submit_command"] + " " + submit_filename
             if not ('Mode' in self.config and 'dryrun' in self.config['Mode'] and
                     self.config['Mode']['dryrun']):
-                subprocess.check_call(cmd, shell=True)
-
+                output = subprocess.check_output(cmd, shell=True).decode('utf-8', 'replace')
+                job_id = self.parse_job_id(output)
+                if job_id is None:
+                    logging.warning('no job id in submit output: %r', output)
+                else:
+                    job_ids.append(job_id)
+        return job_ids
 
-    def cleanup(self, cmd, direc):
+    def cleanup(self, cmd, direc, job_ids=None):
         """
         Cleans up temporary directories that were created on a network file system that were not
         deleted by the job itself. Checks whether the job ID used to identify a temporary directory
@@ -404,11 +507,14 @@ class SubmitPBS(Submit):
         Args:
             cmd: Command needed to query about which jobs are running for the user
             direc: Which directory to look for the temporory directories
+            job_ids: ids of the jobs in the queue, from a scheduler snapshot,
+                     instead of running `cmd`
         """
-        cmd = cmd[:-6]
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        d = p.communicate()[0]
-        job_ids = set([job.split(" ")[0] for job in d.splitlines() if "[" not in job.split(" ")[0] ])
+        if job_ids is None:
+            cmd = cmd[:-6]
+            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+            d = p.communicate()[0]
+            job_ids = set([job.split(" ")[0] for job in d.splitlines() if "[" not in job.split(" ")[0] ])
         dir_ids = set([dir.split("/")[-1].split(".")[0] for dir in glob.glob(os.path.join(os.path.expandvars(direc), "*"))])
         for ids in (dir_ids - job_ids):
             logging.info("Deleting %s", ids)
@@ -418,6 +524,15 @@ class SubmitSLURM(SubmitPBS):
     """SLURM is similar to PBS, but with different headers"""
 
     option_tag = "#SBATCH"
+    job_id_pattern = re.compile(r'Submitted batch job (\d+)')
+    array_index = '$SLURM_ARRAY_TASK_ID'
+
+    def write_array_option(self, f, cluster_config, num_jobs):
+        line = "--array=1-%d" % num_jobs
+        throttle = self.get_array_throttle(cluster_config, num_jobs)
+        if throttle:
+            line += "%%%d" % throttle
+        self.write_option(f, line)
 
     def write_general_header(self, f, cluster_config, mem=3000, walltime_hours=14, disk=1,
                              num_nodes=1, num_cpus=1, num_gpus=0,
@@ -436,8 +551,6 @@ class SubmitSLURM(SubmitPBS):
             num_gpus: requested number of gpus
             num_jobs: requested number of jobs
         """
-        if num_jobs > 1:
-            raise Exception('more than one job not supported')
         self.write_line(f, "#!/bin/bash")
         self.write_option(f, '--job-name="glidein"')
         self.write_option(f, '--nodes=%d'%num_nodes)
@@ -451,12 +564,16 @@ class SubmitSLURM(SubmitPBS):
         if "partition" in cluster_config:
             self.write_option(f, "--partition=%s" % cluster_config["partition"])
         self.write_option(f, "--time=%d:00:00" % walltime_hours)
+        if num_jobs > 0:
+            self.write_array_option(f, cluster_config, num_jobs)
         if self.config["Mode"]["debug"]:
             log_dir = os.path.join(os.getcwd(), 'out')
             if not os.path.isdir(log_dir):
                 os.mkdir(log_dir)
-            self.write_option(f, "--output="+os.path.join(log_dir, "%j.out"))
-            self.write_option(f, "--error="+os.path.join(log_dir, "%j.err"))
+            # %A_%a is the array id and index
+            log_name = "%A_%a" if num_jobs > 0 else "%j"
+            self.write_option(f, "--output="+os.path.join(log_dir, log_name+".out"))
+            self.write_option(f, "--error="+os.path.join(log_dir, log_name+".err"))
         else:
             self.write_option(f, "--output=/dev/null")
             self.write_option(f, "--error=/dev/null")
@@ -466,6 +583,14 @@ class SubmitUGE(SubmitPBS):
     """UGE is similar to PBS, but with different headers"""
 
     option_tag = "#$"
+    job_id_pattern = re.compile(r'Your job(?:-array)? (\d+)')
+    array_index = '$SGE_TASK_ID'
+
+    def write_array_option(self, f, cluster_config, num_jobs):
+        self.write_option(f, "-t 1-%d" % num_jobs)
+        throttle = self.get_array_throttle(cluster_config, num_jobs)
+        if throttle:
+            self.write_option(f, "-tc %d" % throttle)
 
     def get_cores_for_memory(self, cluster_config, num_cpus_advertised, num_gpus_advertised, mem_advertised):
         """
@@ -507,12 +632,21 @@ class SubmitUGE(SubmitPBS):
             self.write_option(f, "-o /dev/null")
             self.write_option(f, "-e /dev/null")
         if num_jobs > 0:
-            self.write_option(f, "-t 1-%d" % num_jobs)
+            self.write_array_option(f, cluster_config, num_jobs)
 
 class SubmitLSF(SubmitPBS):
     """LSF is similar to PBS, but with different headers"""
 
     option_tag = "#BSUB"
+    job_id_pattern = re.compile(r'Job <(\d+)>')
+    array_index = '$LSB_JOBINDEX'
+
+    def write_array_option(self, f, cluster_config, num_jobs):
+        line = '-J "glidein[1-%d]' % num_jobs
+        throttle = self.get_array_throttle(cluster_config, num_jobs)
+        if throttle:
+            line += "%%%d" % throttle
+        self.write_option(f, line + '"')
 
     def write_general_header(self, f, cluster_config, mem=3000, walltime_hours=14, disk=1,
                              num_nodes=1, num_cpus=1, num_gpus=0,
@@ -560,8 +694,8 @@ class SubmitLSF(SubmitPBS):
                              (cpus_tot, cpus_per_node))
         """
         if num_jobs > 0:
-            # job name will be "[index]"
-            self.write_option(f, "-J [1-%d]" % num_jobs)
+            # job name will be "glidein[index]"
+            self.write_array_option(f, cluster_config, num_jobs)
 
         if ('Mode' in self.config and 'debug' in self.config['Mode']
             and self.config['Mode']['debug']):
@@ -579,6 +713,14 @@ class SubmitSGE(SubmitPBS):
     """SGE is similar to PBS, but with different headers"""
 
     option_tag = "#$"
+    job_id_pattern = SubmitUGE.job_id_pattern
+    array_index = '$SGE_TASK_ID'
+
+    def write_array_option(self, f, cluster_config, num_jobs):
+        self.write_option(f, "-t 1-%d" % num_jobs)
+        throttle = self.get_array_throttle(cluster_config, num_jobs)
+        if throttle:
+            self.write_option(f, "-tc %d" % throttle)
 
     def get_cores_for_memory(self, cluster_config, num_cpus_advertised, num_gpus_advertised, mem_advertised):
         """
@@ -619,11 +761,21 @@ class SubmitSGE(SubmitPBS):
             self.write_option(f, "-o /dev/null")
             self.write_option(f, "-e /dev/null")
         if num_jobs > 0:
-            self.write_option(f, "-t 1-%d" % num_jobs)
+            self.write_array_option(f, cluster_config, num_jobs)
 
 class SubmitCondor(Submit):
     """Submit an HTCondor job"""
 
+    # cluster id in the output of condor_submit
+    cluster_id_pattern = re.compile(r'submitted to cluster (\d+)')
+
+    def __init__(self, config, secrets):
+        super(SubmitCondor, self).__init__(config, secrets)
+        # (partition, state bucket) -> submit description, for the bindings
+        self.submit_descriptions = {}
+        # partition the env wrapper was last written for
+        self.env_wrapper_partition = None
+
     def make_env_wrapper(self, env_wrapper, cluster_config):
         """
         Creating wrapper execute script for
@@ -683,8 +835,120 @@ class SubmitCondor(Submit):
             mode |= 0o111
             os.fchmod(f.fileno(), mode & 0o7777)
 
+    def get_submit_description(self, env_wrapper, state, cluster_config,
+                               presigned_put_url=None, presigned_get_url=None):
+        """
+        Get the HTCondor submit description, without the queue statement
+
+        Args:
+            env_wrapper: name of wrapper script
+            state: what resource requirements a given glidein has
+            cluster_config: the Cluster config dict (or that of an alternate partition)
+
+        Returns:
+            list: lines of the submit description
+        """
+        lines = []
+        if "custom_header" in self.config["SubmitFile"]:
+            lines.append(self.config["SubmitFile"]["custom_header"])
+
+        if ('Mode' in self.config and 'debug' in self.config['Mode']
+           and self.config["Mode"]["debug"]):
+            outdir = os.path.join(os.getcwd(),'out')
+            if not os.path.isdir(outdir):
+                os.mkdir(outdir)
+            lines.append("output = %s/$(Cluster).out"%outdir)
+            lines.append("error = %s/$(Cluster).out"%outdir)
+        else:
+            lines.append("output = /dev/null")
+            lines.append("error = /dev/null")
+        if 'log' in self.config['SubmitFile']:
+            lines.append("log = "+self.config['SubmitFile']['log'])
+        else:
+            lines.append("log = log")
+        lines.append("notification = never")
+        lines.append("should_transfer_files = YES")
+        lines.append("when_to_transfer_output = ON_EXIT")
+        lines.append("want_graceful_removal = True")
+        lines.append("executable = %s" % env_wrapper)
+        lines.append("+TransferOutput=\"\"")
+
+        # get input files
+        infiles = []
+        glidein_script = self.get_glidein_script()
+        if not os.path.isfile(glidein_script):
+            raise Exception("no glidein_script provided")
+        infiles.append(glidein_script)
+        osarch_script = os.path.join(os.path.dirname(glidein_script),'os_arch.sh')
+        if not os.path.isfile(osarch_script):
+            raise Exception("os_arch.sh not found")
+        infiles.append(osarch_script)
+        log_shipper_script = os.path.join(os.path.dirname(glidein_script),'log_shipper.sh')
+        if not os.path.isfile(log_shipper_script):
+            raise Exception("log_shipper_script.sh not found")
+        infiles.append(log_shipper_script)
+        if "tarball" in self.config["Glidein"]:
+            if not os.path.isfile(self.config["Glidein"]["tarball"]):
+                raise Exception("provided tarball does not exist")
+            infiles.append(self.config["Glidein"]["tarball"])
+        # Adding StartD Cron Scripts
+        if self.config.get("StartdChecks", {}).get("enable_startd_checks", True):
+            startd_cron_scripts_dir = os.path.join(os.path.dirname(glidein_script),
+                                                   'startd_cron_scripts')
+            if not os.path.isdir(startd_cron_scripts_dir):
+                raise Exception("StartD cron scripts directory not found: "
+                                "{}".format(startd_cron_scripts_dir))
+            for script in self.startd_cron_scripts:
+                script_path = os.path.join(startd_cron_scripts_dir, script)
+                if not os.path.isfile(script_path):
+                    raise Exception("Stard cron script not found: {}".format(script))
+                infiles.append(os.path.join(startd_cron_scripts_dir, script))
+        lines.append("transfer_input_files = %s"%(','.join(infiles)))
+
+        if "custom_middle" in self.config["SubmitFile"]:
+            lines.append(self.config["SubmitFile"]["custom_middle"])
+
+        if cluster_config['whole_node']:
+            num_cpus = int(cluster_config['whole_node_cpus'])
+            mem = int(cluster_config['whole_node_memory'])
+            disk = int(cluster_config['whole_node_disk'])*1000
+            if 'whole_node_gpus' in cluster_config:
+                num_gpus = int(cluster_config['whole_node_gpus'])
+            else:
+                num_gpus = 0
+            lines.append('request_cpus=%d' % num_cpus)
+            lines.append('request_memory=%d' % mem)
+            lines.append('request_disk=%d' % disk)
+            if state["gpus"] != 0 and num_gpus:
+                lines.append('request_gpus=%d' % num_gpus)
+        else:
+            if state["cpus"] != 0:
+                lines.append('request_cpus=%d' % state["cpus"])
+            if state["memory"] != 0:
+                mem_safety_margin = 1.1*self.get_resource_limit_scale("mem_safety_scale")
+                lines.append('request_memory=%d' % int(state["memory"]*mem_safety_margin))
+            if state["disk"] != 0:
+                lines.append('request_disk=%d' % int(state["disk"]*1024*1.1))
+            if state["gpus"] != 0:
+                lines.append('request_gpus=%d' % int(state["gpus"]))
+
+        # Creating environment variables
+        environment_variables = ''
+        if presigned_put_url is not None and presigned_get_url is not None:
+            environment_variables += ('PRESIGNED_PUT_URL={} '
+                                      'PRESIGNED_GET_URL={} ').format(presigned_put_url,
+                                                                      presigned_get_url)
+        if not self.config.get("StartdChecks", {}).get("enable_startd_checks", True):
+            environment_variables += 'DISABLE_STARTD_CHECKS=1'
+        if environment_variables != '':
+            lines.append('environment = "%s"' % environment_variables)
+
+        if "custom_footer" in self.config["SubmitFile"]:
+            lines.append(self.config["SubmitFile"]["custom_footer"])
+        return lines
+
     def make_submit_file(self, filename, env_wrapper, state, group_jobs, cluster_config,
-                         presigned_put_url=None, presigned_get_url=None):
+                         presigned_urls=None):
         """
         Creating HTCondor submit file
 
@@ -692,115 +956,116 @@ class SubmitCondor(Submit):
             filename: name of HTCondor submit file
             env_wrapper: name of wrapper script
             state: what resource requirements a given glidein has
+            presigned_urls: (put url, get url) for the startd logs of each job
         """
+        if presigned_urls and len(presigned_urls) > 1:
+            # every job takes its urls from the queue statement
+            lines = self.get_submit_description(env_wrapper, state, cluster_config,
+                                                '$(put_url)', '$(get_url)')
+        elif presigned_urls:
+            lines = self.get_submit_description(env_wrapper, state, cluster_config,
+                                                *presigned_urls[0])
+        else:
+            lines = self.get_submit_description(env_wrapper, state, cluster_config)
         with open(filename, 'w') as f:
-            if "custom_header" in self.config["SubmitFile"]:
-                self.write_line(f, self.config["SubmitFile"]["custom_header"])
-
-            if ('Mode' in self.config and 'debug' in self.config['Mode']
-               and self.config["Mode"]["debug"]):
-                outdir = os.path.join(os.getcwd(),'out')
-                if not os.path.isdir(outdir):
-                    os.mkdir(outdir)
-                self.write_line(f, "output = %s/$(Cluster).out"%outdir)
-                self.write_line(f, "error = %s/$(Cluster).out"%outdir)
-            else:
-                self.write_line(f, "output = /dev/null")
-                self.write_line(f, "error = /dev/null")
-            if 'log' in self.config['SubmitFile']:
-                self.write_line(f, "log = "+self.config['SubmitFile']['log'])
+            for line in lines:
+                self.write_line(f, line)
+            if presigned_urls and len(presigned_urls) > 1:
+                self.write_line(f, 'queue put_url,get_url from (')
+                for put_url, get_url in presigned_urls:
+                    self.write_line(f, '%s %s' % (put_url, get_url))
+                self.write_line(f, ')')
+            elif group_jobs:
+                self.write_line(f, 'queue %d' % state["count"])
             else:
-                self.write_line(f, "log = log")
-            self.write_line(f, "notification = never")
-            self.write_line(f, "should_transfer_files = YES")
-            self.write_line(f, "when_to_transfer_output = ON_EXIT")
-            self.write_line(f, "want_graceful_removal = True")
-            self.write_line(f, "executable = %s" % env_wrapper)
-            self.write_line(f, "+TransferOutput=\"\"")
-
-            # get input files
-            infiles = []
-            glidein_script = self.get_glidein_script()
-            if not os.path.isfile(glidein_script):
-                raise Exception("no glidein_script provided")
-            infiles.append(glidein_script)
-            osarch_script = os.path.join(os.path.dirname(glidein_script),'os_arch.sh')
-            if not os.path.isfile(osarch_script):
-                raise Exception("os_arch.sh not found")
-            infiles.append(osarch_script)
-            log_shipper_script = os.path.join(os.path.dirname(glidein_script),'log_shipper.sh')
-            if not os.path.isfile(log_shipper_script):
-                raise Exception("log_shipper_script.sh not found")
-            infiles.append(log_shipper_script)
-            if "tarball" in self.config["Glidein"]:
-                if not os.path.isfile(self.config["Glidein"]["tarball"]):
-                    raise Exception("provided tarball does not exist")
-                infiles.append(self.config["Glidein"]["tarball"])
-            # Adding StartD Cron Scripts
-            if self.config.get("StartdChecks", {}).get("enable_startd_checks", True):
-                startd_cron_scripts_dir = os.path.join(os.path.dirname(glidein_script),
-                                                       'startd_cron_scripts')
-                if not os.path.isdir(startd_cron_scripts_dir):
-                    raise Exception("StartD cron scripts directory not found: "
-                                    "{}".format(startd_cron_scripts_dir))
-                for script in self.startd_cron_scripts:
-                    script_path = os.path.join(startd_cron_scripts_dir, script)
-                    if not os.path.isfile(script_path):
-                        raise Exception("Stard cron script not found: {}".format(script))
-                    infiles.append(os.path.join(startd_cron_scripts_dir, script))
-            self.write_line(f, "transfer_input_files = %s"%(','.join(infiles)))
+                self.write_line(f, 'queue')
 
-            if "custom_middle" in self.config["SubmitFile"]:
-                self.write_line(f, self.config["SubmitFile"]["custom_middle"])
+    def queue(self, schedd, description, count, cluster_config, itemdata=None):
+        """
+        Queue procs of a submit description as one cluster, in one transaction.
 
-            if cluster_config['whole_node']:
-                num_cpus = int(cluster_config['whole_node_cpus'])
-                mem = int(cluster_config['whole_node_memory'])
-                disk = int(cluster_config['whole_node_disk'])*1000
-                if 'whole_node_gpus' in cluster_config:
-                    num_gpus = int(cluster_config['whole_node_gpus'])
-                else:
-                    num_gpus = 0
-                self.write_line(f, 'request_cpus=%d' % num_cpus)
-                self.write_line(f, 'request_memory=%d' % mem)
-                self.write_line(f, 'request_disk=%d' % disk)
-                if state["gpus"] != 0 and num_gpus:
-                    self.write_line(f, 'request_gpus=%d' % num_gpus)
+        With bindings that support it, clusters of at least
+        `late_materialize` procs are materialized by the schedd as they
+        are needed, with at most `max_idle_jobs` idle jobs at a time.
+
+        Args:
+            schedd: htcondor.Schedd
+            description: submit description, without the queue statement
+            count: number of procs
+            cluster_config: the Cluster config dict (or that of an alternate partition)
+            itemdata: list of macro dicts, one per proc, instead of `count`
+
+        Returns:
+            int: cluster id
+        """
+        import htcondor
+        if hasattr(htcondor, 'SubmitResult'):
+            late_materialize = cluster_config.get('late_materialize', 100)
+            if late_materialize and count >= late_materialize:
+                max_idle = cluster_config.get('max_idle_jobs', late_materialize)
+                description += '\nmax_idle = %d' % max_idle
+            if itemdata is not None:
+                result = schedd.submit(htcondor.Submit(description), count=1,
+                                       itemdata=iter(itemdata))
             else:
-                if state["cpus"] != 0:
-                    self.write_line(f, 'request_cpus=%d' % state["cpus"])
-                if state["memory"] != 0:
-                    mem_safety_margin = 1.1*self.get_resource_limit_scale("mem_safety_scale")
-                    self.write_line(f, 'request_memory=%d' % int(state["memory"]*mem_safety_margin))
-                if state["disk"] != 0:
-                    self.write_line(f, 'request_disk=%d' % int(state["disk"]*1024*1.1))
-                if state["gpus"] != 0:
-                    self.write_line(f, 'request_gpus=%d' % int(state["gpus"]))
-
-            # Creating environment variables
-            environment_variables = ''
-            if presigned_put_url is not None and presigned_get_url is not None:
-                environment_variables += ('PRESIGNED_PUT_URL={} '
-                                          'PRESIGNED_GET_URL={} ').format(presigned_put_url,
-                                                                          presigned_get_url)
-            if not self.config.get("StartdChecks", {}).get("enable_startd_checks", True):
-                environment_variables += 'DISABLE_STARTD_CHECKS=1'
-            if environment_variables != '':
-                self.write_line(f, 'environment = "%s"' % environment_variables)
-
-            if "custom_footer" in self.config["SubmitFile"]:
-                self.write_line(f, self.config["SubmitFile"]["custom_footer"])
-            if group_jobs:
-                self.write_line(f, 'queue %d' % state["count"])
+                result = schedd.submit(htcondor.Submit(description), count=count)
+            return result.cluster()
+        with schedd.transaction() as txn:
+            if itemdata is not None:
+                return htcondor.Submit(description).queue_with_itemdata(
+                    txn, 1, iter(itemdata)).cluster()
+            return htcondor.Submit(description).queue(txn, count)
+
+    def submit_bindings(self, state, partition, env_filename):
+        """
+        Submit glideins through the HTCondor python bindings.
+
+        All glideins of the state are queued as one cluster. The submit
+        description is cached per partition and state bucket, so nothing
+        is written to disk when nothing changed.
+
+        Args:
+            state: what resource requirements a given glidein has
+            partition: config section of the partition
+            env_filename: name of wrapper script
+
+        Returns:
+            list: cluster ids
+        """
+        import htcondor
+        cluster_config = self.config[partition]
+        count = state.get("count", 1)
+        presigned_urls = self.get_presigned_urls(count)
+        key = (partition, presigned_urls is not None,
+               tuple(sorted((k, v) for k, v in state.items() if k != 'count')))
+        if key not in self.submit_descriptions:
+            if presigned_urls is None:
+                lines = self.get_submit_description(env_filename, state, cluster_config)
             else:
-                self.write_line(f, 'queue')
+                # every proc takes its urls from the item data
+                lines = self.get_submit_description(env_filename, state, cluster_config,
+                                                    '$(put_url)', '$(get_url)')
+            self.submit_descriptions[key] = '\n'.join(lines)
+        itemdata = None
+        if presigned_urls is not None:
+            itemdata = [{'put_url': put_url, 'get_url': get_url}
+                        for put_url, get_url in presigned_urls]
+        schedd = htcondor.Schedd()
+        return [self.queue(schedd, self.submit_descriptions[key], count, cluster_config,
+                           itemdata)]
 
     def submit(self, state, partition="Cluster"):
         """
         Writing submit file and submitting a HTCondor job
 
+        With `htcondor_bindings`, the job is submitted through the python
+        bindings instead, without a submit file.
+
         Args:
             state: what resource requirements a given glidein has
+
+        Returns:
+            list: cluster ids
         """
         submit_filename = 'submit.condor'
         if 'filename' in self.config["SubmitFile"]:
@@ -810,31 +1075,38 @@ class SubmitCondor(Submit):
             env_filename = self.config["SubmitFile"]["env_wrapper_name"]
 
         cluster_config = self.config[partition]
-        group_jobs = ("group_jobs" in cluster_config and
-                      cluster_config["group_jobs"] and
-                      "count" in state)
+        if cluster_config.get('htcondor_bindings', False):
+            if (self.env_wrapper_partition != partition or
+                not os.path.isfile(env_filename)):
+                self.make_env_wrapper(env_filename, cluster_config)
+                self.env_wrapper_partition = partition
+            return self.submit_bindings(state, partition, env_filename)
+
+        group_jobs = cluster_config.get("group_jobs", True) and "count" in state
         self.make_env_wrapper(env_filename, cluster_config)
+        self.env_wrapper_partition = partition
         num_submits = 1 if group_jobs else state["count"] if "count" in state else 1
+        presigned_urls = self.get_presigned_urls(state.get("count", 1))
+        cluster_ids = []
         for i in range(num_submits):
-            if self.config.get('StartdLogging', {}).get('send_startd_logs', False) is True:
-                startd_logfile_name = '{}_{}.tar.gz'.format(self.config['Glidein']['site'],
-                                                            uuid.uuid4())
-                presigned_put_url = get_presigned_put_url(startd_logfile_name, self.config,
-                                                          self.secrets)
-                presigned_get_url = get_presigned_get_url(startd_logfile_name, self.config,
-                                                          self.secrets)
+            if presigned_urls is not None and not group_jobs:
+                # every job needs its own urls
                 self.make_submit_file(submit_filename,
                                       env_filename,
                                       state,
                                       group_jobs,
                                       cluster_config,
-                                      presigned_put_url,
-                                      presigned_get_url)
-            else:
+                                      presigned_urls[i:i+1])
+            elif i == 0:
                 self.make_submit_file(submit_filename,
                                       env_filename,
                                       state,
                                       group_jobs,
-                                      cluster_config)
+                                      cluster_config,
+                                      presigned_urls)
             cmd = cluster_config["submit_command"] + " " + submit_filename
-            subprocess.check_call(cmd, shell=True)
+            output = subprocess.check_output(cmd, shell=True).decode('utf-8', 'replace')
+            match = self.cluster_id_pattern.search(output)
+            if match:
+                cluster_ids.append(int(match.group(1)))
+        return cluster_ids
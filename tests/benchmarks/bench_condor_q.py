@@ -0,0 +1,92 @@
+"""
+Benchmark the server queue parsing against recorded condor_q output.
+
+Compares the condor_q text parser with the per-job work done by the
+python bindings backend: the recorded jobs are turned into job ClassAds,
+like the ones a schedd query yields, and each is read with job_ad_values
+and parse_job. The schedd round trip itself is not timed. The bindings
+timing needs the classad module, and is skipped without it.
+
+Usage: python tests/benchmarks/bench_condor_q.py [--jobs N]
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+from collections import Counter
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from pyglidein.server import (parse_job, parse_condor_q_line, job_ad_values,
+                              state_from_counter)
+
+RECORDED_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'condor_q_output.txt')
+
+
+def bench(name, func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        ret = func()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    print('%-10s %8.3f s' % (name, best))
+    return ret
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--jobs', type='int', default=200000,
+                      help='number of idle jobs to simulate (default: 200000)')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='number of repetitions, best is reported (default: 3)')
+    (options, args) = parser.parse_args()
+
+    with open(RECORDED_OUTPUT) as f:
+        recorded = [line.rstrip('\n') for line in f if line.strip()]
+    lines = (recorded * (options.jobs // len(recorded) + 1))[:options.jobs]
+    output = ('\n'.join(lines)+'\n').encode()
+    print('%d jobs, %d distinct lines' % (len(lines), len(set(lines))))
+
+    def text():
+        counter = Counter()
+        for line in output.decode().splitlines():
+            counter[parse_condor_q_line(line)] += 1
+        return state_from_counter(counter)
+
+    state_text = bench('condor_q', text, options.repeat)
+
+    try:
+        import classad
+    except ImportError:
+        print('classad module not found, skipping the bindings timing')
+        return
+
+    ads = []
+    for line in lines:
+        cpus, memory, disk, gpus, reqs = line.split(', ', 4)
+        ad = classad.ClassAd()
+        for attr, val in (('RequestCPUs', cpus), ('RequestMemory', memory),
+                          ('RequestDisk', disk), ('RequestGPUs', gpus)):
+            if val != 'undefined':
+                ad[attr] = classad.ExprTree(val)
+        ad['Requirements'] = classad.ExprTree(reqs)
+        ads.append(ad)
+
+    def bindings():
+        counter = Counter()
+        for ad in ads:
+            counter[parse_job(*job_ad_values(ad))] += 1
+        return state_from_counter(counter)
+
+    state_bindings = bench('bindings', bindings, options.repeat)
+    canonical = lambda state: Counter(tuple(sorted(s.items())) for s in state)
+    if canonical(state_text) != canonical(state_bindings):
+        raise Exception('state differs between backends')
+
+
+if __name__ == '__main__':
+    main()
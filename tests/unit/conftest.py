@@ -0,0 +1,115 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import uuid
+import threading
+from collections import deque
+from optparse import Values
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import tornado.locks
+
+# run against the source tree, like the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+
+@pytest.fixture
+def job():
+    """Factory of state tuples, with the columns of server.state_columns"""
+    from pyglidein.server import state_columns
+    defaults = {'cpus': 1, 'memory': 1000, 'disk': 1000, 'gpus': 0, 'cvmfs': False}
+
+    def make(**kwargs):
+        values = dict(defaults, **kwargs)
+        return tuple(values.get(column) for column in state_columns)
+    return make
+
+
+@pytest.fixture
+def row(job):
+    """Factory of state rows, as served to clients"""
+    from pyglidein.server import state_columns
+
+    def make(count, **kwargs):
+        ret = dict(zip(state_columns, job(**kwargs)))
+        ret['count'] = count
+        return ret
+    return make
+
+
+@pytest.fixture
+def slot():
+    """Factory of glidein slots, see net_demand.slot_from_ad"""
+    def make(cpus=8, memory=16000, disk=100000, gpus=0, site='SiteA', os_arch='RHEL_7_x86_64'):
+        return {'cpus': cpus, 'memory': memory, 'disk': disk, 'gpus': gpus,
+                'site': site, 'os_arch': os_arch, 'gpu_capability': None,
+                'gpu_names': None, 'cvmfs': True}
+    return make
+
+
+@pytest.fixture
+def server_cfg():
+    """The global config of a server with an empty state, see server.main"""
+    from pyglidein.server import set_state
+    from pyglidein.monitoring_store import MonitoringStore
+    from pyglidein.demand_history import DemandHistory
+    options = Values({'delay': 300, 'net_demand': False, 'pending_glidein_jobs': 1,
+                      'pending_glidein_age': 3600, 'state_history': 10})
+    cfg = {'options': options, 'config': {}, 'condor_q': False, 'state': [],
+           'monitoring': MonitoringStore(), 'metrics_sender_client': None,
+           'schedds': {}, 'tracker': None,
+           'state_generation': 0, 'state_cache': None, 'state_epoch': uuid.uuid4().hex,
+           'state_history': deque(maxlen=options.state_history),
+           'state_changed': tornado.locks.Condition(), 'state_updated': None,
+           'snapshot_store': None, 'glidein_slots': None, 'allocator': None,
+           'demand_history': DemandHistory(), 'forecast_cache': {}}
+    set_state(cfg, [])
+    return cfg
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers requests with `server.handler`, see `stub_server`"""
+    def do_GET(self):
+        self.reply(self.path)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.reply(json.loads(body.decode('utf-8')))
+
+    def reply(self, request):
+        self.server.requests.append(request)
+        code, ret = self.server.handler(request)
+        body = json.dumps(ret).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    """
+    A server for the client, answering every request (the decoded json
+    body of a POST, or the path of a GET) with `handler(request)`, which
+    returns (http code, json response). Requests are kept in `requests`.
+    """
+    srv = HTTPServer(('127.0.0.1', 0), StubHandler)
+    srv.requests = []
+    srv.handler = lambda request: (404, None)
+    srv.address = 'http://127.0.0.1:{}/jsonrpc'.format(srv.server_port)
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
@@ -0,0 +1,64 @@
+from __future__ import absolute_import, division, print_function
+
+import time
+
+from pyglidein.allocation import DemandAllocator
+from pyglidein.server import StateIndex
+
+
+def test_split():
+    for count in (0, 1, 7, 100):
+        share = DemandAllocator.split(('key',), count, ['a', 'b', 'c'])
+        assert sum(share.values()) == count
+        assert max(share.values()) - min(share.values()) <= 1
+
+
+def test_allocate(row):
+    index = StateIndex([row(10), row(3, cpus=4), row(5, gpus=1)])
+    allocator = DemandAllocator()
+    allocator.touch('a')
+    allocator.touch('b', {'cpu_only': True})
+    shares = dict((uuid, allocator.allocate(uuid, index)) for uuid in ('a', 'b'))
+
+    # cpu rows are split, the gpu row only goes to the client that can run it
+    assert sum(r['count'] for r in shares['a'] if r['gpus']) == 5
+    assert not any(r['gpus'] for r in shares['b'])
+    for cpus, total in ((1, 10), (4, 3)):
+        counts = [r['count'] for uuid in shares for r in shares[uuid]
+                  if r['cpus'] == cpus and not r['gpus']]
+        assert sum(counts) == total
+    assert all(r['total_count'] >= r['count'] for r in shares['a'] + shares['b'])
+    assert allocator.get_leases()['a']['clients'] == 2
+
+
+def test_allocate_pending_jobs(row):
+    index = StateIndex([row(10)])
+    allocator = DemandAllocator()
+    allocator.touch('a')
+    assert allocator.allocate('a', index, pending_jobs=4)[0]['count'] == 6
+    assert allocator.allocate('a', index, pending_jobs=10) == []
+
+
+def test_expire(row):
+    index = StateIndex([row(10)])
+    allocator = DemandAllocator(lease_time=60)
+    allocator.touch('a')
+    allocator.touch('b', seen=time.time()-120)
+    assert allocator.active() == ['a']
+    assert allocator.allocate('a', index)[0]['count'] == 10
+
+
+def test_touch():
+    allocator = DemandAllocator()
+    assert allocator.touch('a', seen=100)
+    assert not allocator.touch('a', seen=50)
+    assert allocator.last_seen('a') == 100
+    assert allocator.touch('a', {'cpu_only': True})
+
+
+def test_dump_restore():
+    allocator = DemandAllocator()
+    allocator.touch('a', {'cpu_only': True}, seen=time.time())
+    other = DemandAllocator()
+    other.restore(allocator.dump())
+    assert other.dump() == allocator.dump()
@@ -0,0 +1,51 @@
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+from pyglidein.client_util import Client, StateSync
+
+
+def test_batch(stub_server):
+    def handler(request):
+        ret = [{'jsonrpc': '2.0', 'result': 'ok', 'id': request[0]['id']},
+               {'jsonrpc': '2.0', 'id': request[1]['id'],
+                'error': {'code': -32602, 'message': 'Invalid params', 'data': 'bad'}}]
+        # the third call gets no response
+        return 200, list(reversed(ret))
+    stub_server.handler = handler
+    ret = Client(address=stub_server.address).batch([
+        ('get_state', {}), ('get_schedds', {}), ('get_leases', {})])
+    assert ret[0] == 'ok'
+    assert isinstance(ret[1], Exception)
+    assert 'Invalid params' in str(ret[1])
+    assert isinstance(ret[2], Exception)
+    assert [r['method'] for r in stub_server.requests[0]] == ['get_state', 'get_schedds',
+                                                              'get_leases']
+
+
+def test_batch_rejected(stub_server):
+    stub_server.handler = lambda request: (200, {'jsonrpc': '2.0', 'id': None, 'error': {
+        'code': -32600, 'message': 'Invalid Request'}})
+    client = Client(address=stub_server.address)
+    with pytest.raises(Exception):
+        client.batch([('get_state', {})])
+    with pytest.raises(Exception):
+        client.batch([('_private', {})])
+
+
+def test_state_with_monitoring(stub_server):
+    def handler(request):
+        if isinstance(request, list):
+            return 200, [
+                {'jsonrpc': '2.0', 'id': request[0]['id'],
+                 'error': {'code': -32602, 'message': 'Invalid params'}},
+                {'jsonrpc': '2.0', 'id': request[1]['id'], 'result': {
+                    'epoch': 'e1', 'generation': 1, 'full': True,
+                    'state': [{'cpus': 1, 'count': 10}]}}]
+        return 404, None
+    stub_server.handler = handler
+    sync = StateSync(stub_server.address)
+    # a failed monitoring report does not lose the state
+    assert sync.get_state({'uuid': 'a'}) == [{'cpus': 1, 'count': 10}]
+    assert [r['method'] for r in stub_server.requests[0]] == ['monitoring', 'get_state_delta']
+    assert len(stub_server.requests) == 1
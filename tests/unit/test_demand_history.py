@@ -0,0 +1,92 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+
+from pyglidein.demand_history import (DemandTier, DemandHistory, fit_trend,
+                                      daily_profile, day)
+
+bucket = (('cpus', 1), ('gpus', 0))
+
+
+def test_tier_average():
+    tier = DemandTier(300, 4)
+    assert tier.record(600, {bucket: 10})
+    assert not tier.record(700, {bucket: 20})
+    assert tier.record(900, {bucket: 5})
+    assert tier.series(bucket) == [(600, 15.), (900, 5.)]
+    assert tier.series(bucket, since=900) == [(900, 5.)]
+    # buckets missing from a sample count as 0
+    assert tier.series(('other',)) == [(600, 0.), (900, 0.)]
+
+
+def test_tier_wraps():
+    tier = DemandTier(300, 4)
+    for i in range(6):
+        tier.record(i*300, {bucket: i})
+    assert tier.series(bucket) == [(600, 2.), (900, 3.), (1200, 4.), (1500, 5.)]
+    # samples older than the slot holds are ignored
+    assert not tier.record(0, {bucket: 100})
+    # a gap clears the slots left over from before it
+    tier.record(10*300, {bucket: 7})
+    assert tier.series(bucket) == [(3000, 7.)]
+
+
+def test_fit_trend():
+    assert fit_trend([], 0) == (0., 0.)
+    assert fit_trend([(0, 5.)], 100) == (5., 0.)
+    level, slope = fit_trend([(t, 2.*t) for t in range(10)], 20)
+    assert abs(level - 40.) < 1e-9
+    assert abs(slope - 2.) < 1e-9
+
+
+def test_daily_profile():
+    assert daily_profile([(0, 1.), (3600, 1.)], 3600) is None
+    series = [(t, 10. if t % day < day//2 else 0.) for t in range(0, 2*day, 3600)]
+    profile = daily_profile(series, 3600)
+    assert profile[0] == 5.
+    assert profile[23] == -5.
+
+
+def test_forecast_trend():
+    history = DemandHistory(tiers=((300, 12),), trend_window=3600)
+    for i in range(12):
+        history.record(i*300, {bucket: 100 + i*10})
+    now = 11*300
+    ret = history.forecast(bucket, now, [now, now+600])
+    assert not ret['seasonal']
+    assert ret['current'] == 210.
+    assert abs(ret['trend'] - 120.) < 1e-6
+    assert abs(ret['forecast'][1] - 230.) < 1e-6
+    # the forecast is never negative
+    assert history.forecast(bucket, now, [now-10*day])['forecast'] == [0.]
+
+
+def test_forecast_seasonal():
+    history = DemandHistory(tiers=((300, 12), (3600, 72)))
+    for t in range(0, 3*day, 3600):
+        history.record(t, {bucket: 10. if t % day < day//2 else 0.})
+    ret = history.forecast(bucket, 3*day, [3*day + 3600])
+    assert ret['seasonal']
+
+
+def test_record_drops_empty_buckets():
+    history = DemandHistory(tiers=((300, 2),))
+    history.record(0, {bucket: 1})
+    history.record(300, {})
+    assert bucket in history.buckets()
+    history.record(600, {})
+    assert bucket not in history.buckets()
+
+
+def test_dump_restore():
+    history = DemandHistory()
+    history.record(600, {bucket: 3})
+    dump = json.loads(json.dumps(history.dump()))
+    restored = DemandHistory()
+    restored.restore(dump)
+    assert restored.last == 600
+    assert restored.tiers[0].series(bucket) == [(600, 3.)]
+    # a history with other tiers is not restored
+    other = DemandHistory(tiers=((60, 10),))
+    other.restore(dump)
+    assert other.last is None
@@ -0,0 +1,164 @@
+from __future__ import absolute_import, division, print_function
+
+import sys
+import types
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from optparse import Values
+
+import pytest
+import tornado.locks
+from tornado.ioloop import IOLoop
+
+from pyglidein.server import JobEventTracker, condor_q_bindings
+
+classad = pytest.importorskip('classad')
+
+SUBMIT, EXECUTE, JOB_EVICTED, JOB_HELD, JOB_RELEASED, JOB_ABORTED = range(6)
+
+
+class Event(object):
+    def __init__(self, type, cluster, proc=0):
+        self.type = type
+        self.cluster = cluster
+        self.proc = proc
+
+
+class Schedd(object):
+    """Answers queries from the ads in `jobs`, by schedd name"""
+    jobs = {}
+    queries = []
+
+    def __init__(self, ad):
+        self.name = ad['Name']
+
+    def xquery(self, requirements='true', projection=None, opts=None):
+        Schedd.queries.append((self.name, requirements))
+        expr = classad.ExprTree(requirements)
+        return [ad for ad in Schedd.jobs.get(self.name, []) if expr.eval(ad) is True]
+
+
+class JobEventLog(object):
+    """Returns the events appended to `events` since the last read"""
+    events_list = []
+
+    def __init__(self, path):
+        self.path = path
+
+    def events(self, stop_after=None):
+        ret = list(JobEventLog.events_list)
+        del JobEventLog.events_list[:]
+        return iter(ret)
+
+
+class Collector(object):
+    def locate(self, daemon_type, name='local'):
+        return classad.ClassAd({'Name': name})
+
+    def locateAll(self, daemon_type):
+        return [classad.ClassAd({'Name': name}) for name in sorted(Schedd.jobs)]
+
+
+@pytest.fixture
+def htcondor(monkeypatch):
+    """A fake htcondor module, with a single local schedd"""
+    module = types.ModuleType('htcondor')
+    module.JobEventType = Values({'SUBMIT': SUBMIT, 'EXECUTE': EXECUTE,
+                                  'JOB_EVICTED': JOB_EVICTED, 'JOB_HELD': JOB_HELD,
+                                  'JOB_RELEASED': JOB_RELEASED, 'JOB_ABORTED': JOB_ABORTED,
+                                  'JOB_TERMINATED': 6, 'JOB_RECONNECT_FAILED': 7,
+                                  'SHADOW_EXCEPTION': 8})
+    module.DaemonTypes = Values({'Schedd': 'schedd'})
+    module.QueryOpts = Values({'Default': 0, 'AutoCluster': 1})
+    module.Collector = Collector
+    module.Schedd = Schedd
+    module.JobEventLog = JobEventLog
+    monkeypatch.setitem(sys.modules, 'htcondor', module)
+    Schedd.jobs = {'local': []}
+    Schedd.queries = []
+    JobEventLog.events_list = []
+    return module
+
+
+def ad(cluster, proc=0, status=1, cpus=1):
+    return classad.ClassAd({'ClusterId': cluster, 'ProcId': proc, 'JobStatus': status,
+                            'RequestCPUs': cpus, 'RequestMemory': 1000,
+                            'RequestDisk': 1000000})
+
+
+def set_status(cluster, status):
+    for job_ad in Schedd.jobs['local']:
+        if job_ad['ClusterId'] == cluster:
+            job_ad['JobStatus'] = status
+
+
+@pytest.fixture
+def options():
+    return Values({'constraint': None, 'user': None, 'aggregate': False,
+                   'delay': 300, 'schedd_timeout': 60})
+
+
+def test_events(htcondor, options, job):
+    tracker = JobEventTracker('event.log', options)
+    assert tracker.schedd_name == 'local'
+    assert tracker.resync() == Counter()
+    # nothing happened
+    assert tracker.update() is None
+
+    # submits are looked up in the schedd
+    Schedd.jobs['local'] += [ad(1), ad(1, 1), ad(2, cpus=4)]
+    JobEventLog.events_list += [Event(SUBMIT, 1), Event(SUBMIT, 1, 1), Event(SUBMIT, 2)]
+    del Schedd.queries[:]
+    assert tracker.update() == Counter({job(): 2, job(cpus=4): 1})
+    assert len(Schedd.queries) == 1
+    assert 'ClusterId == 1 || ClusterId == 2' in Schedd.queries[0][1]
+
+    # jobs starting or leaving are removed without a query
+    set_status(2, 2)
+    JobEventLog.events_list += [Event(EXECUTE, 2), Event(JOB_ABORTED, 1, 1)]
+    del Schedd.queries[:]
+    assert tracker.update() == Counter({job(): 1})
+    assert Schedd.queries == []
+
+    # held and released, evicted back to idle
+    JobEventLog.events_list += [Event(JOB_HELD, 1)]
+    assert tracker.update() == Counter()
+    set_status(2, 1)
+    JobEventLog.events_list += [Event(JOB_RELEASED, 1), Event(JOB_EVICTED, 2)]
+    assert tracker.update() == Counter({job(): 1, job(cpus=4): 1})
+
+    # submitted and started before the update, never counted
+    Schedd.jobs['local'].append(ad(3, status=2))
+    JobEventLog.events_list += [Event(SUBMIT, 3), Event(EXECUTE, 3)]
+    assert tracker.update() == Counter({job(): 1, job(cpus=4): 1})
+    assert (3, 0) not in tracker.jobs
+
+
+def test_resync(htcondor, options, job):
+    tracker = JobEventTracker('event.log', options)
+    tracker.resync()
+    # job 2 has no event, only a full query finds it
+    Schedd.jobs['local'] += [ad(1), ad(2, cpus=4)]
+    JobEventLog.events_list += [Event(SUBMIT, 1)]
+    assert tracker.resync() == Counter({job(): 1, job(cpus=4): 1})
+    # pending events were superseded by the query
+    assert tracker.update() is None
+
+
+def test_condor_q_resync(htcondor, options, job):
+    """The regular query of the pool resyncs the tracked schedd"""
+    Schedd.jobs = {'local': [ad(1)], 'other': [ad(2, cpus=4)]}
+    executor = ThreadPoolExecutor(max_workers=2)
+    cfg = {'options': options, 'schedds': {}, 'executor': executor,
+           'schedd_executor': executor, 'schedd_slots': tornado.locks.Semaphore(2),
+           'tracker': JobEventTracker('event.log', options)}
+    cfg['tracker'].resync()
+
+    # a missed event
+    Schedd.jobs['local'].append(ad(3))
+    assert cfg['tracker'].update() is None
+    counter = IOLoop.current().run_sync(lambda: condor_q_bindings(cfg))
+    assert counter == Counter({job(): 2, job(cpus=4): 1})
+    assert cfg['tracker'].counter == Counter({job(): 2})
+    assert cfg['schedds']['local']['counter'] == cfg['tracker'].counter
+    executor.shutdown()
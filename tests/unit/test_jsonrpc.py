@@ -0,0 +1,58 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from pyglidein.server import server
+
+
+class TestJSONRPC(AsyncHTTPTestCase):
+    @pytest.fixture(autouse=True)
+    def set_cfg(self, server_cfg):
+        self.cfg = server_cfg
+
+    def get_app(self):
+        return server(self.cfg).application
+
+    def post(self, request):
+        return self.fetch('/jsonrpc', method='POST', body=json.dumps(request))
+
+    def test_call(self):
+        response = self.post({'jsonrpc': '2.0', 'method': 'get_state', 'id': 1})
+        assert response.code == 200
+        assert json.loads(response.body.decode('utf-8')) == {'jsonrpc': '2.0', 'result': [],
+                                                             'id': 1}
+
+    def test_bad_method(self):
+        response = self.post({'jsonrpc': '2.0', 'method': 5, 'id': 1})
+        assert response.code == 400
+        assert json.loads(response.body.decode('utf-8'))['error']['code'] == -32600
+        response = self.post({'jsonrpc': '2.0', 'method': 'nope', 'id': 1})
+        assert json.loads(response.body.decode('utf-8'))['error']['code'] == -32601
+
+    def test_batch(self):
+        response = self.post([{'jsonrpc': '2.0', 'method': 'get_state', 'id': 1},
+                              {'jsonrpc': '2.0', 'method': 'get_schedds', 'id': 2},
+                              {'jsonrpc': '2.0', 'method': 'get_state'},
+                              {'jsonrpc': '2.0', 'method': 'nope'},
+                              {'jsonrpc': '2.0', 'method': 5},
+                              3])
+        assert response.code == 200
+        ret = json.loads(response.body.decode('utf-8'))
+        # the notifications get no response, the invalid requests do
+        assert [r['id'] for r in ret] == [1, 2, None, None]
+        assert ret[0]['result'] == []
+        assert [r['error']['code'] for r in ret[2:]] == [-32600, -32600]
+
+    def test_empty_batch(self):
+        response = self.post([])
+        assert response.code == 400
+        assert json.loads(response.body.decode('utf-8'))['error']['code'] == -32600
+
+    def test_notification_batch(self):
+        response = self.post([{'jsonrpc': '2.0', 'method': 'get_state'},
+                              {'jsonrpc': '2.0', 'method': 'nope'}])
+        assert response.code == 204
+        assert response.body == b''
@@ -0,0 +1,165 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import pickle
+import shutil
+import socket
+import struct
+import tempfile
+
+import tornado.gen
+import tornado.web
+import tornado.httpserver
+from tornado.httpclient import AsyncHTTPClient
+from tornado.tcpserver import TCPServer
+from tornado.testing import AsyncTestCase, bind_unused_port, gen_test
+
+from pyglidein.metrics_sinks import (GraphiteSink, StatsdSink, InfluxdbSink,
+                                     PrometheusSink, QueuedSink)
+
+
+def datapoints(n=3, partition='Cluster'):
+    return [('uuid1', partition, 'glideins_running', 1500000000+i, i) for i in range(n)]
+
+
+class GraphiteServer(TCPServer):
+    def __init__(self):
+        super(GraphiteServer, self).__init__()
+        self.received = []
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        while True:
+            try:
+                size = struct.unpack('!L', (yield stream.read_bytes(4)))[0]
+                self.received.extend(pickle.loads((yield stream.read_bytes(size))))
+            except Exception:
+                break
+
+
+class InfluxdbHandler(tornado.web.RequestHandler):
+    def initialize(self, received):
+        self.received = received
+
+    def post(self):
+        self.received.append((self.request.headers.get('Authorization'),
+                              self.request.body.decode('utf-8')))
+        self.set_status(204)
+
+
+class FlakySink(QueuedSink):
+    """Sink failing on the batches in `fail`"""
+    name = 'flaky'
+
+    def __init__(self, config):
+        super(FlakySink, self).__init__(config)
+        self.sent = []
+        self.fail = set()
+
+    @tornado.gen.coroutine
+    def write(self, batch):
+        if batch[0][3] in self.fail:
+            raise Exception('fail')
+        self.sent.extend(batch)
+
+
+class TestSinks(AsyncTestCase):
+    def setUp(self):
+        super(TestSinks, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestSinks, self).tearDown()
+
+    @gen_test
+    def test_graphite(self):
+        sock, port = bind_unused_port()
+        server = GraphiteServer()
+        server.add_socket(sock)
+        sink = GraphiteSink({'graphite_server': '127.0.0.1', 'graphite_port': port})
+        sink.put(datapoints())
+        yield sink.flush()
+        for _ in range(50):
+            if len(server.received) == 3:
+                break
+            yield tornado.gen.sleep(0.01)
+        sink.stop()
+        server.stop()
+        assert server.received[0] == ('pyglidein.uuid1.Cluster.glideins.running',
+                                      (1500000000, 0))
+        assert len(server.received) == 3
+        assert sink.queue_depth() == 0
+
+    @gen_test
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        sink = StatsdSink({'statsd_server': '127.0.0.1',
+                           'statsd_port': server.getsockname()[1]})
+        sink.put(datapoints(2))
+        yield sink.flush()
+        data = server.recv(65536)
+        sink.stop()
+        server.close()
+        assert data.split(b'\n') == [b'pyglidein.uuid1.Cluster.glideins.running:0|g',
+                                     b'pyglidein.uuid1.Cluster.glideins.running:1|g']
+
+    def test_statsd_packets(self):
+        sink = StatsdSink({'statsd_server': '127.0.0.1', 'statsd_max_packet': 100})
+        packets = sink.packets(datapoints(10))
+        assert len(packets) > 1
+        assert all(len(p) <= 100 for p in packets)
+        assert sum(p.count(b'\n')+1 for p in packets) == 10
+
+    @gen_test
+    def test_influxdb(self):
+        received = []
+        sock, port = bind_unused_port()
+        app = tornado.web.Application([(r'/write', InfluxdbHandler, {'received': received})])
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_socket(sock)
+        sink = InfluxdbSink({'influxdb_url': 'http://127.0.0.1:{}/write?db=test'.format(port),
+                             'influxdb_token': 'secret'})
+        sink.put(datapoints(2) + datapoints(1, partition='GPU Cluster'))
+        yield sink.flush()
+        server.stop()
+        assert received == [('Token secret', '\n'.join([
+            r'pyglidein,uuid=uuid1,partition=Cluster glideins_running=0i 1500000000',
+            r'pyglidein,uuid=uuid1,partition=Cluster glideins_running=1i 1500000001',
+            r'pyglidein,uuid=uuid1,partition=GPU\ Cluster glideins_running=0i 1500000000']))]
+
+    @gen_test
+    def test_prometheus(self):
+        sock, port = bind_unused_port()
+        sock.close()
+        sink = PrometheusSink({'prometheus_port': port, 'prometheus_address': '127.0.0.1'})
+        sink.start()
+        sink.put(datapoints(2))
+        response = yield AsyncHTTPClient().fetch('http://127.0.0.1:{}/metrics'.format(port))
+        sink.stop()
+        assert response.body.decode('utf-8') == (
+            '# TYPE pyglidein_client_glideins_running gauge\n'
+            'pyglidein_client_glideins_running{uuid="uuid1",partition="Cluster"} 1\n')
+
+    @gen_test
+    def test_spill_replay(self):
+        spill_file = os.path.join(self.tmpdir, 'spill')
+        sink = FlakySink({'queue_size': 1, 'batch_size': 1, 'flaky_spill_file': spill_file})
+        for d in datapoints(4):
+            sink.put([d])
+        assert sink.queue_depth() == 1
+        assert len(sink.read_spilled()) == 3
+
+        # the third spilled batch fails, the first two are not sent again
+        sink.fail.add(1500000003)
+        yield sink.flush()
+        assert [d[3] for d in sink.sent] == [1500000001, 1500000002]
+        assert [b for b, _ in sink.read_spilled()] == [[datapoints(4)[3]]]
+
+        sink.fail.clear()
+        sink.next_attempt = 0
+        yield sink.flush()
+        assert [d[3] for d in sink.sent] == [1500000001, 1500000002, 1500000003, 1500000000]
+        assert not sink.has_spilled()
@@ -0,0 +1,66 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import time
+
+from pyglidein.monitoring_store import MetricsRing, MonitoringStore
+
+
+def test_ring():
+    ring = MetricsRing(3)
+    for i in range(5):
+        ring.append({'timestamp': 100 + i, 'glideins_idle': i, 'glideins_running': 'x'})
+    samples = ring.samples()
+    assert [s['timestamp'] for s in samples] == [102, 103, 104]
+    assert [s['glideins_idle'] for s in samples] == [2, 3, 4]
+    assert samples[0]['glideins_running'] == 0
+    assert MetricsRing.restore(3, json.loads(json.dumps(ring.dump()))).samples() == samples
+    # a dump of another size is dropped
+    assert MetricsRing.restore(4, ring.dump()).samples() == []
+
+
+def test_ttl():
+    store = MonitoringStore(ttl=60)
+    store.set('old', {'timestamp': 1}, last_seen=time.time() - 120)
+    store['new'] = {'timestamp': 2}
+    assert list(store) == ['new']
+    assert store.last_seen('old') is None
+    assert [info['timestamp'] for info in store.recent(60)] == [2]
+
+
+def test_max_clients():
+    store = MonitoringStore(max_clients=2)
+    store['a'] = {}
+    store['b'] = {}
+    store['a'] = {'glideins_idle': 1}
+    store['c'] = {}
+    # b reported longest ago
+    assert sorted(store) == ['a', 'c']
+    assert store['a'] == {'glideins_idle': 1}
+    assert len(store) == 2
+
+
+def test_history():
+    store = MonitoringStore(history=2)
+    for i in range(3):
+        store['a'] = {'timestamp': i, 'glideins_idle': i}
+    assert [s['glideins_idle'] for s in store.history('a')] == [1, 2]
+
+
+def test_load():
+    store = MonitoringStore(ttl=60)
+    now = time.time()
+    store.load({'a': {'timestamp': now - 10}, 'b': {'timestamp': now - 120},
+                'c': {'timestamp': now - 20}})
+    assert list(store) == ['c', 'a']
+    assert store.last_seen('a') == now - 10
+
+
+def test_dump_restore():
+    store = MonitoringStore()
+    store['a'] = {'timestamp': 1, 'glideins_idle': 3}
+    other = MonitoringStore()
+    other.restore(json.loads(json.dumps(store.dump())))
+    assert other['a'] == store['a']
+    assert other.history('a') == store.history('a')
+    assert other.version > 0
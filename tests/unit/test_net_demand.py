@@ -0,0 +1,52 @@
+from __future__ import absolute_import, division, print_function
+
+from collections import Counter
+
+from pyglidein.net_demand import (slot_from_ad, slot_matches, fit_demand,
+                                  subtract_pending, net_demand)
+
+
+def test_slot_from_ad():
+    s = slot_from_ad({'Cpus': 4, 'Memory': 8000, 'Disk': 2000000, 'GLIDEIN_Site': 'SiteA'})
+    assert (s['cpus'], s['memory'], s['disk'], s['gpus']) == (4, 8000, 2000, 0)
+    assert s['site'] == 'SiteA'
+    assert s['cvmfs'] is False
+
+
+def test_slot_matches(job, slot):
+    assert slot_matches(job(), slot())
+    assert slot_matches(job(site='SiteA,SiteB'), slot())
+    assert not slot_matches(job(site='SiteB'), slot())
+    assert not slot_matches(job(os_arch='RHEL_8_x86_64'), slot())
+
+
+def test_fit_demand(job, slot):
+    slots = [slot(cpus=8, memory=16000)]
+    ret = fit_demand(Counter({job(cpus=4): 1, job(): 10}), slots)
+    # the 4 cpu job goes first, then 4 single cpu jobs fit in the rest
+    assert ret[job(cpus=4)] == 0
+    assert ret[job()] == 6
+    assert slots[0]['cpus'] == 0
+
+
+def test_fit_demand_no_resources(job, slot):
+    key = job(cpus=0, memory=0, disk=0)
+    slots = [slot()]
+    ret = fit_demand(Counter({key: 5}), slots)
+    assert ret[key] == 5
+    assert slots[0]['cpus'] == 8
+
+
+def test_subtract_pending(job):
+    ret = subtract_pending(Counter({job(): 6, job(cpus=2): 3}), 5)
+    assert sum(ret.values()) == 4
+    assert all(v >= 0 for v in ret.values())
+    assert subtract_pending(Counter({job(): 2}), 10)[job()] == 0
+
+
+def test_net_demand(job, slot):
+    slots = [slot(cpus=2)]
+    ret = net_demand(Counter({job(): 5, job(site='SiteB'): 3}), slots, 1)
+    assert sum(ret.values()) == 5
+    assert slots[0]['cpus'] == 2
+    assert all(v > 0 for v in ret.values())
@@ -0,0 +1,40 @@
+from __future__ import absolute_import, division, print_function
+
+from pyglidein import client_util
+from pyglidein.client_util import PresignedURLProvider
+
+config = {'Glidein': {'site': 'Site'}, 'StartdLogging': {'bucket': 'logs'}}
+
+
+class FakeMinio(object):
+    def __init__(self):
+        self.minted = []
+
+    def presigned_put_object(self, bucket, filename, expires):
+        self.minted.append(filename)
+        return 'put/{}/{}'.format(bucket, filename)
+
+    def presigned_get_object(self, bucket, filename):
+        return 'get/{}/{}'.format(bucket, filename)
+
+
+def test_get(monkeypatch):
+    minio = FakeMinio()
+    monkeypatch.setattr(client_util, 'get_minio_client', lambda config, secrets: minio)
+    provider = PresignedURLProvider(config, {})
+    urls = provider.get(1)
+    # only the urls of one glidein are minted
+    assert len(minio.minted) == 1
+    assert urls == [('put/logs/' + minio.minted[0], 'get/logs/' + minio.minted[0])]
+    assert minio.minted[0].startswith('Site_')
+    urls = provider.get(3)
+    assert len(urls) == 3
+    assert len(set(urls)) == 3
+    assert len(minio.minted) == 4
+
+
+def test_get_error(monkeypatch):
+    def fail(config, secrets):
+        raise Exception('no S3')
+    monkeypatch.setattr(client_util, 'get_minio_client', fail)
+    assert PresignedURLProvider(config, {}).get(2) == []
@@ -0,0 +1,59 @@
+from __future__ import absolute_import, division, print_function
+
+import time
+import random
+from collections import Counter
+
+from pyglidein.quantize import (round_up_step, round_up_log, quantize_key,
+                                merge_rows, quantize)
+
+
+def covers(bucket, key):
+    return (all(bucket[i] >= key[i] for i in range(4)) and
+            bool(bucket[3]) == bool(key[3]) and bucket[4:] == key[4:])
+
+
+def test_round_up_step():
+    assert round_up_step(1001, 500) == 1500
+    assert round_up_step(1000, 500) == 1000
+    assert round_up_step(1001, None) == 1001
+
+
+def test_round_up_log():
+    assert round_up_log(1000, 1) == 1024
+    for value in (1, 3, 1000, 1025, 3000):
+        assert round_up_log(value, 4) >= value
+
+
+def test_quantize_key(job):
+    assert quantize_key(job(memory=1001, disk=1), {'memory_step': 500,
+                                                    'disk_step': 1000}) == job(memory=1500)
+
+
+def test_merge_rows_keeps_groups_apart(job):
+    counter = Counter({job(): 1, job(memory=2000): 1, job(gpus=1): 1,
+                       job(os_arch='RHEL_7_x86_64'): 1})
+    merged = merge_rows(counter, 1)
+    # only the two plain cpu rows can merge
+    assert merged == Counter({job(memory=2000): 2, job(gpus=1): 1,
+                              job(os_arch='RHEL_7_x86_64'): 1})
+
+
+def test_merge_rows_merges_closest(job):
+    counter = Counter({job(memory=1000): 10, job(memory=1100): 10, job(memory=8000): 1})
+    assert merge_rows(counter, 2) == Counter({job(memory=1100): 20, job(memory=8000): 1})
+
+
+def test_quantize_many_distinct_rows(job):
+    rand = random.Random(1)
+    counter = Counter()
+    while len(counter) < 2000:
+        counter[job(cpus=rand.choice([1, 2, 4, 8]), memory=rand.randint(1, 64000),
+                    disk=rand.randint(1, 100000), gpus=rand.choice([0, 0, 0, 1]))] += 1
+    start = time.time()
+    ret = quantize(counter, {'max_rows': 20})
+    assert time.time() - start < 10
+    assert len(ret) <= 20
+    assert sum(ret.values()) == sum(counter.values())
+    for key in counter:
+        assert any(covers(bucket, key) for bucket in ret)
@@ -0,0 +1,69 @@
+from __future__ import absolute_import, division, print_function
+
+import sys
+
+import pytest
+
+from pyglidein.requirements import RequirementsAnalyzer, no_requirements
+
+classad = pytest.importorskip('classad')
+
+
+def analyze(text, **kwargs):
+    return RequirementsAnalyzer(**kwargs).analyze(text)
+
+
+def test_os_arch():
+    assert analyze('OpSysMajorVer == 7').os_arch == 'RHEL_7_x86_64'
+    ret = analyze('OS_ARCH == "RHEL_8_x86_64" || OS_ARCH == "RHEL_9_x86_64"')
+    assert ret.os_arch == 'RHEL_8_x86_64,RHEL_9_x86_64'
+    assert ret.os is None
+    ret = analyze('OpSysAndVer =?= "SL6"')
+    assert (ret.os, ret.os_arch) == ('sl6', 'RHEL_6_x86_64')
+    assert analyze('Memory > 1000').os_arch is None
+
+
+def test_gpu():
+    assert analyze('CUDACapability >= 7.0').gpu_capability == 7.0
+    assert analyze('CUDACapability > 3.0').gpu_capability == 3.5
+    assert analyze('CUDACapability >= 1.0').gpu_capability is None
+    assert analyze('stringListIMember(GPU_NAMES, "V100")').gpu_names == 'V100'
+    assert analyze('GPU_NAMES == "Tesla V100"').gpu_names == 'Tesla V100'
+
+
+def test_site():
+    assert analyze('GLIDEIN_Site == "SiteA" || GLIDEIN_Site == "SiteB"').site == 'SiteA,SiteB'
+    assert analyze('stringListMember(GLIDEIN_Site, "SiteA,SiteB")').site == 'SiteA,SiteB'
+    # literals of other attributes are not tried as sites
+    assert analyze('Owner == "SiteA"').site is None
+
+
+def test_cvmfs():
+    assert analyze('HAS_CVMFS_icecube_opensciencegrid_org').cvmfs
+    ret = analyze('TARGET.HAS_CVMFS_icecube_opensciencegrid_org && OpSysMajorVer == 7')
+    assert (ret.cvmfs, ret.os_arch) == (True, 'RHEL_7_x86_64')
+    assert not analyze('OpSysMajorVer == 7').cvmfs
+
+
+def test_cache():
+    analyzer = RequirementsAnalyzer(maxsize=2)
+    for text in ('OpSysMajorVer == 7', 'OpSysMajorVer == 8', 'OpSysMajorVer == 7',
+                 'OpSysMajorVer == 9', 'OpSysMajorVer == 8'):
+        analyzer.analyze(text)
+    # 8 is evicted by 9, since 7 was used more recently
+    assert (analyzer.hits, analyzer.misses) == (1, 4)
+    assert list(analyzer.cache) == ['OpSysMajorVer == 9', 'OpSysMajorVer == 8']
+
+
+def test_max_probes():
+    # over the budget, the substring matching is used
+    assert analyze('CUDACapability >= 7.0', max_probes=1) == no_requirements
+    assert analyze('OpSysAndVer =?= "SL6"', max_probes=1).os == 'sl6'
+
+
+def test_legacy(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'classad', None)
+    analyzer = RequirementsAnalyzer()
+    assert not analyzer.check()
+    assert analyzer.analyze('CUDACapability >= 7.0') == no_requirements
+    assert analyzer.analyze('OpSysAndVer =?= "SL6"').os == 'sl6'
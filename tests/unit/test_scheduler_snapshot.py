@@ -0,0 +1,178 @@
+from __future__ import absolute_import, division, print_function
+
+import time
+
+from pyglidein.scheduler_snapshot import (Job, SchedulerSnapshot, SlurmSnapshot,
+                                          PBSSnapshot, GridEngineSnapshot, LSFSnapshot,
+                                          get_snapshot)
+
+config = {
+    'Cluster': {'user': 'glidein', 'partitions': ['CPU', 'GPU']},
+    'CPU': {'partition': 'cpu'},
+    'GPU': {'partition': 'gpu', 'job_name': 'glidein'},
+}
+
+
+class StaticSnapshot(SchedulerSnapshot):
+    def __init__(self, jobs, **kwargs):
+        super(StaticSnapshot, self).__init__(config, **kwargs)
+        self.static_jobs = jobs
+        self.queries = 0
+
+    def query(self):
+        self.queries += 1
+        return list(self.static_jobs)
+
+
+def jobs():
+    now = time.time()
+    return [
+        Job('1', 'idle', 'cpu', now - 100, 'glidein'),
+        Job('2', 'idle', 'cpu', now - 300, 'glidein'),
+        Job('3', 'running', 'cpu', now - 1000, 'glidein'),
+        Job('4_1', 'idle', 'gpu', now - 50, 'glidein'),
+        Job('5', 'idle', 'gpu', now - 10, 'other'),
+    ]
+
+
+def test_ttl_and_invalidate():
+    snapshot = StaticSnapshot(jobs(), ttl=60)
+    snapshot.get()
+    snapshot.running('CPU')
+    snapshot.idle('GPU')
+    assert snapshot.queries == 1
+    snapshot.invalidate()
+    snapshot.get()
+    assert snapshot.queries == 2
+    snapshot.updated -= 61
+    snapshot.get()
+    assert snapshot.queries == 3
+
+
+def test_partition_counts():
+    snapshot = StaticSnapshot(jobs())
+    assert snapshot.running('CPU') == 1
+    assert snapshot.idle('CPU') == 2
+    assert snapshot.idle('GPU') == 1
+    assert len(snapshot.partition_jobs('Cluster')) == 5
+
+
+def test_mma_idle_time():
+    snapshot = StaticSnapshot(jobs())
+    metrics = snapshot.get_mma_idle_time('CPU')
+    assert 99 <= metrics['min_idle_time']['CPU'] <= 101
+    assert 299 <= metrics['max_idle_time']['CPU'] <= 301
+    assert 199 <= metrics['avg_idle_time']['CPU'] <= 201
+    metrics = snapshot.get_mma_idle_time('GPU')
+    assert 49 <= metrics['max_idle_time']['GPU'] <= 51
+    assert StaticSnapshot([]).get_mma_idle_time()['avg_idle_time'] == {'Cluster': 0}
+
+
+def test_slurm_query():
+    class Slurm(SlurmSnapshot):
+        def run(self, cmd):
+            assert '-u glidein' in cmd
+            return ('100|PENDING|cpu|2020-01-01T10:00:00|glidein\n'
+                    '101|RUNNING|gpu|2020-01-01T11:00:00|glidein\n'
+                    '102|COMPLETING|cpu|N/A|glidein\n')
+    ret = Slurm(config).get()
+    assert [(j.id, j.state, j.partition) for j in ret] == [
+        ('100', 'idle', 'cpu'), ('101', 'running', 'gpu'), ('102', 'other', 'cpu')]
+    assert ret[0].submit_time is not None
+    assert ret[2].submit_time is None
+
+
+def test_pbs_query():
+    class PBS(PBSSnapshot):
+        def run(self, cmd):
+            return '\n'.join([
+                'Job Id: 200[1].server',
+                '    Job_Name = glidein',
+                '    job_state = Q',
+                '    queue = cpu',
+                '    qtime = Wed Jan  1 10:00:00 2020',
+                '',
+                'Job Id: 201.server',
+                '    Job_Name = glidein',
+                '    job_state = R',
+                '    queue = gpu',
+            ])
+    snapshot = PBS(config)
+    ret = snapshot.get()
+    assert [(j.id, j.state, j.partition, j.name) for j in ret] == [
+        ('200[1].server', 'idle', 'cpu', 'glidein'), ('201.server', 'running', 'gpu', 'glidein')]
+    assert ret[0].submit_time is not None
+    assert snapshot.job_ids() == set(['200', '201'])
+
+
+def test_grid_engine_query():
+    class GridEngine(GridEngineSnapshot):
+        def run(self, cmd):
+            assert '-g d' in cmd
+            return '''<?xml version='1.0'?>
+<job_info>
+  <queue_info>
+    <job_list state="running">
+      <JB_job_number>300</JB_job_number>
+      <JB_name>glidein</JB_name>
+      <state>r</state>
+      <JAT_start_time>2020-01-01T11:00:00.123</JAT_start_time>
+      <queue_name>gpu@node1</queue_name>
+      <tasks>1</tasks>
+    </job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending">
+      <JB_job_number>300</JB_job_number>
+      <JB_name>glidein</JB_name>
+      <state>qw</state>
+      <JB_submission_time>2020-01-01T10:00:00</JB_submission_time>
+      <queue_name></queue_name>
+      <hard_req_queue>gpu</hard_req_queue>
+      <tasks>2</tasks>
+    </job_list>
+    <job_list state="pending">
+      <JB_job_number>301</JB_job_number>
+      <JB_name>glidein</JB_name>
+      <state>hqw</state>
+      <JB_submission_time>2020-01-01T10:00:00</JB_submission_time>
+      <queue_name></queue_name>
+    </job_list>
+  </job_info>
+</job_info>'''
+    snapshot = GridEngine(config)
+    ret = snapshot.get()
+    assert [(j.id, j.state, j.partition) for j in ret] == [
+        ('300.1', 'running', 'gpu'), ('300.2', 'idle', 'gpu'), ('301', 'other', None)]
+    assert all(j.submit_time is not None for j in ret)
+    assert snapshot.idle('GPU') == 1
+    assert snapshot.job_ids() == set(['300', '301'])
+
+
+def test_lsf_query():
+    class LSF(LSFSnapshot):
+        def run(self, cmd):
+            assert '-u glidein' in cmd
+            return ('400|1|PEND|cpu|Jan  1 10:00 2020|glidein[1]\n'
+                    '400|2|RUN|cpu|Jan  1 10:00 2020|glidein[2]\n'
+                    '401|0|PEND|gpu|Jan  1 10:00|glidein\n')
+    snapshot = LSF(config)
+    ret = snapshot.get()
+    assert [(j.id, j.state, j.partition, j.name) for j in ret] == [
+        ('400[1]', 'idle', 'cpu', 'glidein'), ('400[2]', 'running', 'cpu', 'glidein'),
+        ('401', 'idle', 'gpu', 'glidein')]
+    assert all(j.submit_time is not None for j in ret)
+    assert ret[2].submit_time <= time.time() + 86400
+    assert snapshot.idle('CPU') == 1
+    assert snapshot.job_ids() == set(['400', '401'])
+
+
+def test_get_snapshot():
+    assert get_snapshot(config, 'slurm') is None
+    enabled = dict(config, Cluster=dict(config['Cluster'], scheduler_snapshot=True,
+                                        snapshot_ttl=5))
+    snapshot = get_snapshot(enabled, 'slurm')
+    assert isinstance(snapshot, SlurmSnapshot)
+    assert snapshot.ttl == 5
+    assert isinstance(get_snapshot(enabled, 'uge'), GridEngineSnapshot)
+    assert get_snapshot(enabled, 'other') is None
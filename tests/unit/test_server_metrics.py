@@ -0,0 +1,79 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from pyglidein.server import server, set_state
+from pyglidein.server_metrics import Registry
+
+
+def test_exposition():
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Requests', ['method'])
+    gauge = registry.gauge('rows', 'Rows')
+    histogram = registry.histogram('duration_seconds', 'Duration', buckets=[1, 10])
+    counter.inc(method='get')
+    counter.inc(2, method='get')
+    counter.inc(method='a"b')
+    gauge.set(5)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert registry.exposition().split('\n') == [
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{method="a\\"b"} 1',
+        'requests_total{method="get"} 3',
+        '# HELP rows Rows',
+        '# TYPE rows gauge',
+        'rows 5',
+        '# HELP duration_seconds Duration',
+        '# TYPE duration_seconds histogram',
+        'duration_seconds_bucket{le="1"} 1',
+        'duration_seconds_bucket{le="10"} 2',
+        'duration_seconds_bucket{le="+Inf"} 2',
+        'duration_seconds_sum 5.5',
+        'duration_seconds_count 2',
+        '',
+    ]
+    with pytest.raises(ValueError):
+        counter.inc(other='get')
+
+
+class TestMetricsHandler(AsyncHTTPTestCase):
+    @pytest.fixture(autouse=True)
+    def set_cfg(self, server_cfg, row):
+        self.cfg = server_cfg
+        set_state(self.cfg, [row(10), row(5, cpus=4)])
+
+    def get_app(self):
+        return server(self.cfg).application
+
+    def metrics(self):
+        response = self.fetch('/metrics')
+        assert response.code == 200
+        assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+        return dict(line.rsplit(' ', 1) for line in response.body.decode('utf-8').split('\n')
+                    if line and not line.startswith('#'))
+
+    def test_state(self):
+        metrics = self.metrics()
+        assert metrics['pyglidein_state_rows'] == '2'
+        assert metrics['pyglidein_state_jobs'] == '15'
+        assert metrics['pyglidein_state_generation'] == str(self.cfg['state_generation'])
+        assert float(metrics['pyglidein_state_age_seconds']) < 60
+
+    def test_jsonrpc(self):
+        def count():
+            return float(self.metrics().get(
+                'pyglidein_jsonrpc_duration_seconds_count{method="get_state"}', 0))
+
+        def errors():
+            return float(self.metrics().get(
+                'pyglidein_jsonrpc_errors_total{method="unknown"}', 0))
+        before = (count(), errors())
+        for method in ('get_state', 'nope'):
+            self.fetch('/jsonrpc', method='POST', body=json.dumps(
+                {'jsonrpc': '2.0', 'method': method, 'id': 1}))
+        assert (count(), errors()) == (before[0] + 1, before[1] + 1)
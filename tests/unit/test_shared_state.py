@@ -0,0 +1,55 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+
+from pyglidein.server import poll_shared
+from pyglidein.shared_state import SharedStateWriter, SharedStateReader, header
+
+
+def test_publish_read(tmpdir):
+    path = str(tmpdir.join('state'))
+    writer = SharedStateWriter(path, size=64)
+    reader = SharedStateReader(path)
+    # nothing published yet
+    assert reader.read() is None
+    writer.publish(b'one')
+    assert reader.read() == b'one'
+    assert reader.read() is None
+    # larger than the file, which grows
+    writer.publish(b'x' * 1000)
+    assert reader.read() == b'x' * 1000
+    writer.publish(b'two')
+    assert reader.read() == b'two'
+    reader.close()
+    writer.close()
+
+
+def test_torn_read(tmpdir):
+    path = str(tmpdir.join('state'))
+    writer = SharedStateWriter(path)
+    reader = SharedStateReader(path)
+    writer.publish(b'one')
+    # the writer is in the middle of an update
+    header.pack_into(writer.map, 0, writer.seq + 1, 0)
+    assert reader.read() is None
+    header.pack_into(writer.map, 0, writer.seq + 2, 3)
+    writer.map[header.size:header.size+3] = b'two'
+    assert reader.read() == b'two'
+    reader.close()
+    writer.close()
+
+
+def test_poll_shared(tmpdir, server_cfg, row):
+    state_writer = SharedStateWriter(str(tmpdir.join('state')))
+    monitoring_writer = SharedStateWriter(str(tmpdir.join('monitoring')))
+    state_reader = SharedStateReader(str(tmpdir.join('state')))
+    monitoring_reader = SharedStateReader(str(tmpdir.join('monitoring')))
+    doc = {'epoch': 'collector', 'generation': 7, 'updated': 100., 'state': [row(3)],
+           'schedds': {}, 'history': False}
+    state_writer.publish(json.dumps(doc).encode('utf-8'))
+    monitoring_writer.publish(json.dumps({'monitoring': [], 'metrics': ''}).encode('utf-8'))
+    poll_shared(server_cfg, state_reader, monitoring_reader)
+    # the worker serves the generation and epoch of the collector
+    assert (server_cfg['state_epoch'], server_cfg['state_generation']) == ('collector', 7)
+    assert server_cfg['state'] == [row(3)]
+    assert [gen for gen, index in server_cfg['state_history']] == [7]
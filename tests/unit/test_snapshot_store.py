@@ -0,0 +1,52 @@
+from __future__ import absolute_import, division, print_function
+
+import time
+
+from pyglidein.server import load_snapshot
+from pyglidein.snapshot_store import SnapshotStore
+
+
+def test_save_load(tmpdir):
+    path = str(tmpdir.join('snapshot.db'))
+    store = SnapshotStore(path)
+    assert store.load() == (None, None, {})
+    store.save_state([{'cpus': 1, 'count': 2}], 100.)
+    store.save_state([{'cpus': 1, 'count': 3}], 200.)
+    store.save_monitoring({'a': {'timestamp': 150, 'glideins_idle': 1}})
+    store.save_monitoring({'b': {'timestamp': 160, 'glideins_idle': 2}})
+    store.close()
+
+    store = SnapshotStore(path)
+    state, timestamp, monitoring = store.load()
+    assert (state, timestamp) == ([{'cpus': 1, 'count': 3}], 200.)
+    assert monitoring == {'a': {'timestamp': 150, 'glideins_idle': 1},
+                          'b': {'timestamp': 160, 'glideins_idle': 2}}
+    # already saved
+    store.save_state([{'cpus': 1, 'count': 3}], 200.)
+    assert store.conn.execute('select count(*) from state').fetchone()[0] == 2
+    store.close()
+
+
+def test_compact(tmpdir):
+    store = SnapshotStore(str(tmpdir.join('snapshot.db')), keep_states=2)
+    now = time.time()
+    for i in range(5):
+        store.save_state([{'cpus': 1, 'count': i}], now + i)
+    store.save_monitoring({'old': {'timestamp': now - 1000}, 'new': {'timestamp': now}})
+    store.compact(max_monitoring_age=100)
+    assert store.conn.execute('select count(*) from state').fetchone()[0] == 2
+    state, timestamp, monitoring = store.load()
+    assert (state, timestamp) == ([{'cpus': 1, 'count': 4}], now + 4)
+    assert list(monitoring) == ['new']
+
+
+def test_load_snapshot(tmpdir, server_cfg, row):
+    store = SnapshotStore(str(tmpdir.join('snapshot.db')))
+    updated = time.time() - 60
+    store.save_state([row(3)], updated)
+    store.save_monitoring({'a': {'timestamp': updated, 'glideins_idle': 1}})
+    server_cfg['snapshot_store'] = store
+    load_snapshot(server_cfg)
+    assert server_cfg['state'] == [row(3)]
+    assert server_cfg['state_updated'] == updated
+    assert server_cfg['monitoring']['a']['glideins_idle'] == 1
@@ -0,0 +1,44 @@
+from __future__ import absolute_import, division, print_function
+
+from pyglidein.server import set_state, get_state_delta
+
+
+def without_count(row):
+    return dict((k, v) for k, v in row.items() if k != 'count')
+
+
+def test_full(server_cfg, row):
+    set_state(server_cfg, [row(10), row(5, cpus=4)])
+    ret = get_state_delta(server_cfg)
+    assert ret['full']
+    assert ret['epoch'] == server_cfg['state_epoch']
+    assert ret['generation'] == server_cfg['state_generation']
+    assert sorted(r['count'] for r in ret['state']) == [5, 10]
+
+
+def test_delta(server_cfg, row):
+    set_state(server_cfg, [row(10), row(5, cpus=4)])
+    old = get_state_delta(server_cfg)
+    set_state(server_cfg, [row(12), row(2, cpus=8)])
+    ret = get_state_delta(server_cfg, old['generation'], old['epoch'])
+    assert not ret['full']
+    assert ret['generation'] == old['generation'] + 1
+    assert sorted(ret['changed'], key=lambda r: r['cpus']) == [row(12), row(2, cpus=8)]
+    assert ret['removed'] == [without_count(row(5, cpus=4))]
+
+    ret = get_state_delta(server_cfg, ret['generation'], ret['epoch'])
+    assert (ret['full'], ret['changed'], ret['removed']) == (False, [], [])
+
+
+def test_full_on_unknown_generation(server_cfg, row):
+    set_state(server_cfg, [row(1)])
+    old = get_state_delta(server_cfg)
+    # another server instance
+    ret = get_state_delta(server_cfg, old['generation'], 'other epoch')
+    assert ret['full']
+    # a generation that dropped out of the history
+    for count in range(2, 2 + server_cfg['options'].state_history):
+        set_state(server_cfg, [row(count)])
+    ret = get_state_delta(server_cfg, old['generation'], old['epoch'])
+    assert ret['full']
+    assert ret['state'] == [row(1 + server_cfg['options'].state_history)]
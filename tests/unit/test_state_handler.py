@@ -0,0 +1,63 @@
+from __future__ import absolute_import, division, print_function
+
+import gzip
+import json
+from io import BytesIO
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from pyglidein.server import server, set_state
+
+
+def test_set_state_generation(server_cfg, row):
+    set_state(server_cfg, [row(1)])
+    generation = server_cfg['state_generation']
+    etag = server_cfg['state_cache']['etag']
+    # an unchanged state keeps its generation and etag
+    set_state(server_cfg, [row(1)])
+    assert server_cfg['state_generation'] == generation
+    set_state(server_cfg, [row(2)])
+    assert server_cfg['state_generation'] == generation + 1
+    assert server_cfg['state_cache']['etag'] != etag
+
+
+class TestStateHandler(AsyncHTTPTestCase):
+    @pytest.fixture(autouse=True)
+    def set_cfg(self, server_cfg, row):
+        self.cfg = server_cfg
+        self.row = row
+        set_state(self.cfg, [row(10), row(5, cpus=4)])
+
+    def get_app(self):
+        return server(self.cfg).application
+
+    def test_state(self):
+        response = self.fetch('/state')
+        assert response.code == 200
+        assert json.loads(response.body.decode('utf-8')) == self.cfg['state']
+        assert response.headers['X-State-Generation'] == str(self.cfg['state_generation'])
+        assert response.headers['ETag'] == self.cfg['state_cache']['etag']
+
+    def test_etag(self):
+        etag = self.fetch('/state').headers['ETag']
+        response = self.fetch('/state', headers={'If-None-Match': etag})
+        assert response.code == 304
+        assert response.body == b''
+        set_state(self.cfg, [self.row(11)])
+        response = self.fetch('/state', headers={'If-None-Match': etag})
+        assert response.code == 200
+        assert response.headers['ETag'] != etag
+
+    def test_gzip(self):
+        response = self.fetch('/state', headers={'Accept-Encoding': 'gzip'},
+                              decompress_response=False)
+        assert response.headers['Content-Encoding'] == 'gzip'
+        body = gzip.GzipFile(fileobj=BytesIO(response.body)).read()
+        assert body == self.cfg['state_cache']['body']
+
+    def test_jsonrpc(self):
+        response = self.fetch('/jsonrpc', method='POST', body=json.dumps(
+            {'jsonrpc': '2.0', 'method': 'get_state', 'id': 1}))
+        assert json.loads(response.body.decode('utf-8'))['result'] == self.cfg['state']
+        assert response.headers['ETag'] == self.cfg['state_cache']['etag']
@@ -0,0 +1,64 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+
+import pytest
+
+from pyglidein.server import StateIndex, set_state, get_state_delta
+
+
+def counts(rows):
+    return sorted(row['count'] for row in rows.values())
+
+
+def test_filter(row):
+    index = StateIndex([row(1), row(2, cpus=8), row(3, gpus=1), row(4, memory=16000),
+                        row(5, os='RHEL7')])
+    assert counts(index.filter()) == [1, 2, 3, 4, 5]
+    assert counts(index.filter({'gpu_only': True})) == [3]
+    assert counts(index.filter({'cpu_only': True})) == [1, 2, 4, 5]
+    assert counts(index.filter({'max_cpus': 4, 'max_memory': 8000})) == [1, 3, 5]
+    assert counts(index.filter({'min_cpus': 2})) == [2]
+    # rows without an os requirement match any os
+    assert counts(index.filter({'os': ['RHEL6']})) == [1, 2, 3, 4]
+    assert counts(index.filter({'os': ['RHEL6', 'RHEL7']})) == [1, 2, 3, 4, 5]
+
+
+def test_filter_errors(row):
+    index = StateIndex([row(1)])
+    with pytest.raises(Exception):
+        index.filter({'nope': 1})
+
+
+def test_filter_cache(row):
+    index = StateIndex([row(1), row(2, cpus=8)])
+    ret = index.filter({'max_cpus': 4, 'os': ['b', 'a']})
+    assert index.filter({'os': ['a', 'b'], 'max_cpus': 4}) is ret
+    assert len(index.cache) == 1
+
+
+def test_encoded(row):
+    state = [row(1), row(2, cpus=8), row(3, gpus=1)]
+    index = StateIndex(state)
+    ret = json.loads(index.encoded({'cpu_only': True}).decode('utf-8'))
+    # in state order
+    assert ret == [state[0], state[1]]
+    assert index.encoded({'cpu_only': True}) is index.encoded({'cpu_only': True})
+
+
+def test_list_filters(row):
+    index = StateIndex([row(1), row(2, os_arch='RHEL_7_x86_64,RHEL_8_x86_64'),
+                        row(3, site='SiteA'), row(4, cvmfs=True)])
+    assert counts(index.filter({'os_arch': 'RHEL_8_x86_64'})) == [1, 2, 3, 4]
+    assert counts(index.filter({'os_arch': 'RHEL_6_x86_64'})) == [1, 3, 4]
+    assert counts(index.filter({'site': 'SiteB'})) == [1, 2, 4]
+    assert counts(index.filter({'cvmfs': False})) == [1, 2, 3]
+
+
+def test_filtered_delta(server_cfg, row):
+    set_state(server_cfg, [row(1), row(2, gpus=1)])
+    old = get_state_delta(server_cfg, filters={'gpu_only': True})
+    assert [r['count'] for r in old['state']] == [2]
+    set_state(server_cfg, [row(3), row(2, gpus=1)])
+    ret = get_state_delta(server_cfg, old['generation'], old['epoch'], {'gpu_only': True})
+    assert (ret['full'], ret['changed'], ret['removed']) == (False, [], [])
@@ -0,0 +1,61 @@
+from __future__ import absolute_import, division, print_function
+
+from pyglidein.client_util import StateSync
+
+
+def jsonrpc(responses):
+    """Handler answering get_state_delta calls with `responses`, in order"""
+    def handler(request):
+        if isinstance(request, dict) and request['method'] == 'get_state_delta':
+            return 200, {'jsonrpc': '2.0', 'result': responses.pop(0), 'id': request['id']}
+        return 404, None
+    return handler
+
+
+def test_delta(stub_server):
+    stub_server.handler = jsonrpc([
+        {'epoch': 'e1', 'generation': 1, 'full': True,
+         'state': [{'cpus': 1, 'count': 10}, {'cpus': 4, 'count': 5}]},
+        {'epoch': 'e1', 'generation': 2, 'full': False,
+         'changed': [{'cpus': 1, 'count': 12}, {'cpus': 8, 'count': 2}],
+         'removed': [{'cpus': 4}]},
+    ])
+    sync = StateSync(stub_server.address, filters={'cpu_only': True})
+    assert sorted(r['count'] for r in sync.get_state()) == [5, 10]
+    assert stub_server.requests[0]['params'] == {'since_generation': None, 'epoch': None,
+                                                 'filters': {'cpu_only': True}}
+    state = sync.get_state()
+    assert sorted((r['cpus'], r['count']) for r in state) == [(1, 12), (8, 2)]
+    assert stub_server.requests[1]['params']['since_generation'] == 1
+    assert stub_server.requests[1]['params']['epoch'] == 'e1'
+    # callers get copies
+    state[0]['count'] = 0
+    assert 0 not in [r['count'] for r in sync.rows.values()]
+
+
+def test_epoch_reset(stub_server):
+    stub_server.handler = jsonrpc([
+        {'epoch': 'e1', 'generation': 5, 'full': True, 'state': [{'cpus': 1, 'count': 10}]},
+        # the server restarted
+        {'epoch': 'e2', 'generation': 1, 'full': True, 'state': [{'cpus': 2, 'count': 3}]},
+    ])
+    sync = StateSync(stub_server.address)
+    sync.get_state()
+    assert sync.get_state() == [{'cpus': 2, 'count': 3}]
+    assert (sync.epoch, sync.generation) == ('e2', 1)
+
+
+def test_fallback(stub_server):
+    def handler(request):
+        if request == '/state':
+            return 404, None
+        if request['method'] == 'get_state':
+            return 200, {'jsonrpc': '2.0', 'result': [{'cpus': 1, 'count': 7}],
+                         'id': request['id']}
+        return 200, {'jsonrpc': '2.0', 'id': request['id'],
+                     'error': {'code': -32601, 'message': 'Method not found'}}
+    stub_server.handler = handler
+    sync = StateSync(stub_server.address)
+    sync.generation = 3
+    assert sync.get_state() == [{'cpus': 1, 'count': 7}]
+    assert sync.generation is None
@@ -0,0 +1,38 @@
+from __future__ import absolute_import, division, print_function
+
+import io
+
+from pyglidein.submit import SubmitPBS, SubmitSLURM, SubmitUGE, SubmitLSF
+
+
+def array_options(cls, cluster_config, num_jobs=10):
+    f = io.StringIO()
+    cls({}, {}).write_array_option(f, cluster_config, num_jobs)
+    return f.getvalue().strip().split('\n')
+
+
+def test_array_options():
+    assert array_options(SubmitPBS, {}) == ['#PBS -t 1-10']
+    assert array_options(SubmitSLURM, {}) == ['#SBATCH --array=1-10']
+    assert array_options(SubmitUGE, {}) == ['#$ -t 1-10']
+    assert array_options(SubmitLSF, {}) == ['#BSUB -J "glidein[1-10]"']
+
+
+def test_array_throttle():
+    # max_idle_jobs does not throttle arrays
+    assert array_options(SubmitPBS, {'max_idle_jobs': 5}) == ['#PBS -t 1-10']
+    assert array_options(SubmitPBS, {'array_throttle': 5}) == ['#PBS -t 1-10%5']
+    assert array_options(SubmitPBS, {'array_throttle': 20}) == ['#PBS -t 1-10']
+    assert array_options(SubmitSLURM, {'array_throttle': 5}) == ['#SBATCH --array=1-10%5']
+    assert array_options(SubmitUGE, {'array_throttle': 5}) == ['#$ -t 1-10', '#$ -tc 5']
+    assert array_options(SubmitLSF, {'array_throttle': 5}) == ['#BSUB -J "glidein[1-10]%5"']
+
+
+def test_parse_job_id():
+    assert SubmitPBS({}, {}).parse_job_id('1234[].server\n') == '1234[].server'
+    assert SubmitSLURM({}, {}).parse_job_id('Submitted batch job 1234\n') == '1234'
+    assert SubmitUGE({}, {}).parse_job_id(
+        'Your job-array 1234.1-10:1 ("glidein") has been submitted\n') == '1234'
+    assert SubmitLSF({}, {}).parse_job_id(
+        'Job <1234> is submitted to default queue <normal>.\n') == '1234'
+    assert SubmitSLURM({}, {}).parse_job_id('error\n') is None
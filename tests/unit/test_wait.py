@@ -0,0 +1,91 @@
+from __future__ import absolute_import, division, print_function
+
+import json
+import socket
+import time
+
+import pytest
+import tornado.gen
+from tornado.iostream import IOStream
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from pyglidein.client_util import wait_for_state
+from pyglidein.server import server, set_state, WaitHandler
+
+
+class TestWaitHandler(AsyncHTTPTestCase):
+    @pytest.fixture(autouse=True)
+    def set_cfg(self, server_cfg, row):
+        self.cfg = server_cfg
+        self.row = row
+        set_state(self.cfg, [row(1)])
+
+    def get_app(self):
+        return server(self.cfg).application
+
+    def wait(self, **args):
+        args.setdefault('epoch', self.cfg['state_epoch'])
+        args.setdefault('generation', self.cfg['state_generation'])
+        url = '/wait?' + '&'.join('{}={}'.format(k, v) for k, v in args.items())
+        return self.http_client.fetch(self.get_url(url), raise_error=False)
+
+    @gen_test
+    def test_changed(self):
+        response = yield self.wait(generation=self.cfg['state_generation']-1)
+        assert json.loads(response.body.decode('utf-8')) == {
+            'epoch': self.cfg['state_epoch'], 'generation': self.cfg['state_generation'],
+            'changed': True}
+        response = yield self.wait(epoch='other')
+        assert json.loads(response.body.decode('utf-8'))['changed']
+
+    @gen_test
+    def test_wait(self):
+        start = time.time()
+        self.io_loop.call_later(0.1, lambda: set_state(self.cfg, [self.row(2)]))
+        response = yield self.wait(timeout=10)
+        assert json.loads(response.body.decode('utf-8'))['changed']
+        assert time.time() - start < 5
+
+    @gen_test
+    def test_timeout(self):
+        response = yield self.wait(timeout=0.1)
+        assert not json.loads(response.body.decode('utf-8'))['changed']
+        response = yield self.wait(timeout='x')
+        assert response.code == 400
+
+    @gen_test
+    def test_disconnect(self):
+        finished = []
+        on_finish = WaitHandler.on_finish
+        WaitHandler.on_finish = lambda handler: finished.append(handler)
+        try:
+            stream = IOStream(socket.socket())
+            yield stream.connect(('127.0.0.1', self.get_http_port()))
+            yield stream.write('GET /wait?generation={}&epoch={}&timeout=300 HTTP/1.1\r\n'
+                               'Host: localhost\r\n\r\n'.format(
+                                   self.cfg['state_generation'],
+                                   self.cfg['state_epoch']).encode('utf-8'))
+            yield tornado.gen.sleep(0.1)
+            stream.close()
+            for _ in range(50):
+                if finished:
+                    break
+                yield tornado.gen.sleep(0.01)
+        finally:
+            WaitHandler.on_finish = on_finish
+        # the wait ended without a state change or timeout
+        assert finished
+
+
+def test_wait_for_state(stub_server):
+    stub_server.handler = lambda request: (200, {'epoch': 'e1', 'generation': 3,
+                                                 'changed': True})
+    assert wait_for_state(stub_server.address, 2, 'e1', 30)
+    path = stub_server.requests[0]
+    assert path.startswith('/wait?')
+    assert sorted(path.split('?')[1].split('&')) == ['epoch=e1', 'generation=2', 'timeout=30']
+    stub_server.handler = lambda request: (200, {'epoch': 'e1', 'generation': 2,
+                                                 'changed': False})
+    assert not wait_for_state(stub_server.address, None, None, 30)
+    assert sorted(stub_server.requests[1].split('?')[1].split('&')) == [
+        'generation=0', 'timeout=30']